@@ -0,0 +1,526 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import faults
+import gateway
+import storage
+import timestamps
+import tracing
+from payload_codec import CONTENT_FORMATS, encode
+from reading import Reading
+
+# Hermetic protocol benchmarks: everything runs in this process against localhost on ports
+# away from the simulator's defaults, with fault injection and tracing off and fixed seeds,
+# so two reports from different commits can be compared with --compare.
+
+MQTT_PORT = 21883
+COAP_PORT = 25684
+MODBUS_BASE_PORT = 21600
+SENSORS = ("humidity", "light", "temperature")
+
+
+def _rss_mb():
+    # current resident set size; falls back to the peak where /proc is not available
+    try:
+        with open("/proc/self/statm", "r") as fh:
+            return round(int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20, 1)
+    except Exception:
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return round(peak / (2**20 if sys.platform == "darwin" else 2**10), 1)
+    except Exception:
+        return None
+
+
+def _percentiles(samples_ms: list) -> dict | None:
+    if not samples_ms:
+        return None
+    s = sorted(samples_ms)
+
+    def pick(q):
+        return round(s[min(len(s) - 1, int(q * len(s)))], 4)
+
+    return {"p50": pick(0.5), "p90": pick(0.9), "p99": pick(0.99), "max": round(s[-1], 4),
+            "mean": round(sum(s) / len(s), 4)}
+
+
+def _wait_for_port(port: int, timeout: float = 5.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+
+def _readings(n: int, seed: int, devices: int = 10, protocol: str = "MQTT") -> list:
+    """n deterministic readings spread over devices, stamped as sent now."""
+    rng = random.Random(seed)
+    out = []
+    seqs = [0] * devices
+    now = timestamps.utc_now()
+    t, d = now.strftime("%H:%M:%S"), now.strftime("%Y-%m-%d")
+    for _ in range(n):
+        i = rng.randrange(devices)
+        r = Reading(device_id=f"bench{i}", time=t, date=d, protocol=protocol, sensor_type=rng.choice(SENSORS),
+                    value=round(rng.uniform(0, 500), 2), seq=seqs[i])
+        seqs[i] += 1
+        r.stamp_send()
+        out.append(r)
+    return out
+
+
+class _CaptureSink:
+    """Records arrival count and latency of everything the gateway persists."""
+
+    name = "benchmark"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.count = 0
+            self.latencies = []
+            self.last_ns = 0
+
+    def write(self, batch: list):
+        now = time.perf_counter_ns()
+        with self._lock:
+            self.count += len(batch)
+            self.latencies.extend(r.latency_ms for r in batch if r.latency_ms is not None)
+            self.last_ns = now
+
+    def wait_for(self, n: int, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.count >= n:
+                return True
+            time.sleep(0.005)
+        return False
+
+    def close(self):
+        pass
+
+
+class Bench:
+    """One benchmark: setup() once, then prepare(n) and run(n) for the warm-up and every measured repeat.
+
+    prepare(n) builds the inputs of the next run outside the timed window. run(n) performs n operations and returns per-operation latencies in ms (or None); it may
+    return (latencies, ops) when the number of operations differs from n.
+    """
+
+    name = ""
+    unit = "ops"
+
+    def setup(self, args):
+        pass
+
+    def prepare(self, n: int):
+        pass
+
+    def run(self, n: int):
+        raise NotImplementedError
+
+    def teardown(self):
+        pass
+
+
+class SaveMany(Bench):
+    name = "storage.save_many"
+    unit = "records"
+
+    def setup(self, args):
+        self.batch = args.batch
+        self.readings = _readings(self.batch * 64, args.seed)
+
+    def run(self, n):
+        lat = []
+        done = 0
+        while done < n:
+            chunk = self.readings[:min(self.batch, n - done)]
+            t0 = time.perf_counter_ns()
+            storage.save_many(chunk)
+            lat.append((time.perf_counter_ns() - t0) / 1e6)
+            done += len(chunk)
+        return lat, done
+
+
+class SaveToCsv(Bench):
+    name = "storage.save_to_csv"
+    unit = "records"
+
+    def setup(self, args):
+        self.readings = _readings(1024, args.seed)
+
+    def run(self, n):
+        lat = []
+        readings = self.readings
+        for i in range(n):
+            t0 = time.perf_counter_ns()
+            storage.save_to_csv(readings[i % len(readings)])
+            lat.append((time.perf_counter_ns() - t0) / 1e6)
+        return lat
+
+
+class ProcessMessages(Bench):
+    name = "gateway.process_messages"
+    unit = "records"
+
+    def setup(self, args):
+        self.batch = args.batch
+        self.seed = args.seed
+
+    def prepare(self, n):
+        # fresh readings each run: the gateway stamps receive_ts on readings that have none
+        self.readings = _readings(n, self.seed)
+
+    def run(self, n):
+        readings = self.readings
+        lat = []
+        for i in range(0, n, self.batch):
+            chunk = readings[i:i + self.batch]
+            t0 = time.perf_counter_ns()
+            gateway.process_messages(chunk)
+            lat.append((time.perf_counter_ns() - t0) / 1e6)
+        return lat, n
+
+
+class ProcessMessage(ProcessMessages):
+    name = "gateway.process_message"
+
+    def setup(self, args):
+        super().setup(args)
+        self.batch = 1
+
+
+class CollectorOnMessage(Bench):
+    name = "MqttCollector._on_message"
+    unit = "messages"
+
+    def setup(self, args):
+        from collector.mqtt_collector import MqttCollector
+        self.collector = MqttCollector(encoding=args.encoding)
+        self.encoding = args.encoding
+        self.seed = args.seed
+
+    def prepare(self, n):
+        self.messages = [SimpleNamespace(payload=encode(r.to_payload(), self.encoding, "MQTT")[0], topic="iot")
+                         for r in _readings(n, self.seed)]
+
+    def run(self, n):
+        on_message = self.collector._on_message
+        lat = []
+        for msg in self.messages:
+            t0 = time.perf_counter_ns()
+            on_message(None, None, msg)
+            lat.append((time.perf_counter_ns() - t0) / 1e6)
+        return lat
+
+
+class ModbusCycle(Bench):
+    name = "ModbusPoller.poll_once"
+    unit = "cycles"
+
+    def setup(self, args):
+        from devices.modbus_device import start_modbus_device_thread
+        from gateway_modbus_poller import ModbusPoller
+        targets = []
+        for i in range(args.modbus_devices):
+            port = MODBUS_BASE_PORT + i
+            start_modbus_device_thread(host="127.0.0.1", port=port, update_interval=0.01)
+            if not _wait_for_port(port):
+                raise RuntimeError(f"Modbus device on port {port} did not start listening")
+            targets.append({"host": "127.0.0.1", "port": port, "device_id": f"benchmodbus{i}"})
+        self.poller = ModbusPoller(targets, poll_interval=0)
+        self.readings = 0
+
+    def run(self, n):
+        lat = []
+        for _ in range(n):
+            t0 = time.perf_counter_ns()
+            self.readings += self.poller.poll_once()
+            lat.append((time.perf_counter_ns() - t0) / 1e6)
+        return lat
+
+
+class CoapRoundTrip(Bench):
+    name = "coap.round_trip"
+    unit = "requests"
+
+    def setup(self, args):
+        import aiocoap
+        from gateway_coap_server import start_coap_server
+        self._aiocoap = aiocoap
+        self.encoding = args.encoding if args.encoding in ("json", "cbor") else "json"
+        self.concurrency = args.concurrency
+        self.seed = args.seed
+        start_coap_server(bind_port=COAP_PORT, encoding=self.encoding)
+        self.loop = asyncio.new_event_loop()
+        self.context = self.loop.run_until_complete(aiocoap.Context.create_client_context())
+
+    async def _send_all(self, payloads):
+        aiocoap = self._aiocoap
+        uri = f"coap://127.0.0.1:{COAP_PORT}/gateway"
+        sem = asyncio.Semaphore(self.concurrency)
+        lat = []
+
+        async def one(payload):
+            async with sem:
+                request = aiocoap.Message(code=aiocoap.POST, uri=uri, payload=payload,
+                                          content_format=CONTENT_FORMATS[self.encoding])
+                t0 = time.perf_counter_ns()
+                await self.context.request(request).response
+                lat.append((time.perf_counter_ns() - t0) / 1e6)
+
+        await asyncio.gather(*(one(p) for p in payloads))
+        return lat
+
+    def prepare(self, n):
+        self.payloads = [encode(r.to_payload(), self.encoding, "COAP")[0]
+                         for r in _readings(n, self.seed, protocol="COAP")]
+
+    def run(self, n):
+        return self.loop.run_until_complete(self._send_all(self.payloads))
+
+    def teardown(self):
+        self.loop.run_until_complete(self.context.shutdown())
+        self.loop.close()
+
+
+class MqttEndToEnd(Bench):
+    """Publisher -> built-in broker -> MqttCollector -> gateway -> sinks, as fast as the client publishes.
+
+    Latency is the gateway's send_ts -> receive_ts latency_ms; throughput counts readings
+    persisted between the first publish and the last arrival.
+    """
+
+    name = "e2e.mqtt"
+    unit = "readings"
+
+    def setup(self, args):
+        import paho.mqtt.client as mqtt
+        from collector.local_broker import LocalBroker
+        from collector.mqtt_collector import MqttCollector
+        self.qos = args.qos
+        self.encoding = args.encoding
+        self.batch = args.mqtt_batch
+        self.seed = args.seed
+        self.broker = LocalBroker(host="127.0.0.1", port=MQTT_PORT)
+        self.broker.start()
+        self.sink = _CaptureSink()
+        gateway.add_sink(self.sink)
+        self.collector = MqttCollector(broker_host="127.0.0.1", broker_port=MQTT_PORT, topic="bench",
+                                       qos=min(self.qos, 1), encoding=self.encoding)
+        self.collector.start()
+        self.client = mqtt.Client(client_id="bench-publisher")
+        self.client.max_inflight_messages_set(1000)
+        connected = threading.Event()
+        self.client.on_connect = lambda client, userdata, flags, rc: connected.set()
+        self.client.connect("127.0.0.1", MQTT_PORT)
+        self.client.loop_start()
+        if not connected.wait(5):
+            raise RuntimeError("benchmark publisher could not connect to the broker")
+        time.sleep(0.2)  # let the collector subscribe
+
+    def prepare(self, n):
+        readings = _readings(n, self.seed)
+        self.bodies = []
+        for i in range(0, n, self.batch):
+            chunk = readings[i:i + self.batch]
+            if self.batch == 1:
+                self.bodies.append(chunk[0].to_payload())
+            else:
+                self.bodies.append({"device_id": chunk[0].device_id, "protocol": "MQTT",
+                                    "batch": [r.to_payload(batch_item=True) for r in chunk]})
+
+    def run(self, n):
+        self.sink.reset()
+        t0 = time.perf_counter_ns()
+        for body in self.bodies:
+            # stamped at publish time so queueing in the publisher is not counted as latency
+            for item in body.get("batch", [body]):
+                item["send_ts"], mono = timestamps.send_stamp()
+                if mono is not None:
+                    item["send_mono_ns"] = mono
+            self.client.publish("bench", encode(body, self.encoding, "MQTT")[0], qos=self.qos)
+        if not self.sink.wait_for(n, timeout=max(10.0, n / 200)):
+            print(f"[BENCHMARK] e2e.mqtt: only {self.sink.count}/{n} readings arrived")
+        elapsed_s = ((self.sink.last_ns or time.perf_counter_ns()) - t0) / 1e9
+        return list(self.sink.latencies), self.sink.count, elapsed_s
+
+    def teardown(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+        self.collector.stop()
+        self.broker.stop()
+        gateway.sinks.remove(self.sink)
+
+
+BENCHMARKS = [SaveMany, SaveToCsv, ProcessMessages, ProcessMessage, CollectorOnMessage, ModbusCycle,
+              CoapRoundTrip, MqttEndToEnd]
+# operations per measured repeat (scaled by --scale)
+DEFAULT_OPS = {
+    "storage.save_many": 50000,
+    "storage.save_to_csv": 10000,
+    "gateway.process_messages": 20000,
+    "gateway.process_message": 5000,
+    "MqttCollector._on_message": 5000,
+    "ModbusPoller.poll_once": 200,
+    "coap.round_trip": 1000,
+    "e2e.mqtt": 10000,
+}
+
+
+def _measure(bench: Bench, n: int, warmup: int, repeat: int, seed: int) -> dict:
+    random.seed(seed)
+    if warmup:
+        bench.prepare(warmup)
+        bench.run(warmup)
+    runs = []
+    for _ in range(repeat):
+        random.seed(seed)
+        # every repeat replays the same sequence numbers; start the loss accounting afresh
+        gateway.sequences.reset()
+        bench.prepare(n)
+        cpu0, wall0 = time.process_time(), time.perf_counter()
+        out = bench.run(n)
+        wall, cpu = time.perf_counter() - wall0, time.process_time() - cpu0
+        lat, ops = (out, n) if not isinstance(out, tuple) else out[:2]
+        if isinstance(out, tuple) and len(out) > 2:
+            wall = out[2]  # the benchmark measured its own active interval
+        runs.append({"ops": ops, "seconds": round(wall, 4), "ops_per_s": round(ops / wall, 1) if wall > 0 else None,
+                     "cpu_seconds": round(cpu, 4), "cpu_util": round(cpu / wall, 3) if wall > 0 else None,
+                     "latency_ms": _percentiles(lat or [])})
+    # report the median repeat by throughput; all repeats are kept for spread
+    best = sorted(runs, key=lambda r: r["ops_per_s"] or 0)[len(runs) // 2]
+    return {**best, "unit": bench.unit, "rss_mb": _rss_mb(), "repeats": [r["ops_per_s"] for r in runs]}
+
+
+def _git_commit():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5,
+                             cwd=Path(__file__).resolve().parent)
+        return out.stdout.strip() or None
+    except Exception:
+        return None
+
+
+def run_benchmarks(args) -> dict:
+    # hermetic settings: no injected faults, no tracing, output into a temporary directory
+    faults.LOSS_RATE, faults.FAIL_PROB, faults.LATENCY_RANGE = 0.0, 0.0, (0, 0)
+    tracing.initialize(0.0)
+    timestamps.set_mode(args.timestamp_mode)
+    storage.SENT_LOG_ENABLED = False
+    workdir = Path(tempfile.mkdtemp(prefix="iot-bench-"))
+    storage.initialize_output(str(workdir / "recorded.csv"))
+    selected = [b for b in BENCHMARKS if not args.only or any(o in b.name for o in args.only)]
+    results = {}
+    for cls in selected:
+        bench = cls()
+        n = max(1, int(DEFAULT_OPS[cls.name] * args.scale))
+        print(f"[BENCHMARK] {cls.name}: {n} {cls.unit} x {args.repeat}")
+        try:
+            bench.setup(args)
+            results[cls.name] = _measure(bench, n, max(1, n // 10) if args.warmup else 0, args.repeat, args.seed)
+        except Exception as e:
+            print(f"[BENCHMARK] {cls.name} failed: {e}")
+            results[cls.name] = {"error": str(e)}
+        finally:
+            try:
+                bench.teardown()
+            except Exception:
+                pass
+        r = results[cls.name]
+        if "error" not in r:
+            lat = r["latency_ms"] or {}
+            print(f"  {r['ops_per_s']} {cls.unit}/s, p50 {lat.get('p50')} ms, p99 {lat.get('p99')} ms, "
+                  f"cpu {r['cpu_util']}, rss {r['rss_mb']} MB")
+    storage.close()
+    return {
+        "meta": {
+            "commit": _git_commit(),
+            "created": timestamps.utc_now().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "args": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        },
+        "results": results,
+    }
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> list:
+    """Rows of (benchmark, metric, baseline, current, change, regressed) for ops_per_s and p99 latency."""
+    rows = []
+    for name, cur in current["results"].items():
+        base = baseline.get("results", {}).get(name)
+        if not base or "error" in base or "error" in cur:
+            continue
+        pairs = [("ops_per_s", base.get("ops_per_s"), cur.get("ops_per_s"), -1)]
+        pairs.append(("p99_ms", (base.get("latency_ms") or {}).get("p99"), (cur.get("latency_ms") or {}).get("p99"), 1))
+        for metric, b, c, worse in pairs:
+            if not b or c is None:
+                continue
+            change = (c - b) / b
+            rows.append((name, metric, b, c, change, change * worse > threshold))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the protocol stacks and hot components on localhost.")
+    parser.add_argument("--only", nargs="*", help="run benchmarks whose name contains any of these strings")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply the operations per repeat")
+    parser.add_argument("--repeat", type=int, default=3, help="measured repeats per benchmark (median is reported)")
+    parser.add_argument("--no-warmup", dest="warmup", action="store_false", help="skip the warm-up run")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--batch", type=int, default=100, help="records per batch for the batch APIs")
+    parser.add_argument("--encoding", default="json", help="payload encoding (json, cbor, msgpack, packed)")
+    parser.add_argument("--qos", type=int, default=0, help="MQTT QoS for the end-to-end run")
+    parser.add_argument("--mqtt-batch", type=int, default=1, help="readings per MQTT publish in the end-to-end run")
+    parser.add_argument("--concurrency", type=int, default=8, help="outstanding CoAP requests")
+    parser.add_argument("--modbus-devices", type=int, default=4, help="Modbus devices polled per cycle")
+    parser.add_argument("--timestamp-mode", default="iso", choices=timestamps.MODES)
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON report path")
+    parser.add_argument("--compare", help="baseline JSON report to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="relative throughput drop / p99 increase reported as a regression")
+    args = parser.parse_args(argv)
+
+    report = run_benchmarks(args)
+    with open(args.output, "w", encoding="utf-8") as fh:
+        json.dump(report, fh, indent=2)
+    print(f"Report written to {args.output}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as fh:
+            baseline = json.load(fh)
+        rows = compare(baseline, report, args.threshold)
+        print(f"Compared with {args.compare} (commit {baseline.get('meta', {}).get('commit')}):")
+        for name, metric, b, c, change, regressed in rows:
+            flag = "  REGRESSION" if regressed else ""
+            print(f"  {name:28s} {metric:10s} {b:>12} -> {c:>12} ({change:+.1%}){flag}")
+        if any(r[5] for r in rows):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
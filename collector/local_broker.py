@@ -1,104 +1,95 @@
-import threading
-import asyncio
-import subprocess
-import shutil
-import time
-
-
-class LocalBroker:
-
-    def __init__(self, host='127.0.0.1', port=1883):
-        self.host = host
-        self.port = port
-        self._mode = None  # 'hbmqtt' or 'mosquitto' or None
-        self._thread = None
-        self._loop = None
-        self._broker = None
-        self._mosquitto_proc = None
-
-    def _try_start_hbmqtt(self):
-        try:
-            from hbmqtt.broker import Broker
-        except Exception as e:
-            # ImportError or runtime incompatibilities (websockets, etc.)
-            return False, f"hbmqtt import failed: {e}"
-
-        config = {
-            'listeners': {
-                'default': {
-                    'type': 'tcp',
-                    'bind': f'{self.host}:{self.port}'
-                }
-            },
-            'sys_interval': 10,
-            'topic-check': {
-                'enabled': False
-            }
-        }
-
-        self._broker = Broker(config)
-
-        def _run():
-            self._loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(self._loop)
-            try:
-                self._loop.run_until_complete(self._broker.start())
-                self._loop.run_forever()
-            finally:
-                try:
-                    self._loop.run_until_complete(self._broker.shutdown())
-                except Exception:
-                    pass
-
-        self._thread = threading.Thread(target=_run, daemon=True)
-        self._thread.start()
-        # small delay to start
-        time.sleep(0.2)
-        return True, "hbmqtt started"
-
-    def _try_start_mosquitto(self):
-        mosq = shutil.which('mosquitto')
-        if not mosq:
-            return False, 'mosquitto not found'
-        # Start mosquitto in background, bind to requested port if possible
-        try:
-            # -p sets the port
-            proc = subprocess.Popen([mosq, '-p', str(self.port)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            self._mosquitto_proc = proc
-            # give it a moment to start
-            time.sleep(0.2)
-            return True, 'mosquitto started'
-        except Exception as e:
-            return False, f'mosquitto start failed: {e}'
-
-    def start(self):
-        # Try hbmqtt first (lazy import)
-        ok, msg = self._try_start_hbmqtt()
-        if ok:
-            self._mode = 'hbmqtt'
-            return
-
-        # hbmqtt failed; try mosquitto
-        ok2, msg2 = self._try_start_mosquitto()
-        if ok2:
-            self._mode = 'mosquitto'
-            return
-
-        # If both failed, raise with helpful message
-        raise RuntimeError(f"Failed to start local MQTT broker: {msg}; {msg2}")
-
-    def stop(self):
-        if self._mode == 'hbmqtt' and self._broker and self._loop:
-            try:
-                self._loop.call_soon_threadsafe(self._loop.stop)
-            except Exception:
-                pass
-            if self._thread:
-                self._thread.join(timeout=2)
-        elif self._mode == 'mosquitto' and self._mosquitto_proc:
-            try:
-                self._mosquitto_proc.terminate()
-                self._mosquitto_proc.wait(timeout=2)
-            except Exception:
-                pass
-        self._mode = None
+import subprocess
+import shutil
+import socket
+import time
+
+from collector.mqtt_broker import MqttBroker
+
+
+class LocalBroker:
+
+    def __init__(self, host='127.0.0.1', port=1883):
+        self.host = host
+        self.port = port
+        self._mode = None  # 'builtin', 'mosquitto', 'external' or None
+        self._broker = None
+        self._mosquitto_proc = None
+
+    def _try_start_builtin(self):
+        broker = MqttBroker(host=self.host, port=self.port)
+        try:
+            # returns once the listener is bound, no need to sleep
+            broker.start()
+        except Exception as e:
+            return False, f"built-in broker failed: {e}"
+        self._broker = broker
+        return True, "built-in broker started"
+
+    def _port_open(self) -> bool:
+        # one attempt: a refused connect means nothing listens, so there is nothing to wait for
+        try:
+            with socket.create_connection((self.host, self.port), timeout=0.2):
+                return True
+        except OSError:
+            return False
+
+    def _wait_for_port(self, timeout=3.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self._port_open():
+                return True
+            time.sleep(0.05)
+        return False
+
+    def _try_start_mosquitto(self):
+        mosq = shutil.which('mosquitto')
+        if not mosq:
+            return False, 'mosquitto not found'
+        # Start mosquitto in background, bind to requested port if possible
+        try:
+            # -p sets the port
+            proc = subprocess.Popen([mosq, '-p', str(self.port)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            self._mosquitto_proc = proc
+            if not self._wait_for_port():
+                return False, 'mosquitto did not start listening'
+            return True, 'mosquitto started'
+        except Exception as e:
+            return False, f'mosquitto start failed: {e}'
+
+    def start(self):
+        # A broker is already listening (e.g. a system mosquitto): just use it
+        if self._port_open():
+            self._mode = 'external'
+            return
+
+        # In-repo asyncio broker first: no external packages or binaries needed
+        ok, msg = self._try_start_builtin()
+        if ok:
+            self._mode = 'builtin'
+            return
+
+        # built-in broker failed (e.g. port taken); try mosquitto
+        ok2, msg2 = self._try_start_mosquitto()
+        if ok2:
+            self._mode = 'mosquitto'
+            return
+
+        # If both failed, raise with helpful message
+        raise RuntimeError(f"Failed to start local MQTT broker: {msg}; {msg2}")
+
+    def stats(self) -> dict:
+        """Per-client and per-topic counters (built-in broker only)."""
+        if self._mode == 'builtin' and self._broker:
+            return self._broker.stats()
+        return {}
+
+    def stop(self):
+        if self._mode == 'builtin' and self._broker:
+            self._broker.stop()
+        elif self._mode == 'mosquitto' and self._mosquitto_proc:
+            try:
+                self._mosquitto_proc.terminate()
+                self._mosquitto_proc.wait(timeout=2)
+            except Exception:
+                pass
+        self._mode = None
@@ -0,0 +1,452 @@
+import asyncio
+import itertools
+import struct
+import threading
+from collections import deque
+
+# MQTT 3.1.1 control packet types
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+PUBREC = 5
+PUBREL = 6
+PUBCOMP = 7
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+_PINGRESP = bytes([PINGRESP << 4, 0])
+_WRITE_HIGH_WATER = 256 * 1024  # bytes buffered towards a subscriber before we wait for it
+
+
+def _encode_length(n: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = n % 128
+        n //= 128
+        if n:
+            byte |= 0x80
+        out.append(byte)
+        if not n:
+            return bytes(out)
+
+
+def _encode_str(s: str) -> bytes:
+    b = s.encode('utf-8')
+    return struct.pack('!H', len(b)) + b
+
+
+def _packet(first: int, body: bytes) -> bytes:
+    return bytes([first]) + _encode_length(len(body)) + body
+
+
+def _publish_packet(topic: str, payload: bytes, qos: int, retain: bool, packet_id: int | None = None, dup=False) -> bytes:
+    first = (PUBLISH << 4) | (qos << 1) | (1 if retain else 0) | (0x08 if dup else 0)
+    body = _encode_str(topic)
+    if qos:
+        body += struct.pack('!H', packet_id)
+    return _packet(first, body + payload)
+
+
+def _read_str(buf: bytes, pos: int):
+    (n,) = struct.unpack_from('!H', buf, pos)
+    pos += 2
+    return buf[pos:pos + n].decode('utf-8'), pos + n
+
+
+class TopicTrie:
+    """Subscription index keyed by topic level, with '+' and '#' wildcard support.
+
+    Lookups walk at most one exact, one '+' and one '#' branch per level, so matching cost
+    depends on topic depth rather than on the number of subscriptions.
+    """
+
+    __slots__ = ('children', 'subscribers')
+
+    def __init__(self):
+        self.children = {}
+        self.subscribers = {}  # Session -> granted qos
+
+    def add(self, topic_filter: str, session, qos: int):
+        node = self
+        for level in topic_filter.split('/'):
+            node = node.children.setdefault(level, TopicTrie())
+        node.subscribers[session] = qos
+
+    def remove(self, topic_filter: str, session):
+        path = [self]
+        node = self
+        for level in topic_filter.split('/'):
+            node = node.children.get(level)
+            if node is None:
+                return
+            path.append(node)
+        node.subscribers.pop(session, None)
+        # prune empty branches
+        levels = topic_filter.split('/')
+        for i in range(len(levels), 0, -1):
+            child = path[i]
+            if child.subscribers or child.children:
+                break
+            del path[i - 1].children[levels[i - 1]]
+
+    def match(self, topic: str) -> dict:
+        """Return {session: max granted qos} for every filter matching topic."""
+        out = {}
+        levels = topic.split('/')
+        # wildcards never match topics starting with '$' at the first level
+        self._match(levels, 0, out, not topic.startswith('$'))
+        return out
+
+    def _match(self, levels, i, out, wildcards_ok):
+        if wildcards_ok:
+            hash_node = self.children.get('#')
+            if hash_node is not None:
+                self._collect(hash_node, out)
+        if i == len(levels):
+            self._collect(self, out)
+            return
+        child = self.children.get(levels[i])
+        if child is not None:
+            child._match(levels, i + 1, out, True)
+        if wildcards_ok:
+            plus = self.children.get('+')
+            if plus is not None:
+                plus._match(levels, i + 1, out, True)
+
+    @staticmethod
+    def _collect(node, out):
+        for session, qos in node.subscribers.items():
+            if out.get(session, -1) < qos:
+                out[session] = qos
+
+
+def filter_matches(topic_filter: str, topic: str) -> bool:
+    """Match a single topic against a single filter (used for retained messages)."""
+    f_levels = topic_filter.split('/')
+    t_levels = topic.split('/')
+    if topic.startswith('$') and f_levels[0] in ('+', '#'):
+        return False
+    for i, f in enumerate(f_levels):
+        if f == '#':
+            return True
+        if i >= len(t_levels):
+            return False
+        if f != '+' and f != t_levels[i]:
+            return False
+    return len(f_levels) == len(t_levels)
+
+
+class Session:
+    """Broker-side state for one client id; survives reconnects when clean_session is false."""
+
+    def __init__(self, client_id: str, clean: bool):
+        self.client_id = client_id
+        self.clean = clean
+        self.subscriptions = {}  # filter -> qos
+        self.writer = None
+        self.inflight = {}  # packet id -> publish packet awaiting PUBACK
+        self.pending = deque(maxlen=10000)  # QoS1 messages queued while offline
+        self.qos2_received = set()
+        self._ids = itertools.cycle(range(1, 65536))
+        self.counters = {'connects': 0, 'msgs_in': 0, 'msgs_out': 0, 'bytes_in': 0, 'bytes_out': 0}
+
+    def next_packet_id(self) -> int:
+        pid = next(self._ids)
+        while pid in self.inflight:
+            pid = next(self._ids)
+        return pid
+
+
+class MqttBroker:
+    """Minimal asyncio MQTT 3.1.1 broker: QoS 0/1 delivery, retained messages, wildcards.
+
+    Inbound QoS 2 publishes are accepted (PUBREC/PUBREL/PUBCOMP) and delivered at most at
+    QoS 1. Runs on its own event loop thread; start() returns once the listener is bound.
+    """
+
+    def __init__(self, host='127.0.0.1', port=1883):
+        self.host = host
+        self.port = port
+        self._trie = TopicTrie()
+        self._match_cache = {}
+        self._sessions = {}  # client_id -> Session
+        self._retained = {}  # topic -> (payload, qos)
+        self._topic_counters = {}  # topic -> [messages, bytes]
+        self._anon_ids = itertools.count(1)
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._ready = threading.Event()
+        self._error = None
+
+    # ------------------------------------------------------------------ lifecycle
+    def start(self, timeout=5.0):
+        def _run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            try:
+                self._server = self._loop.run_until_complete(
+                    asyncio.start_server(self._handle_client, self.host, self.port))
+            except Exception as e:
+                self._error = e
+                self._ready.set()
+                return
+            self._ready.set()
+            try:
+                self._loop.run_forever()
+            finally:
+                self._server.close()
+                for task in asyncio.all_tasks(self._loop):
+                    task.cancel()
+                self._loop.run_until_complete(asyncio.sleep(0))
+
+        self._thread = threading.Thread(target=_run, name='mqtt-broker', daemon=True)
+        self._thread.start()
+        if not self._ready.wait(timeout):
+            raise RuntimeError('MQTT broker did not start in time')
+        if self._error:
+            raise self._error
+
+    def stop(self):
+        if self._loop and self._loop.is_running():
+            self._loop.call_soon_threadsafe(self._loop.stop)
+        if self._thread:
+            self._thread.join(timeout=2)
+
+    def stats(self) -> dict:
+        """Snapshot of per-client and per-topic counters."""
+        return {
+            'clients': {cid: dict(s.counters, connected=s.writer is not None) for cid, s in list(self._sessions.items())},
+            'topics': {t: {'messages': c[0], 'bytes': c[1]} for t, c in list(self._topic_counters.items())},
+            'retained': len(self._retained),
+        }
+
+    # ------------------------------------------------------------------ connection handling
+    async def _read_packet(self, reader):
+        first = (await reader.readexactly(1))[0]
+        length = 0
+        mult = 1
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length += (byte & 0x7F) * mult
+            if not byte & 0x80:
+                break
+            mult *= 128
+            if mult > 128 ** 3:
+                raise ValueError('malformed remaining length')
+        body = await reader.readexactly(length) if length else b''
+        return first, body
+
+    async def _handle_client(self, reader, writer):
+        session = None
+        will = None
+        try:
+            first, body = await asyncio.wait_for(self._read_packet(reader), timeout=10)
+            if first >> 4 != CONNECT:
+                return
+            session, will, keepalive, session_present = self._on_connect(body, writer)
+            if session is None:
+                writer.write(_packet(CONNACK << 4, bytes([0, 2])))  # identifier rejected
+                return
+            writer.write(_packet(CONNACK << 4, bytes([1 if session_present else 0, 0])))
+            self._resume(session)
+            timeout = keepalive * 1.5 if keepalive else None
+            while True:
+                first, body = await asyncio.wait_for(self._read_packet(reader), timeout=timeout)
+                ptype = first >> 4
+                session.counters['bytes_in'] += len(body) + 2
+                if ptype == PUBLISH:
+                    await self._on_publish(session, first, body)
+                elif ptype == PUBACK:
+                    session.inflight.pop(struct.unpack('!H', body[:2])[0], None)
+                elif ptype == PUBREL:
+                    pid = struct.unpack('!H', body[:2])[0]
+                    session.qos2_received.discard(pid)
+                    self._send(session, _packet(PUBCOMP << 4, body[:2]))
+                elif ptype == SUBSCRIBE:
+                    self._on_subscribe(session, body)
+                elif ptype == UNSUBSCRIBE:
+                    self._on_unsubscribe(session, body)
+                elif ptype == PINGREQ:
+                    self._send(session, _PINGRESP)
+                elif ptype == DISCONNECT:
+                    will = None
+                    break
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError, ValueError):
+            pass
+        except asyncio.CancelledError:
+            return
+        finally:
+            if session is not None and session.writer is writer:
+                session.writer = None
+                if session.clean:
+                    self._drop_session(session)
+            try:
+                writer.close()
+            except Exception:
+                pass
+        if will is not None:
+            topic, payload, qos, retain = will
+            await self._route(topic, payload, qos, retain)
+
+    def _on_connect(self, body: bytes, writer):
+        proto, pos = _read_str(body, 0)
+        level = body[pos]
+        flags = body[pos + 1]
+        (keepalive,) = struct.unpack_from('!H', body, pos + 2)
+        pos += 4
+        client_id, pos = _read_str(body, pos)
+        clean = bool(flags & 0x02)
+        will = None
+        if flags & 0x04:
+            will_topic, pos = _read_str(body, pos)
+            (n,) = struct.unpack_from('!H', body, pos)
+            will_payload = body[pos + 2:pos + 2 + n]
+            will = (will_topic, will_payload, (flags >> 3) & 0x03, bool(flags & 0x20))
+        if proto not in ('MQTT', 'MQIsdp') or level not in (3, 4):
+            return None, None, 0, False
+        if not client_id:
+            if not clean:
+                return None, None, 0, False
+            client_id = f'anon-{next(self._anon_ids)}'
+
+        existing = self._sessions.get(client_id)
+        if existing is not None and existing.writer is not None:
+            # session takeover: the newest connection wins
+            try:
+                existing.writer.close()
+            except Exception:
+                pass
+            existing.writer = None
+        if existing is not None and clean:
+            self._drop_session(existing)
+            existing = None
+        session_present = existing is not None
+        session = existing or Session(client_id, clean)
+        session.clean = clean
+        session.writer = writer
+        session.counters['connects'] += 1
+        self._sessions[client_id] = session
+        return session, will, keepalive, session_present
+
+    def _resume(self, session: Session):
+        # redeliver unacknowledged QoS1 messages, then anything queued while offline
+        for pid, packet in list(session.inflight.items()):
+            self._send(session, bytes([packet[0] | 0x08]) + packet[1:])
+        while session.pending:
+            topic, payload = session.pending.popleft()
+            self._deliver(session, topic, payload, 1, False)
+
+    def _drop_session(self, session: Session):
+        for topic_filter in session.subscriptions:
+            self._trie.remove(topic_filter, session)
+        session.subscriptions.clear()
+        self._match_cache.clear()
+        if self._sessions.get(session.client_id) is session:
+            del self._sessions[session.client_id]
+
+    async def _on_publish(self, session: Session, first: int, body: bytes):
+        qos = (first >> 1) & 0x03
+        retain = bool(first & 0x01)
+        topic, pos = _read_str(body, 0)
+        if qos:
+            pid_bytes = body[pos:pos + 2]
+            pos += 2
+        payload = body[pos:]
+        session.counters['msgs_in'] += 1
+        if qos == 1:
+            self._send(session, _packet(PUBACK << 4, pid_bytes))
+        elif qos == 2:
+            pid = struct.unpack('!H', pid_bytes)[0]
+            self._send(session, _packet(PUBREC << 4, pid_bytes))
+            if pid in session.qos2_received:
+                return  # duplicate of a message we already routed
+            session.qos2_received.add(pid)
+        await self._route(topic, payload, qos, retain)
+
+    async def _route(self, topic: str, payload: bytes, qos: int, retain: bool):
+        counters = self._topic_counters.get(topic)
+        if counters is None:
+            counters = self._topic_counters[topic] = [0, 0]
+        counters[0] += 1
+        counters[1] += len(payload)
+        if retain:
+            if payload:
+                self._retained[topic] = (payload, qos)
+            else:
+                self._retained.pop(topic, None)
+        matches = self._match_cache.get(topic)
+        if matches is None:
+            if len(self._match_cache) > 10000:
+                self._match_cache.clear()
+            matches = self._match_cache[topic] = self._trie.match(topic)
+        slow = None
+        for sub, sub_qos in matches.items():
+            out_qos = min(qos, sub_qos, 1)
+            if sub.writer is None:
+                if out_qos and not sub.clean:
+                    sub.pending.append((topic, payload))
+                continue
+            self._deliver(sub, topic, payload, out_qos, False)
+            if sub.writer.transport.get_write_buffer_size() > _WRITE_HIGH_WATER:
+                slow = slow or []
+                slow.append(sub.writer)
+        if slow:
+            # apply backpressure to the publisher rather than buffering without bound
+            for w in slow:
+                try:
+                    await w.drain()
+                except ConnectionError:
+                    pass
+
+    def _deliver(self, session: Session, topic: str, payload: bytes, qos: int, retain: bool):
+        if qos:
+            pid = session.next_packet_id()
+            packet = _publish_packet(topic, payload, qos, retain, pid)
+            session.inflight[pid] = packet
+        else:
+            packet = _publish_packet(topic, payload, 0, retain)
+        session.counters['msgs_out'] += 1
+        self._send(session, packet)
+
+    def _send(self, session: Session, data: bytes):
+        if session.writer is None:
+            return
+        session.counters['bytes_out'] += len(data)
+        session.writer.write(data)
+
+    def _on_subscribe(self, session: Session, body: bytes):
+        pid_bytes = body[:2]
+        pos = 2
+        granted = []
+        new_filters = []
+        while pos < len(body):
+            topic_filter, pos = _read_str(body, pos)
+            qos = min(body[pos] & 0x03, 1)
+            pos += 1
+            self._trie.add(topic_filter, session, qos)
+            session.subscriptions[topic_filter] = qos
+            granted.append(qos)
+            new_filters.append((topic_filter, qos))
+        self._match_cache.clear()
+        self._send(session, _packet(SUBACK << 4, pid_bytes + bytes(granted)))
+        for topic_filter, sub_qos in new_filters:
+            for topic, (payload, qos) in list(self._retained.items()):
+                if filter_matches(topic_filter, topic):
+                    self._deliver(session, topic, payload, min(qos, sub_qos), True)
+
+    def _on_unsubscribe(self, session: Session, body: bytes):
+        pid_bytes = body[:2]
+        pos = 2
+        while pos < len(body):
+            topic_filter, pos = _read_str(body, pos)
+            self._trie.remove(topic_filter, session)
+            session.subscriptions.pop(topic_filter, None)
+        self._match_cache.clear()
+        self._send(session, _packet(UNSUBACK << 4, pid_bytes))
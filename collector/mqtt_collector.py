@@ -1,82 +1,112 @@
-import threading
-import json
-import time
-from typing import Callable
-import paho.mqtt.client as mqtt
-from storage import save_to_csv
-from gateway import process_message
-from datetime import datetime
-
-
-class MqttCollector:
-    def __init__(self, broker_host="localhost", broker_port=1883, topic="iot"):
-        self.broker_host = broker_host
-        self.broker_port = broker_port
-        self.topic = topic
-        self._client = mqtt.Client()
-        self._thread = None
-        self._stop_event = threading.Event()
-
-        # Bind callbacks
-        self._client.on_connect = self._on_connect
-        self._client.on_message = self._on_message
-
-    def _on_connect(self, client, userdata, flags, rc):
-        if rc == 0:
-            client.subscribe(self.topic)
-        else:
-            print(f"[MQTT COLLECTOR] Connection failed with rc={rc}")
-
-    def _on_message(self, client, userdata, msg):
-        try:
-            payload = msg.payload.decode("utf-8")
-            data = json.loads(payload)
-        except Exception as e:
-            print(f"[MQTT COLLECTOR] Failed to decode message: {e}")
-            return
-        # attach receive timestamp and compute latency if send_ts present
-        try:
-            recv_ts = datetime.utcnow().isoformat()
-            data["receive_ts"] = recv_ts
-            if "send_ts" in data and data.get("send_ts"):
-                try:
-                    send_dt = datetime.fromisoformat(data.get("send_ts"))
-                    recv_dt = datetime.fromisoformat(recv_ts)
-                    latency_ms = int((recv_dt - send_dt).total_seconds() * 1000)
-                    data["latency_ms"] = latency_ms
-                except Exception:
-                    data["latency_ms"] = ""
-        except Exception:
-            pass
-        # forward normalized data to gateway for persistence
-        try:
-            process_message(data)
-        except Exception as e:
-            # fallback
-            save_to_csv(data)
-
-    def start(self):
-        if self._thread and self._thread.is_alive():
-            return
-
-        def _run():
-            try:
-                self._client.connect(self.broker_host, self.broker_port)
-                # Blocking network loop; exits when stop_event is set via disconnect
-                while not self._stop_event.is_set():
-                    self._client.loop(timeout=1.0)
-            except Exception as e:
-                print(f"[MQTT COLLECTOR] Error in MQTT loop: {e}")
-
-        self._stop_event.clear()
-        self._thread = threading.Thread(target=_run, daemon=True)
-        self._thread.start()
-
-    def stop(self):
-        self._stop_event.set()
-        try:
-            self._client.disconnect()
-        except Exception:
-            pass
-        if self._thread:
-            self._thread.join(timeout=2)
+import threading
+import time
+import paho.mqtt.client as mqtt
+from gateway import process_messages
+from payload_codec import decode
+from reading import Reading
+from metrics import COLLECTOR_RECEIVED, COLLECTOR_DECODE_ERRORS
+import tracing
+import timestamps
+
+
+class MqttCollector:
+    def __init__(self, broker_host="localhost", broker_port=1883, topic="iot", qos=0, encoding="json"):
+        self.broker_host = broker_host
+        self.broker_port = broker_port
+        self.topic = topic
+        self.qos = qos
+        self.encoding = encoding
+        self._client = mqtt.Client()
+        self._thread = None
+        self._stop_event = threading.Event()
+        self._subscribed = threading.Event()
+        self._last_message = 0.0
+
+        # Bind callbacks
+        self._client.on_connect = self._on_connect
+        self._client.on_subscribe = self._on_subscribe
+        self._client.on_message = self._on_message
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            client.subscribe(self.topic, qos=self.qos)
+        else:
+            print(f"[MQTT COLLECTOR] Connection failed with rc={rc}")
+
+    def _on_subscribe(self, client, userdata, mid, granted_qos):
+        self._subscribed.set()
+
+    def wait_ready(self, timeout=5.0) -> bool:
+        """Wait until the broker acknowledged the subscription (CONNACK and SUBACK received)."""
+        return self._subscribed.wait(timeout)
+
+    def drain(self, idle=0.5, timeout=5.0):
+        """Wait until no message arrived for idle seconds (at most timeout), so in-flight publishes are persisted."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and time.monotonic() - self._last_message < idle:
+            time.sleep(0.05)
+
+    def _on_message(self, client, userdata, msg):
+        arrived_ns = time.perf_counter_ns()
+        self._last_message = time.monotonic()
+        recv_ts = timestamps.now()
+        recv_mono_ns = time.monotonic_ns()
+        try:
+            data, decode_us = decode(msg.payload, self.encoding, "MQTT")
+            # batched publishes carry a list of readings sharing device_id/protocol
+            batch = data.get("batch")
+            if isinstance(batch, list):
+                common = {"device_id": data.get("device_id", ""), "protocol": data.get("protocol", "")}
+                readings = [Reading.from_dict(item, common) for item in batch]
+            else:
+                readings = [Reading.from_dict(data)]
+        except Exception as e:
+            COLLECTOR_DECODE_ERRORS.inc("MQTT")
+            print(f"[MQTT COLLECTOR] Failed to decode message: {e}")
+            return
+        if not readings:
+            return
+        COLLECTOR_RECEIVED.inc("MQTT", amount=len(readings))
+        # codec cost per reading: the message size and decode time are shared by the batch
+        payload_bytes = round(len(msg.payload) / len(readings), 1)
+        decode_us = round(decode_us / len(readings), 2)
+        for reading in readings:
+            trace_id = reading.trace_id
+            if trace_id is not None:
+                tracing.stamp(trace_id, "received", arrived_ns)
+                tracing.stamp(trace_id, "decoded")
+            reading.encoding = self.encoding
+            reading.payload_bytes = payload_bytes
+            reading.decode_us = decode_us
+            reading.stamp_receive(recv_ts, recv_mono_ns)
+        # forward the whole batch to the gateway for normalisation and persistence
+        try:
+            process_messages(readings)
+        except Exception as e:
+            print(f"[MQTT COLLECTOR] Failed to process message: {e}")
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+
+        def _run():
+            try:
+                self._client.connect(self.broker_host, self.broker_port)
+                # Blocking network loop; exits when stop_event is set via disconnect
+                while not self._stop_event.is_set():
+                    self._client.loop(timeout=1.0)
+            except Exception as e:
+                print(f"[MQTT COLLECTOR] Error in MQTT loop: {e}")
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=_run, name='mqtt-collector', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        try:
+            self._client.disconnect()
+        except Exception:
+            pass
+        if self._thread:
+            self._thread.join(timeout=2)
@@ -0,0 +1,292 @@
+import json
+import queue
+import threading
+import time
+from collections import deque
+
+from metrics import DEVICE_MESSAGES
+
+# Aggregates are pushed to browsers as server-sent events; nothing is read back from disk.
+
+_PAGE = """<!doctype html>
+<html><head><meta charset="utf-8"><title>IoT protocol dashboard</title>
+<style>
+body{font-family:sans-serif;margin:12px;background:#f6f6f6}
+.grid{display:grid;grid-template-columns:3fr 2fr;gap:12px}
+.card{background:#fff;border-radius:6px;padding:8px 12px;box-shadow:0 1px 2px #0002}
+canvas{width:100%;height:220px}
+table{border-collapse:collapse;width:100%;font-size:13px}
+td,th{padding:2px 6px;text-align:right}td:first-child,th:first-child{text-align:left}
+#status{color:#666;font-size:12px}
+</style></head><body>
+<h2>IoT protocol dashboard <span id="status">connecting...</span></h2>
+<div class="grid">
+ <div>
+  <div class="card"><h4>Light</h4><canvas id="c-light"></canvas></div>
+  <div class="card"><h4>Humidity</h4><canvas id="c-humidity"></canvas></div>
+  <div class="card"><h4>Temperature</h4><canvas id="c-temperature"></canvas></div>
+ </div>
+ <div>
+  <div class="card"><h4>Per protocol</h4><table id="t-proto"></table></div>
+  <div class="card"><h4>Per device</h4><table id="t-dev"></table></div>
+ </div>
+</div>
+<script>
+const MAX_POINTS = __MAX_POINTS__;
+const LIMITS = {light:[0,500], humidity:[0,100], temperature:[0,50]};
+const series = {};  // sensor -> device -> [[t, v], ...]
+const colors = ['#1f77b4','#ff7f0e','#2ca02c','#d62728','#9467bd','#8c564b','#e377c2','#7f7f7f','#bcbd22','#17becf'];
+const devColor = {};
+function color(d){ if(!(d in devColor)) devColor[d] = colors[Object.keys(devColor).length % colors.length]; return devColor[d]; }
+function addPoints(points){
+  for (const [dev, sensor, t, v] of points){
+    const s = series[sensor] = series[sensor] || {};
+    const arr = s[dev] = s[dev] || [];
+    arr.push([t, v]);
+    if (arr.length > MAX_POINTS) arr.splice(0, arr.length - MAX_POINTS);
+  }
+}
+function draw(sensor){
+  const c = document.getElementById('c-' + sensor); if (!c) return;
+  const w = c.width = c.clientWidth, h = c.height = c.clientHeight, ctx = c.getContext('2d');
+  const s = series[sensor] || {}; let t0 = Infinity, t1 = -Infinity;
+  for (const arr of Object.values(s)) for (const [t] of arr){ t0 = Math.min(t0, t); t1 = Math.max(t1, t); }
+  const [lo, hi] = LIMITS[sensor] || [0, 100];
+  ctx.strokeStyle = '#ddd'; ctx.strokeRect(30, 5, w - 35, h - 25);
+  ctx.fillStyle = '#666'; ctx.font = '10px sans-serif'; ctx.fillText(hi, 2, 12); ctx.fillText(lo, 2, h - 20);
+  if (!isFinite(t0)) return;
+  const span = Math.max(t1 - t0, 1);
+  const x = t => 30 + (t - t0) / span * (w - 40), y = v => 5 + (1 - (v - lo) / (hi - lo)) * (h - 25);
+  let ly = 14;
+  for (const [dev, arr] of Object.entries(s)){
+    ctx.strokeStyle = ctx.fillStyle = color(dev); ctx.beginPath();
+    arr.forEach(([t, v], i) => i ? ctx.lineTo(x(t), y(v)) : ctx.moveTo(x(t), y(v)));
+    ctx.stroke(); ctx.fillText(dev, w - 90, ly); ly += 11;
+  }
+}
+function fmt(v, d){ return v === null || v === undefined ? '-' : Number(v).toFixed(d); }
+function tables(ev){
+  let html = '<tr><th>protocol</th><th>msg/s</th><th>p50 ms</th><th>p90 ms</th><th>p99 ms</th></tr>';
+  for (const [p, r] of Object.entries(ev.protocols))
+    html += `<tr><td>${p}</td><td>${fmt(r.rate,1)}</td><td>${fmt(r.p50,1)}</td><td>${fmt(r.p90,1)}</td><td>${fmt(r.p99,1)}</td></tr>`;
+  document.getElementById('t-proto').innerHTML = html;
+  html = '<tr><th>device</th><th>received</th><th>attempted</th><th>PDR</th></tr>';
+  for (const [d, r] of Object.entries(ev.devices).sort())
+    html += `<tr><td style="color:${color(d)}">${d}</td><td>${r.received}</td><td>${r.attempted}</td><td>${fmt(r.pdr,3)}</td></tr>`;
+  document.getElementById('t-dev').innerHTML = html;
+}
+let pending = false;
+function render(){ pending = false; for (const s of Object.keys(LIMITS)) draw(s); }
+const es = new EventSource('/events');
+es.onmessage = m => {
+  const ev = JSON.parse(m.data);
+  addPoints(ev.points); tables(ev);
+  document.getElementById('status').textContent = 'updated ' + new Date().toLocaleTimeString();
+  if (!pending){ pending = true; requestAnimationFrame(render); }
+};
+es.onerror = () => { document.getElementById('status').textContent = 'disconnected, retrying...'; };
+</script></body></html>
+"""
+
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    idx = min(len(sorted_values) - 1, int(q * len(sorted_values)))
+    return sorted_values[idx]
+
+
+class DashboardStream:
+    """Incremental aggregates for the browser dashboard.
+
+    It is a gateway sink: write() is called on the gateway path with each batch of records and
+    only appends to a deque (push() does the same for one record); a publisher thread
+    drains it every refresh_ms, updates recent points per device/sensor, per-device PDR,
+    per-protocol rates and latency percentiles, and sends the delta to every subscriber.
+    """
+
+    def __init__(self, refresh_ms: int = 500, max_points: int = 50, latency_window: int = 2000):
+        self.refresh_ms = refresh_ms
+        self.max_points = max_points
+        self._incoming = deque()
+        self._points = {}  # (device_id, sensor_type) -> deque of [t_ms, value]
+        self._received = {}  # device_id -> count
+        self._protocol_of = {}  # device_id -> protocol
+        self._latency = {}  # protocol -> deque of recent latency_ms
+        self._latency_window = latency_window
+        self._rate_counts = {}  # protocol -> readings in the last interval
+        self._subscribers = []
+        self._sub_lock = threading.Lock()
+        self._last_event = None
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._server = None  # HTTP server from start_dashboard, shut down by close()
+
+    name = "dashboard"
+
+    def push(self, record):
+        self._incoming.append((time.time(), record))
+
+    def write(self, batch: list):
+        now = time.time()
+        self._incoming.extend((now, record) for record in batch)
+
+    def close(self):
+        self.stop()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def subscribe(self) -> queue.Queue:
+        q = queue.Queue(maxsize=20)
+        with self._sub_lock:
+            self._subscribers.append(q)
+        # new clients start from the full recent window, later events are deltas
+        q.put_nowait(self._snapshot_event())
+        return q
+
+    def unsubscribe(self, q: queue.Queue):
+        with self._sub_lock:
+            if q in self._subscribers:
+                self._subscribers.remove(q)
+
+    def _snapshot_event(self) -> str:
+        points = [[dev, sensor, t, v] for (dev, sensor), pts in list(self._points.items()) for t, v in list(pts)]
+        summary = self._last_event or {"protocols": {}, "devices": {}}
+        return json.dumps({**summary, "points": points})
+
+    def _drain(self) -> list:
+        new_points = []
+        while True:
+            try:
+                ts, rec = self._incoming.popleft()
+            except IndexError:
+                break
+            dev = rec.device_id
+            proto = rec.protocol
+            self._received[dev] = self._received.get(dev, 0) + 1
+            self._protocol_of[dev] = proto
+            self._rate_counts[proto] = self._rate_counts.get(proto, 0) + 1
+            value = rec.value
+            if value is not None:
+                key = (dev, rec.sensor_type.lower())
+                pts = self._points.get(key)
+                if pts is None:
+                    pts = self._points[key] = deque(maxlen=self.max_points)
+                point = [int(ts * 1000), value]
+                pts.append(point)
+                new_points.append([key[0], key[1]] + point)
+            latency = rec.latency_ms
+            if latency is not None:
+                lat = self._latency.get(proto)
+                if lat is None:
+                    lat = self._latency[proto] = deque(maxlen=self._latency_window)
+                lat.append(latency)
+        return new_points
+
+    def _summary(self, interval_s: float) -> dict:
+        attempted = {}
+        for (dev, _proto, outcome), n in DEVICE_MESSAGES.values().items():
+            if outcome in ("sent", "dropped"):
+                attempted[dev] = attempted.get(dev, 0) + n
+        devices = {}
+        for dev in set(self._received) | set(attempted):
+            rec = self._received.get(dev, 0)
+            att = attempted.get(dev, 0)
+            devices[dev] = {"received": rec, "attempted": att, "pdr": (rec / att) if att else None}
+        protocols = {}
+        for proto in set(self._rate_counts) | set(self._latency):
+            lat = sorted(self._latency.get(proto, ()))
+            protocols[proto] = {
+                "rate": self._rate_counts.get(proto, 0) / interval_s,
+                "p50": _percentile(lat, 0.50),
+                "p90": _percentile(lat, 0.90),
+                "p99": _percentile(lat, 0.99),
+            }
+        self._rate_counts = {p: 0 for p in self._rate_counts}
+        return {"protocols": protocols, "devices": devices}
+
+    def _run(self):
+        last = time.monotonic()
+        while not self._stop_event.wait(self.refresh_ms / 1000.0):
+            now = time.monotonic()
+            points = self._drain()
+            self._last_event = self._summary(max(now - last, 1e-3))
+            last = now
+            with self._sub_lock:
+                subscribers = list(self._subscribers)
+            if not subscribers:
+                continue
+            event = json.dumps({**self._last_event, "points": points})
+            for q in subscribers:
+                try:
+                    q.put_nowait(event)
+                except queue.Full:
+                    # slow client: drop this delta rather than stall the publisher
+                    pass
+
+    def start(self):
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="dashboard-publisher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout=2)
+
+
+def create_app(stream: DashboardStream):
+    from flask import Flask, Response
+
+    app = Flask("iot-dashboard")
+
+    @app.route("/")
+    def _index():
+        return _PAGE.replace("__MAX_POINTS__", str(stream.max_points))
+
+    @app.route("/events")
+    def _events():
+        q = stream.subscribe()
+
+        def _gen():
+            try:
+                while True:
+                    try:
+                        data = q.get(timeout=15)
+                        yield f"data: {data}\n\n"
+                    except queue.Empty:
+                        yield ": keep-alive\n\n"
+            finally:
+                stream.unsubscribe(q)
+
+        return Response(_gen(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+    return app
+
+
+def start_dashboard(host: str = "127.0.0.1", port: int = 8050, refresh_ms: int = 500, max_points: int = 50):
+    """Start the aggregator and serve the dashboard from a background thread.
+
+    Returns the DashboardStream; register it with gateway.add_sink to feed it. Its close()
+    (called by gateway.close()) stops the publisher and shuts the HTTP server down.
+    """
+    from werkzeug.serving import make_server, WSGIRequestHandler
+
+    class _QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    stream = DashboardStream(refresh_ms=refresh_ms, max_points=max_points)
+    # bind first: if the port is taken nothing has been started yet
+    try:
+        server = make_server(host, port, create_app(stream), threaded=True, request_handler=_QuietHandler)
+    except SystemExit:
+        # werkzeug reports a port in use and calls sys.exit instead of raising
+        raise RuntimeError(f"Dashboard could not bind {host}:{port}")
+    stream._server = server
+    t = threading.Thread(target=server.serve_forever, name="dashboard-http", daemon=True)
+    t.start()
+    stream.start()
+    return stream
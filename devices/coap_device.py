@@ -1,61 +1,94 @@
 import asyncio
-import json
 import random
 import threading
-from datetime import datetime
+import time
 
 import aiocoap
 from storage import log_sent
+import timestamps
+from payload_codec import encode, CONTENT_FORMATS
+from reading import Reading
+from metrics import DEVICE_MESSAGES
+import tracing
 from faults import should_drop, get_network_delay, is_device_failed, maybe_fail
 
 
-async def _coap_send_once(protocol, uri: str, payload: dict):
-    request = aiocoap.Message(code=aiocoap.POST, uri=uri, payload=json.dumps(payload).encode('utf-8'))
+async def _coap_send_once(protocol, uri: str, payload: bytes, encoding: str = 'json', trace_id=None):
+    request = aiocoap.Message(code=aiocoap.POST, uri=uri, payload=payload, content_format=CONTENT_FORMATS[encoding])
     try:
-        await protocol.request(request).response
+        pending = protocol.request(request)
+        # stamped once the request is issued, like the MQTT device after publish()
+        tracing.stamp(trace_id, 'published')
+        await pending.response
     except Exception:
         pass
 
 
-def start_coap_device_loop(uri: str, device_id: str, sensor_files: dict, interval=5):
+async def _pause(stop_event: threading.Event, seconds: float):
+    # asyncio.sleep in short steps so stop() takes effect within 0.1 s
+    end = time.monotonic() + seconds
+    while not stop_event.is_set():
+        left = end - time.monotonic()
+        if left <= 0:
+            return
+        await asyncio.sleep(min(left, 0.1))
+
+
+class CoapDeviceThread(threading.Thread):
+    """Thread running one simulated CoAP device's event loop; stop() ends it after the current request."""
+
+    def __init__(self, target, device_id: str, stop_event: threading.Event):
+        super().__init__(target=target, name=f'coap-device-{device_id}', daemon=True)
+        self._stop_event = stop_event
+
+    def stop(self):
+        self._stop_event.set()
+
+
+def start_coap_device_loop(uri: str, device_id: str, sensor_files: dict, interval=5, encoding: str = 'json'):
+    stop_event = threading.Event()
+
     async def _loop():
         protocol = await aiocoap.Context.create_client_context()
+        seq = 0
         try:
-            while True:
-                value = str(random.uniform(10.0, 30.0))
+            while not stop_event.is_set():
+                value = random.uniform(10.0, 30.0)
                 maybe_fail(device_id)
                 if is_device_failed(device_id):
-                    await asyncio.sleep(interval)
+                    DEVICE_MESSAGES.inc(device_id, 'COAP', 'failed')
+                    await _pause(stop_event, interval)
                     continue
+                # dropped readings still take a sequence number so the gateway sees the gap
+                reading_seq = seq
+                seq += 1
                 if should_drop():
+                    DEVICE_MESSAGES.inc(device_id, 'COAP', 'dropped')
                     # log attempted send
                     try:
-                        log_sent({'device_id': device_id, 'send_ts': datetime.utcnow().isoformat(), 'protocol': 'COAP'})
+                        log_sent({'device_id': device_id, 'send_ts': timestamps.now(), 'protocol': 'COAP', 'seq': reading_seq})
                     except Exception:
                         pass
-                    await asyncio.sleep(interval)
+                    await _pause(stop_event, interval)
                     continue
-                from datetime import datetime as _dt
-                now = _dt.utcnow()
-                payload = {
-                    'device_id': device_id,
-                    'protocol': 'COAP',
-                    'sensor_type': 'temperature',
-                    'value': value,
-                    'time': now.strftime('%H:%M:%S'),
-                    'date': now.strftime('%Y-%m-%d')
-                }
-                send_ts = datetime.utcnow().isoformat()
-                payload['send_ts'] = send_ts
+                now = timestamps.utc_now()
+                reading = Reading(device_id=device_id, time=now.strftime('%H:%M:%S'), date=now.strftime('%Y-%m-%d'),
+                                  protocol='COAP', sensor_type='temperature', value=value, seq=reading_seq)
+                reading.stamp_send()
+                trace_id = reading.trace_id = tracing.start(device_id, 'COAP')
+                data, encode_us = encode(reading.to_payload(), encoding, 'COAP')
+                DEVICE_MESSAGES.inc(device_id, 'COAP', 'sent')
                 try:
-                    log_sent({'device_id': device_id, 'send_ts': send_ts, 'protocol': 'COAP'})
+                    log_sent({'device_id': device_id, 'send_ts': reading.send_ts, 'protocol': 'COAP', 'seq': reading_seq,
+                              'payload_bytes': len(data), 'encode_us': round(encode_us, 2)})
                 except Exception:
                     pass
                 delay = get_network_delay()
                 if delay and delay > 0:
                     await asyncio.sleep(delay)
-                await _coap_send_once(protocol, uri, payload)
-                await asyncio.sleep(interval)
+                tracing.stamp(trace_id, 'fault_delayed')
+                await _coap_send_once(protocol, uri, data, encoding, trace_id)
+                await _pause(stop_event, interval)
         finally:
             try:
                 await protocol.shutdown()
@@ -67,6 +100,6 @@ def start_coap_device_loop(uri: str, device_id: str, sensor_files: dict, interva
         asyncio.set_event_loop(loop)
         loop.run_until_complete(_loop())
 
-    t = threading.Thread(target=_runner, daemon=True)
+    t = CoapDeviceThread(_runner, device_id, stop_event)
     t.start()
     return t
@@ -1,20 +1,40 @@
 import threading
-import time
 import random
-from pymodbus.server.sync import StartTcpServer
+from pymodbus.server.sync import ModbusTcpServer
 from pymodbus.device import ModbusDeviceIdentification
 from pymodbus.datastore import ModbusSequentialDataBlock, ModbusSlaveContext, ModbusServerContext
 from pymodbus.transaction import ModbusRtuFramer, ModbusSocketFramer
 
 
+# Holding register layout: 0 = temperature * 100, 1-2 = sequence number of the sample (high, low word)
+SEQ_REGISTER = 1
+
+
 class ModbusDeviceThread(threading.Thread):
+    """Simulated Modbus TCP device: a server thread answers polls while this thread updates the registers.
+
+    wait_ready() returns once the server socket is bound; after stop() the thread shuts the
+    server down and releases the port (join() to wait for it).
+    """
+
     def __init__(self, host='127.0.0.1', port=1502, unit_id=1, update_interval=5):
-        super().__init__(daemon=True)
+        super().__init__(name=f'modbus-device-{port}', daemon=True)
         self.host = host
         self.port = port
         self.unit_id = unit_id
         self.update_interval = update_interval
         self._stop_event = threading.Event()
+        self._ready = threading.Event()
+        self._server = None
+        self._error = None
+
+    def wait_ready(self, timeout=5.0) -> bool:
+        """Wait until the server listens; raises RuntimeError if it failed to bind."""
+        if not self._ready.wait(timeout):
+            return False
+        if self._error:
+            raise RuntimeError(f'Modbus device on port {self.port} failed to start: {self._error}')
+        return True
 
     def stop(self):
         self._stop_event.set()
@@ -31,24 +51,31 @@ class ModbusDeviceThread(threading.Thread):
         identity.ProductCode = 'SD'
         identity.VendorUrl = 'http://example.com'
 
-        # Start server in a background thread via StartTcpServer which blocks; we instead periodically update registers
-        # Approach: run StartTcpServer in its own thread and in this thread update the store.
-
-        def _server_thread():
-            StartTcpServer(context, identity=identity, address=(self.host, self.port))
-
-        t = threading.Thread(target=_server_thread, daemon=True)
-        t.start()
+        # The server binds in its constructor and serves in its own thread; this thread updates the store.
+        try:
+            self._server = ModbusTcpServer(context, identity=identity, address=(self.host, self.port),
+                                           allow_reuse_address=True)
+        except Exception as e:
+            self._error = e
+            self._ready.set()
+            return
+        threading.Thread(target=self._server.serve_forever, name=f'modbus-server-{self.port}', daemon=True).start()
+        self._ready.set()
 
+        seq = 0
         try:
             while not self._stop_event.is_set():
                 # update register 0 with a random temperature-like value scaled as integer
                 temp = int(random.uniform(2000, 3000))  # e.g. scaled by 100
-                with context[0].store.lock:
-                    context[0].setValues(3, 0, [temp])
-                time.sleep(self.update_interval)
+                # one setValues call so a poll never sees the value and sequence number of different samples
+                context[0].setValues(3, 0, [temp, (seq >> 16) & 0xFFFF, seq & 0xFFFF])
+                seq += 1
+                self._stop_event.wait(self.update_interval)
         except Exception:
             pass
+        finally:
+            self._server.shutdown()
+            self._server.server_close()
 
 
 def start_modbus_device_thread(host='127.0.0.1', port=1502, unit_id=1, update_interval=5):
@@ -1,109 +1,220 @@
-import threading
-import time
-import random
-import csv
-import json
-from datetime import datetime
-from storage import log_sent
-from faults import should_drop, get_network_delay, is_device_failed, maybe_fail
-from pathlib import Path
-import paho.mqtt.client as mqtt
-
-
-class MqttDeviceThread(threading.Thread):
-    def __init__(self, device_id: str, sensor_files: dict, broker_host: str, topic: str, fixed_interval: int | None = None, broker_port: int = 1883):
-        super().__init__(daemon=True)
-        self.device_id = device_id
-        self.sensor_files = sensor_files
-        self.broker_host = broker_host
-        self.broker_port = broker_port
-        self.topic = topic
-        self.fixed_interval = fixed_interval
-        self._stop_event = threading.Event()
-        self._client = mqtt.Client()
-
-    def stop(self):
-        self._stop_event.set()
-
-    def join(self, timeout=None):
-        self._stop_event.set()
-        super().join(timeout)
-
-    def _pick_random_reading(self):
-        sensor_type = random.choice(list(self.sensor_files.keys()))
-        path = self.sensor_files[sensor_type]
-        if not Path(path).exists():
-            return None
-        with open(path, "r", encoding="utf-8") as fh:
-            reader = list(csv.reader(fh))
-            if len(reader) <= 1:
-                return None
-            row = random.choice(reader[1:])
-            if len(row) < 3:
-                return None
-            return {"time": row[0], "date": row[1], "sensor_type": sensor_type, "value": row[2]}
-
-    def run(self):
-        try:
-            self._client.connect(self.broker_host, self.broker_port)
-        except Exception as e:
-            print(f"[MQTT DEVICE {self.device_id}] Failed to connect to broker: {e}")
-            return
-
-        while not self._stop_event.is_set():
-            reading = self._pick_random_reading()
-            if reading:
-                payload = {
-                    "device_id": self.device_id,
-                    "time": reading["time"],
-                    "date": reading["date"],
-                    "protocol": "MQTT",
-                    "sensor_type": reading["sensor_type"],
-                    "value": reading["value"],
-                }
-                try:
-                    # simulate device failure
-                    maybe_fail(self.device_id)
-                    if is_device_failed(self.device_id):
-                        # device is down for now; skip
-                        continue
-                    # simulate packet loss
-                    if should_drop():
-                        # log attempted send but drop the packet
-                        send_ts = datetime.utcnow().isoformat()
-                        try:
-                            log_sent({"device_id": self.device_id, "send_ts": send_ts, "protocol": "MQTT"})
-                        except Exception:
-                            pass
-                        continue
-                    # attach send timestamp (ISO format) for latency measurement
-                    send_ts = datetime.utcnow().isoformat()
-                    payload["send_ts"] = send_ts
-                    # log the attempted send for PDR calculation
-                    try:
-                        log_sent({"device_id": self.device_id, "send_ts": send_ts, "protocol": "MQTT"})
-                    except Exception:
-                        # non-fatal if logging fails
-                        pass
-                    # apply network delay
-                    delay = get_network_delay()
-                    if delay and delay > 0:
-                        time.sleep(delay)
-                    self._client.publish(self.topic, json.dumps(payload))
-                except Exception as e:
-                    print(f"[MQTT DEVICE {self.device_id}] Publish error: {e}")
-
-            if self.fixed_interval and self.fixed_interval > 0:
-                sleep_for = self.fixed_interval
-            else:
-                sleep_for = random.randint(4, 10)
-            for _ in range(int(sleep_for * 10)):
-                if self._stop_event.is_set():
-                    break
-                time.sleep(0.1)
-
-
-def start_mqtt_device_thread(device_id: str, sensor_files: dict, broker_host: str, topic: str, fixed_interval: int | None = None, broker_port: int = 1883):
-    t = MqttDeviceThread(device_id=device_id, sensor_files=sensor_files, broker_host=broker_host, topic=topic, fixed_interval=fixed_interval, broker_port=broker_port)
-    t.start()
-    return t
+import threading
+import time
+import random
+import csv
+from storage import log_sent
+import timestamps
+from payload_codec import encode
+from reading import Reading
+from metrics import DEVICE_MESSAGES
+import tracing
+from faults import should_drop, get_network_delay, is_device_failed, maybe_fail
+from pathlib import Path
+import paho.mqtt.client as mqtt
+
+
+class MqttDeviceThread(threading.Thread):
+    """Simulated MQTT sensor.
+
+    qos selects the MQTT delivery guarantee (0/1/2). With batch_size > 1 or batch_ms > 0,
+    readings are buffered and published together once batch_size readings are pending or
+    the oldest one is batch_ms old; each reading keeps its own send_ts so the collector can
+    attribute latency (including the time spent waiting in the batch) per reading.
+    max_inflight bounds unacknowledged QoS 1/2 messages handled by the paho network loop.
+    encoding picks the payload codec (see payload_codec.ENCODINGS). Every reading, including
+    ones dropped by fault injection, takes the next sequence number.
+    """
+
+    def __init__(self, device_id: str, sensor_files: dict, broker_host: str, topic: str, fixed_interval: int | None = None, broker_port: int = 1883,
+                 qos: int = 0, batch_size: int = 1, batch_ms: int = 0, max_inflight: int = 20, encoding: str = "json"):
+        super().__init__(name=f"mqtt-device-{device_id}", daemon=True)
+        self.device_id = device_id
+        self.sensor_files = sensor_files
+        self.broker_host = broker_host
+        self.broker_port = broker_port
+        self.topic = topic
+        self.fixed_interval = fixed_interval
+        self.qos = qos
+        self.batch_size = max(1, int(batch_size))
+        self.batch_ms = batch_ms
+        self.encoding = encoding
+        self._stop_event = threading.Event()
+        self._pending = []  # readings waiting to be published as one batch
+        self._batch_started = 0.0
+        self._seq = 0
+        self._last_publish = None  # MQTTMessageInfo of the latest publish, waited for on stop
+        # keep the session across reconnects so unacknowledged QoS 1/2 messages are retried
+        self._client = mqtt.Client(client_id=device_id, clean_session=(qos == 0))
+        self._client.max_inflight_messages_set(max_inflight)
+        self._client.max_queued_messages_set(max_inflight * 50)
+
+    def stop(self):
+        self._stop_event.set()
+
+    def join(self, timeout=None):
+        self._stop_event.set()
+        super().join(timeout)
+
+    def connected(self) -> bool:
+        return self._client.is_connected()
+
+    def _pick_random_reading(self):
+        sensor_type = random.choice(list(self.sensor_files.keys()))
+        path = self.sensor_files[sensor_type]
+        if not Path(path).exists():
+            return None
+        with open(path, "r", encoding="utf-8") as fh:
+            reader = list(csv.reader(fh))
+            if len(reader) <= 1:
+                return None
+            row = random.choice(reader[1:])
+            if len(row) < 3:
+                return None
+            return {"time": row[0], "date": row[1], "sensor_type": sensor_type, "value": row[2]}
+
+    def _batching(self) -> bool:
+        return self.batch_size > 1 or self.batch_ms > 0
+
+    def _publish(self, readings: list):
+        if len(readings) == 1 and not self._batching():
+            body = readings[0].to_payload()
+        else:
+            body = {"device_id": self.device_id, "protocol": "MQTT",
+                    "batch": [r.to_payload(batch_item=True) for r in readings]}
+        trace_ids = [r.trace_id for r in readings if r.trace_id is not None]
+        data, encode_us = encode(body, self.encoding, "MQTT")
+        # the sent log records every attempt (PDR denominator), whether or not the client accepts
+        # the publish; the "sent" metric below only counts accepted publishes
+        share = len(data) / len(readings)
+        for r in readings:
+            try:
+                log_sent({"device_id": self.device_id, "send_ts": r.send_ts, "protocol": "MQTT", "seq": r.seq,
+                          "payload_bytes": round(share, 1), "encode_us": round(encode_us / len(readings), 2)})
+            except Exception:
+                # non-fatal if logging fails
+                pass
+        # apply network delay
+        delay = get_network_delay()
+        if delay and delay > 0:
+            time.sleep(delay)
+        for trace_id in trace_ids:
+            tracing.stamp(trace_id, "fault_delayed")
+        try:
+            info = self._client.publish(self.topic, data, qos=self.qos)
+        except Exception:
+            DEVICE_MESSAGES.inc(self.device_id, "MQTT", "failed", amount=len(readings))
+            raise
+        # QoS 1/2 publishes made while disconnected stay queued and are sent after reconnecting
+        accepted = info.rc == mqtt.MQTT_ERR_SUCCESS or (info.rc == mqtt.MQTT_ERR_NO_CONN and self.qos > 0)
+        if not accepted:
+            DEVICE_MESSAGES.inc(self.device_id, "MQTT", "failed", amount=len(readings))
+            if info.rc == mqtt.MQTT_ERR_QUEUE_SIZE:
+                print(f"[MQTT DEVICE {self.device_id}] In-flight queue full, message dropped")
+            else:
+                print(f"[MQTT DEVICE {self.device_id}] Publish rejected: {mqtt.error_string(info.rc)}")
+            return
+        DEVICE_MESSAGES.inc(self.device_id, "MQTT", "sent", amount=len(readings))
+        self._last_publish = info
+        for trace_id in trace_ids:
+            tracing.stamp(trace_id, "published")
+
+    def _flush(self):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        # ends the batch wait, so the injected delay is traced on its own
+        for r in batch:
+            tracing.stamp(r.trace_id, "flushed")
+        try:
+            self._publish(batch)
+        except Exception as e:
+            print(f"[MQTT DEVICE {self.device_id}] Publish error: {e}")
+
+    def _batch_due(self) -> bool:
+        if not self._pending:
+            return False
+        if len(self._pending) >= self.batch_size:
+            return True
+        return self.batch_ms > 0 and (time.monotonic() - self._batch_started) * 1000 >= self.batch_ms
+
+    def run(self):
+        try:
+            self._client.connect(self.broker_host, self.broker_port)
+        except Exception as e:
+            print(f"[MQTT DEVICE {self.device_id}] Failed to connect to broker: {e}")
+            return
+        # background network loop handles acks, retries and reconnects for QoS 1/2
+        self._client.loop_start()
+
+        try:
+            self._produce()
+        finally:
+            self._flush()
+            # let the network loop deliver (and for QoS 1/2 get acknowledged) what is still queued
+            if self._last_publish is not None:
+                try:
+                    self._last_publish.wait_for_publish(timeout=2)
+                except Exception:
+                    pass
+            self._client.loop_stop()
+            try:
+                self._client.disconnect()
+            except Exception:
+                pass
+
+    def _produce(self):
+        while not self._stop_event.is_set():
+            picked = self._pick_random_reading()
+            if picked:
+                reading = Reading(device_id=self.device_id, time=picked["time"], date=picked["date"], protocol="MQTT",
+                                  sensor_type=picked["sensor_type"], value=float(picked["value"]))
+                try:
+                    # simulate device failure
+                    maybe_fail(self.device_id)
+                    if is_device_failed(self.device_id):
+                        # device is down for now; skip
+                        DEVICE_MESSAGES.inc(self.device_id, "MQTT", "failed")
+                        continue
+                    reading.seq = self._seq
+                    self._seq += 1
+                    # simulate packet loss
+                    if should_drop():
+                        DEVICE_MESSAGES.inc(self.device_id, "MQTT", "dropped")
+                        # log attempted send but drop the packet
+                        try:
+                            log_sent({"device_id": self.device_id, "send_ts": timestamps.now(), "protocol": "MQTT", "seq": reading.seq})
+                        except Exception:
+                            pass
+                        continue
+                    # attach send timestamp (see timestamps.MODE) for latency measurement
+                    reading.stamp_send()
+                    reading.trace_id = tracing.start(self.device_id, "MQTT")
+                    if self._batching():
+                        if not self._pending:
+                            self._batch_started = time.monotonic()
+                        self._pending.append(reading)
+                        if self._batch_due():
+                            self._flush()
+                    else:
+                        self._publish([reading])
+                except Exception as e:
+                    print(f"[MQTT DEVICE {self.device_id}] Publish error: {e}")
+
+            if self.fixed_interval and self.fixed_interval > 0:
+                sleep_for = self.fixed_interval
+            else:
+                sleep_for = random.randint(4, 10)
+            for _ in range(int(sleep_for * 10)):
+                if self._stop_event.is_set():
+                    break
+                if self._batch_due():
+                    self._flush()
+                time.sleep(0.1)
+
+
+def start_mqtt_device_thread(device_id: str, sensor_files: dict, broker_host: str, topic: str, fixed_interval: int | None = None, broker_port: int = 1883,
+                             qos: int = 0, batch_size: int = 1, batch_ms: int = 0, max_inflight: int = 20, encoding: str = "json"):
+    t = MqttDeviceThread(device_id=device_id, sensor_files=sensor_files, broker_host=broker_host, topic=topic, fixed_interval=fixed_interval, broker_port=broker_port,
+                         qos=qos, batch_size=batch_size, batch_ms=batch_ms, max_inflight=max_inflight, encoding=encoding)
+    t.start()
+    return t
@@ -1,84 +1,164 @@
-import subprocess
-import time
-import json
-from pathlib import Path
-import pandas as pd
-
-
-def _write_config(overrides: dict):
-    cfg_path = Path('config.json')
-    with cfg_path.open('r', encoding='utf-8') as f:
-        cfg = json.load(f)
-    cfg.update(overrides)
-    with cfg_path.open('w', encoding='utf-8') as f:
-        json.dump(cfg, f, indent=4)
-
-
-def _compute_metrics(sent_path='sent_messages.csv', rec_path='all_devices_recorded_data.csv'):
-    sent = pd.read_csv(sent_path) if Path(sent_path).exists() else pd.DataFrame(columns=['device_id','send_ts','protocol'])
-    rec = pd.read_csv(rec_path) if Path(rec_path).exists() else pd.DataFrame()
-    protocols = sorted(sent['protocol'].unique()) if not sent.empty else []
-    results = []
-    for proto in protocols:
-        sent_count = int((sent[sent['protocol'] == proto]).shape[0])
-        if not rec.empty:
-            rec_proto = rec[rec['protocol'] == proto]
-            rec_count = int(rec_proto.shape[0])
-            if 'latency_ms' in rec_proto.columns:
-                lat = pd.to_numeric(rec_proto['latency_ms'], errors='coerce').dropna()
-                avg_latency = float(lat.mean()) if not lat.empty else None
-            else:
-                avg_latency = None
-        else:
-            rec_count = 0
-            avg_latency = None
-        pdr = rec_count / sent_count if sent_count > 0 else None
-        results.append({'protocol': proto, 'sent': sent_count, 'received': rec_count, 'pdr': pdr, 'avg_latency_ms': avg_latency})
-    return results
-
-
-def run_sweep(loss_rates, fail_probs, run_seconds=12, output_csv='experiments_results.csv'):
-    out_rows = []
-    base_cfg_path = Path('config.json')
-    if not base_cfg_path.exists():
-        raise FileNotFoundError('config.json missing')
-
-    for loss in loss_rates:
-        for fail in fail_probs:
-            print(f'Running experiment loss={loss} fail={fail}')
-            # reset logs
-            for p in ['all_devices_recorded_data.csv', 'sent_messages.csv']:
-                try:
-                    Path(p).unlink()
-                except Exception:
-                    pass
-            # write config overrides
-            _write_config({'loss_rate': loss, 'fail_prob': fail})
-            # start demo
-            proc = subprocess.Popen(["python", "run_demo.py"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            try:
-                time.sleep(run_seconds)
-            finally:
-                # terminate process
-                proc.terminate()
-                try:
-                    proc.wait(timeout=3)
-                except Exception:
-                    proc.kill()
-            # compute metrics
-            metrics = _compute_metrics()
-            for m in metrics:
-                row = {'loss_rate': loss, 'fail_prob': fail, **m}
-                out_rows.append(row)
-            # small pause
-            time.sleep(1)
-
-    if out_rows:
-        df = pd.DataFrame(out_rows)
-        df.to_csv(output_csv, index=False)
-    return out_rows
-
-
-if __name__ == '__main__':
-    # quick demo sweep
-    run_sweep([0.0, 0.1], [0.0, 0.05], run_seconds=12)
+import subprocess
+import time
+import json
+from pathlib import Path
+import pandas as pd
+from rollups import rollup_path
+from segments import read_manifest, segment_paths
+
+
+def _write_config(overrides: dict):
+    cfg_path = Path('config.json')
+    with cfg_path.open('r', encoding='utf-8') as f:
+        cfg = json.load(f)
+    cfg.update(overrides)
+    with cfg_path.open('w', encoding='utf-8') as f:
+        json.dump(cfg, f, indent=4)
+
+
+def _read_log(path, **kwargs):
+    # segmented logs (storage_segment_*) are read through their manifest; .gz segments included
+    if read_manifest(path):
+        frames = [pd.read_csv(p) for p in segment_paths(path) if Path(p).exists()]
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(**kwargs)
+    return pd.read_csv(path) if Path(path).exists() else pd.DataFrame(**kwargs)
+
+
+def seq_device_counts(rec, sent=None):
+    """Per-device expected, received and duplicate counts from sequence numbers.
+
+    Devices number readings from 0, so at least max(seq) + 1 were attempted; duplicates count once.
+    Readings lost after a device's last delivered one only show up in the sent log, so when it is
+    available each device expects max(attempts logged, max(seq) + 1), including devices that
+    delivered nothing. Without it the figure is a lower bound on loss. Returns None when rec has
+    no sequence numbers. Also used by the PDR cell in visualiser.ipynb.
+    """
+    if 'seq' not in rec.columns:
+        return None
+    seq = rec.assign(seq=pd.to_numeric(rec['seq'], errors='coerce')).dropna(subset=['seq'])
+    if seq.empty:
+        return None
+    per_device = seq.groupby('device_id')['seq'].agg(['max', 'nunique', 'size'])
+    counts = pd.DataFrame({'expected': per_device['max'] + 1, 'received': per_device['nunique'],
+                           'duplicates': per_device['size'] - per_device['nunique']})
+    if sent is not None and not sent.empty:
+        attempts = sent.groupby('device_id').size()
+        counts = counts.reindex(counts.index.union(attempts.index), fill_value=0)
+        counts['expected'] = pd.concat([counts['expected'], attempts], axis=1).max(axis=1)
+    return counts.astype(int)
+
+
+def _seq_counts(rec_proto, sent_proto=None):
+    counts = seq_device_counts(rec_proto, sent_proto)
+    if counts is None:
+        return None
+    return int(counts['expected'].sum()), int(counts['received'].sum()), int(counts['duplicates'].sum())
+
+
+def _compute_metrics(sent_path='sent_messages.csv', rec_path='all_devices_recorded_data.csv'):
+    sent = _read_log(sent_path, columns=['device_id','send_ts','protocol'])
+    rec = _read_log(rec_path)
+    if 'seq' in rec.columns:
+        rec['seq'] = pd.to_numeric(rec['seq'], errors='coerce')
+    protocols = set(sent['protocol'].unique()) if not sent.empty else set()
+    if not rec.empty:
+        protocols |= set(rec['protocol'].dropna().unique())
+    results = []
+    for proto in sorted(protocols):
+        sent_proto = sent[sent['protocol'] == proto]
+        sent_count = int(sent_proto.shape[0])
+        duplicates = None
+        if not rec.empty:
+            rec_proto = rec[rec['protocol'] == proto]
+            rec_count = int(rec_proto.shape[0])
+            counts = _seq_counts(rec_proto, sent_proto) if 'seq' in rec_proto.columns else None
+            if counts is not None:
+                # PDR from sequence numbers, with the sent log covering losses after the last delivery
+                sent_count, rec_count, duplicates = counts
+            if 'latency_ms' in rec_proto.columns:
+                lat = pd.to_numeric(rec_proto['latency_ms'], errors='coerce').dropna()
+                avg_latency = float(lat.mean()) if not lat.empty else None
+            else:
+                avg_latency = None
+        else:
+            rec_count = 0
+            avg_latency = None
+        pdr = rec_count / sent_count if sent_count > 0 else None
+        results.append({'protocol': proto, 'sent': sent_count, 'received': rec_count, 'pdr': pdr,
+                        'duplicates': duplicates, 'avg_latency_ms': avg_latency})
+    return results
+
+
+def _rollup_timeline(resolution=10, directory='rollups'):
+    # per-protocol history from the gateway rollups instead of re-grouping the raw CSV
+    path = rollup_path(resolution, directory)
+    if not path.exists():
+        return pd.DataFrame()
+    roll = pd.read_csv(path)
+    if roll.empty:
+        return roll
+    # weight window means by the readings that had a latency, not by all readings
+    roll['latency_weight'] = roll['latency_mean_ms'].fillna(0) * roll['latency_count']
+    timeline = roll.groupby(['window_start', 'protocol'], as_index=False).agg(
+        count=('count', 'sum'), drops=('drops', 'sum'), duplicates=('duplicates', 'sum'),
+        latency_count=('latency_count', 'sum'), latency_weight=('latency_weight', 'sum'),
+        latency_max_ms=('latency_max_ms', 'max'))
+    timeline['msgs_per_s'] = timeline['count'] / resolution
+    timeline['latency_mean_ms'] = timeline['latency_weight'] / timeline['latency_count'].where(timeline['latency_count'] > 0)
+    return timeline.drop(columns=['latency_weight', 'latency_count'])
+
+
+def run_sweep(loss_rates, fail_probs, run_seconds=12, output_csv='experiments_results.csv',
+              timeline_csv='experiments_timeline.csv'):
+    out_rows = []
+    timelines = []
+    base_cfg_path = Path('config.json')
+    if not base_cfg_path.exists():
+        raise FileNotFoundError('config.json missing')
+
+    for loss in loss_rates:
+        for fail in fail_probs:
+            print(f'Running experiment loss={loss} fail={fail}')
+            # reset logs
+            for p in ['all_devices_recorded_data.csv', 'sent_messages.csv']:
+                try:
+                    Path(p).unlink()
+                except Exception:
+                    pass
+            # write config overrides
+            _write_config({'loss_rate': loss, 'fail_prob': fail})
+            # start demo
+            proc = subprocess.Popen(["python", "run_demo.py"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            try:
+                time.sleep(run_seconds)
+            finally:
+                # SIGTERM: run_demo stops devices, drains the collectors and flushes storage before exiting
+                proc.terminate()
+                try:
+                    proc.wait(timeout=15)
+                except Exception:
+                    proc.kill()
+            # compute metrics
+            metrics = _compute_metrics()
+            for m in metrics:
+                row = {'loss_rate': loss, 'fail_prob': fail, **m}
+                out_rows.append(row)
+            timeline = _rollup_timeline()
+            if not timeline.empty:
+                timeline.insert(0, 'fail_prob', fail)
+                timeline.insert(0, 'loss_rate', loss)
+                timelines.append(timeline)
+            # small pause
+            time.sleep(1)
+
+    if out_rows:
+        df = pd.DataFrame(out_rows)
+        df.to_csv(output_csv, index=False)
+    if timelines:
+        pd.concat(timelines, ignore_index=True).to_csv(timeline_csv, index=False)
+    return out_rows
+
+
+if __name__ == '__main__':
+    # quick demo sweep
+    run_sweep([0.0, 0.1], [0.0, 0.05], run_seconds=12)
@@ -1,41 +1,66 @@
-from datetime import datetime
-from typing import Dict
-from storage import save_to_csv
-
-
-def _normalize_common(data: Dict) -> Dict:
-    # Ensure keys: device_id, time, date, protocol, sensor_type, value
-    out = {
-        "device_id": data.get("device_id") or data.get("id") or "",
-        "time": data.get("time") or data.get("t") or "",
-        "date": data.get("date") or data.get("d") or "",
-        "protocol": data.get("protocol") or "",
-        "sensor_type": data.get("sensor_type") or data.get("sensor") or "",
-        "value": data.get("value") or data.get("val") or "",
-    }
-    # add receive timestamp if not present
-    if "receive_ts" not in data:
-        out["receive_ts"] = datetime.utcnow().isoformat()
-    else:
-        out["receive_ts"] = data.get("receive_ts")
-    # preserve send_ts if present
-    if "send_ts" in data:
-        out["send_ts"] = data.get("send_ts")
-    return out
-
-
-def process_message(raw: Dict):
-    """Process a raw message from any protocol, normalize and persist.
-
-    Expects raw to be a dict with protocol-specific keys.
-    """
-    norm = _normalize_common(raw)
-    # try to compute latency if send_ts present
-    try:
-        if "send_ts" in norm and norm.get("send_ts"):
-            # let storage or collector compute latency; still write fields
-            pass
-    except Exception:
-        pass
-    # write to CSV via storage
-    save_to_csv(norm)
\ No newline at end of file
+from typing import List
+from metrics import SEQUENCE_EVENTS, SEQUENCE_LOST
+from reading import Reading
+from sequence import SeqTracker
+from sinks import CsvSink, MetricsSink
+
+import tracing
+
+# Batches of Readings are fanned out to every sink in order
+sinks = [CsvSink(), MetricsSink()]
+
+# loss / duplicate / reorder accounting from the per-device sequence numbers
+sequences = SeqTracker()
+SEQUENCE_LOST.set_function(lambda: {(dev,): s["lost"] for dev, s in sequences.stats().items()})
+
+
+def add_sink(sink):
+    """Register a sink (write(batch), close()) to receive every batch of Readings."""
+    sinks.append(sink)
+
+
+def _normalize_common(data) -> Reading:
+    # dicts (legacy callers) are converted by the schema-compiled Reading.from_dict
+    reading = data if isinstance(data, Reading) else Reading.from_dict(data)
+    # add receive timestamp (and latency from send_ts) if the receiver did not stamp it
+    if reading.receive_ts is None:
+        reading.stamp_receive()
+    return reading
+
+
+def process_messages(batch: List):
+    """Normalise a batch of Readings (or raw dicts) from any protocol and hand it to every sink.
+
+    Sinks receive the whole batch, so persisting and counting cost one call per batch
+    instead of one per message.
+    """
+    if not batch:
+        return
+    records = [_normalize_common(raw) for raw in batch]
+    for r in records:
+        if r.seq is not None:
+            outcome = sequences.observe(r.device_id, r.seq)
+            if outcome != "new":
+                SEQUENCE_EVENTS.inc(r.device_id, outcome)
+    for sink in sinks:
+        try:
+            sink.write(records)
+        except Exception as e:
+            print(f"[GATEWAY] {getattr(sink, 'name', type(sink).__name__)} sink failed: {e}")
+    for r in records:
+        if r.trace_id is not None:
+            tracing.finish(r.trace_id)
+
+
+def process_message(raw):
+    """Process a single Reading or raw message dict (see process_messages)."""
+    process_messages([raw])
+
+
+def close():
+    """Flush and close every sink (called at shutdown)."""
+    for sink in sinks:
+        try:
+            sink.close()
+        except Exception as e:
+            print(f"[GATEWAY] {getattr(sink, 'name', type(sink).__name__)} sink failed to close: {e}")
@@ -1,36 +1,109 @@
 import asyncio
-import json
+import threading
+import time
 from gateway import process_message
+from payload_codec import decode, CONTENT_FORMATS
+from reading import Reading
+from metrics import COAP_REQUESTS
+import tracing
 
 import aiocoap.resource as resource
 import aiocoap
 
 
 class GatewayResource(resource.Resource):
+    def __init__(self, encoding='json'):
+        super().__init__()
+        self.encoding = encoding
+
+    def _encoding_for(self, request):
+        # JSON and CBOR are identified by Content-Format; opaque payloads use the configured codec
+        fmt = request.opt.content_format
+        fmt = int(fmt) if fmt is not None else None
+        if fmt == CONTENT_FORMATS['json']:
+            return 'json'
+        if fmt == CONTENT_FORMATS['cbor']:
+            return 'cbor'
+        return self.encoding
+
     async def render_post(self, request):
+        arrived_ns = time.perf_counter_ns()
+        recv_mono_ns = time.monotonic_ns()
         try:
-            payload = request.payload.decode('utf-8')
-            data = json.loads(payload)
-            process_message(data)
+            encoding = self._encoding_for(request)
+            data, decode_us = decode(request.payload, encoding, 'COAP')
+            reading = Reading.from_dict(data)
+            if reading.trace_id is not None:
+                tracing.stamp(reading.trace_id, 'received', arrived_ns)
+                tracing.stamp(reading.trace_id, 'decoded')
+            reading.encoding = encoding
+            reading.payload_bytes = len(request.payload)
+            reading.decode_us = round(decode_us, 2)
+            reading.stamp_receive(recv_mono_ns=recv_mono_ns)
+            process_message(reading)
+            COAP_REQUESTS.inc('ok')
         except Exception:
-            pass
+            COAP_REQUESTS.inc('error')
         return aiocoap.Message(code=aiocoap.CONTENT, payload=b'OK')
 
 
-def start_coap_server(bind_host='127.0.0.1', bind_port=5683):
-    async def _run():
+class CoapGatewayServer:
+    """aiocoap server context for the gateway resource, on its own event loop thread.
+
+    start() returns once the UDP socket is bound; stop() shuts the context down, so requests
+    already handed to the resource finish before the loop exits.
+    """
+
+    def __init__(self, bind_host='127.0.0.1', bind_port=5683, encoding='json'):
+        self.bind_host = bind_host
+        self.bind_port = bind_port
+        self.encoding = encoding
+        self._loop = None
+        self._thread = None
+        self._stopped = None
+        self._ready = threading.Event()
+        self._error = None
+
+    async def _serve(self):
         root = resource.Site()
-        root.add_resource(['gateway'], GatewayResource())
-        await aiocoap.Context.create_server_context(root, bind=(bind_host, bind_port))
-        # run forever
-        await asyncio.get_running_loop().create_future()
-
-    loop = asyncio.new_event_loop()
-    def _starter():
-        asyncio.set_event_loop(loop)
-        loop.run_until_complete(_run())
-
-    import threading
-    t = threading.Thread(target=_starter, daemon=True)
-    t.start()
-    return t
+        root.add_resource(['gateway'], GatewayResource(self.encoding))
+        try:
+            context = await aiocoap.Context.create_server_context(root, bind=(self.bind_host, self.bind_port))
+        except Exception as e:
+            self._error = e
+            self._ready.set()
+            return
+        self._stopped = asyncio.get_running_loop().create_future()
+        self._ready.set()
+        try:
+            await self._stopped
+        finally:
+            await context.shutdown()
+
+    def start(self, timeout=5.0):
+        def _run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            self._loop.run_until_complete(self._serve())
+
+        self._thread = threading.Thread(target=_run, name='coap-gateway', daemon=True)
+        self._thread.start()
+        if not self._ready.wait(timeout):
+            raise RuntimeError('CoAP gateway did not start in time')
+        if self._error:
+            raise RuntimeError(f'CoAP gateway failed to start: {self._error}')
+
+    def stop(self):
+        if self._loop and self._stopped is not None:
+            try:
+                self._loop.call_soon_threadsafe(lambda: self._stopped.done() or self._stopped.set_result(None))
+            except RuntimeError:
+                pass  # loop already closed
+        if self._thread:
+            self._thread.join(timeout=2)
+
+
+def start_coap_server(bind_host='127.0.0.1', bind_port=5683, encoding='json'):
+    server = CoapGatewayServer(bind_host, bind_port, encoding)
+    server.start()
+    return server
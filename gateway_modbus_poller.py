@@ -2,15 +2,25 @@ import threading
 import time
 from typing import List
 from pymodbus.client.sync import ModbusTcpClient
-from gateway import process_message
+from gateway import process_messages
 from storage import log_sent
+from reading import Reading
 from faults import should_drop, get_network_delay, is_device_failed, maybe_fail
-from datetime import datetime
+from metrics import DEVICE_MESSAGES, MODBUS_POLL_CYCLE
+import tracing
+import timestamps
 
 
 class ModbusPoller(threading.Thread):
+    """Polls the simulated Modbus devices and forwards each sample to the gateway.
+
+    The sample's sequence number is read from registers 1-2, so a sample polled twice shows up
+    as a duplicate and device updates between polls show up as gaps. The samples of one poll
+    cycle are handed to the gateway as a single batch.
+    """
+
     def __init__(self, targets: List[dict], poll_interval=5):
-        super().__init__(daemon=True)
+        super().__init__(name='modbus-poller', daemon=True)
         self.targets = targets
         self.poll_interval = poll_interval
         self._stop_event = threading.Event()
@@ -20,49 +30,66 @@ class ModbusPoller(threading.Thread):
 
     def run(self):
         while not self._stop_event.is_set():
-            for t in self.targets:
-                host = t.get('host', '127.0.0.1')
-                port = t.get('port', 1502)
-                device_id = t.get('device_id', 'modbus1')
-                try:
-                    client = ModbusTcpClient(host, port=port)
-                    if not client.connect():
+            self.poll_once()
+            self._stop_event.wait(self.poll_interval)
+
+    def poll_once(self) -> int:
+        """Poll every target once and hand the samples to the gateway; returns the batch size."""
+        cycle_start = time.perf_counter()
+        batch = []
+        for t in self.targets:
+            host = t.get('host', '127.0.0.1')
+            port = t.get('port', 1502)
+            device_id = t.get('device_id', 'modbus1')
+            client = ModbusTcpClient(host, port=port)
+            try:
+                if not client.connect():
+                    continue
+                rr = client.read_holding_registers(0, 3, unit=1)
+                if rr and hasattr(rr, 'registers'):
+                    seq = (rr.registers[1] << 16) | rr.registers[2] if len(rr.registers) >= 3 else None
+                    # simulate device failure and fault injection
+                    maybe_fail(device_id)
+                    if is_device_failed(device_id):
+                        DEVICE_MESSAGES.inc(device_id, 'MODBUS', 'failed')
                         continue
-                    rr = client.read_holding_registers(0, 1, unit=1)
-                    if rr and hasattr(rr, 'registers'):
-                        # simulate device failure and fault injection
-                        maybe_fail(device_id)
-                        if is_device_failed(device_id):
-                            continue
-                        if should_drop():
-                            # log attempted send but don't forward
-                            try:
-                                log_sent({'device_id': device_id, 'send_ts': datetime.utcnow().isoformat(), 'protocol': 'MODBUS'})
-                            except Exception:
-                                pass
-                            continue
-                        val = rr.registers[0]
-                        send_ts = datetime.utcnow().isoformat()
+                    if should_drop():
+                        DEVICE_MESSAGES.inc(device_id, 'MODBUS', 'dropped')
+                        # log attempted send but don't forward
                         try:
-                            log_sent({'device_id': device_id, 'send_ts': send_ts, 'protocol': 'MODBUS'})
+                            log_sent({'device_id': device_id, 'send_ts': timestamps.now(), 'protocol': 'MODBUS', 'seq': seq})
                         except Exception:
                             pass
-                        delay = get_network_delay()
-                        if delay and delay > 0:
-                            time.sleep(delay)
-                        # normalize to gateway format and include dummy date/time
-                        from datetime import datetime as _dt
-                        now = _dt.utcnow()
-                        msg = {
-                            'device_id': device_id,
-                            'protocol': 'MODBUS',
-                            'sensor_type': 'temperature',
-                            'value': str(val / 100.0),
-                            'time': now.strftime('%H:%M:%S'),
-                            'date': now.strftime('%Y-%m-%d'),
-                            'send_ts': send_ts
-                        }
-                        process_message(msg)
-                except Exception:
-                    pass
-            time.sleep(self.poll_interval)
+                        continue
+                    trace_id = tracing.start(device_id, 'MODBUS', stage='received')
+                    val = rr.registers[0]
+                    tracing.stamp(trace_id, 'decoded')
+                    DEVICE_MESSAGES.inc(device_id, 'MODBUS', 'sent')
+                    now = timestamps.utc_now()
+                    # holding registers are raw 16-bit words, no payload codec involved
+                    reading = Reading(device_id=device_id, time=now.strftime('%H:%M:%S'), date=now.strftime('%Y-%m-%d'),
+                                      protocol='MODBUS', sensor_type='temperature', value=val / 100.0,
+                                      encoding='registers', payload_bytes=2 * len(rr.registers), seq=seq, trace_id=trace_id)
+                    # the reading is "sent" once polled and received after the injected delay
+                    reading.stamp_send()
+                    try:
+                        log_sent({'device_id': device_id, 'send_ts': reading.send_ts, 'protocol': 'MODBUS', 'seq': seq})
+                    except Exception:
+                        pass
+                    delay = get_network_delay()
+                    if delay and delay > 0:
+                        time.sleep(delay)
+                    # received now, not when the batch reaches the gateway at the end of the cycle
+                    reading.stamp_receive()
+                    batch.append(reading)
+            except Exception:
+                pass
+            finally:
+                # a new connection per target and cycle; close it so sockets are not leaked
+                client.close()
+        try:
+            process_messages(batch)
+        except Exception as e:
+            print(f"[MODBUS POLLER] Failed to process batch: {e}")
+        MODBUS_POLL_CYCLE.observe(time.perf_counter() - cycle_start)
+        return len(batch)
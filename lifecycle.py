@@ -0,0 +1,181 @@
+import socket
+import threading
+import time
+
+# Components of the simulation (broker, collector, protocol servers, devices) are registered
+# with a Lifecycle, which starts each one as soon as its dependencies are ready - independent
+# stacks in parallel - and stops them in reverse order so producers stop before the
+# consumers that persist their data.
+
+
+def port_listening(port: int, host: str = "127.0.0.1") -> bool:
+    """True if a TCP connection to host:port succeeds."""
+    try:
+        with socket.create_connection((host, port), timeout=0.2):
+            return True
+    except OSError:
+        return False
+
+
+class Component:
+    """A named part of the simulation.
+
+    start() builds and launches it and returns a handle (e.g. the thread or server object),
+    which is passed to ready() and stop(). ready(handle) is polled until it returns True or
+    ready_timeout expires (no probe = ready once start returns). Modules needed only by this
+    component should be imported inside start(), so disabled protocols cost nothing.
+    A component that is not required may fail without aborting the run; its dependents are
+    skipped.
+    """
+
+    def __init__(self, name: str, start, stop=None, ready=None, depends=(), ready_timeout: float = 10.0,
+                 required: bool = True):
+        self.name = name
+        self.start = start
+        self.stop = stop
+        self.ready = ready
+        self.depends = tuple(depends)
+        self.ready_timeout = ready_timeout
+        self.required = required
+        self.handle = None
+        self.state = "pending"  # pending, starting, ready, failed, skipped, stopped
+        self.error = None
+        self.started_at = None  # seconds since Lifecycle.start_all
+        self.start_s = None  # time in start()
+        self.ready_s = None  # start() call to ready
+        self.stop_s = None
+        self._done = threading.Event()
+
+
+class Lifecycle:
+    """Starts registered components concurrently by dependency and stops them in reverse order."""
+
+    def __init__(self):
+        self._components = {}
+        self._ready_order = []
+        self._lock = threading.Lock()
+        self._t0 = None
+        self._stopping = threading.Event()
+
+    def add(self, name: str, start, stop=None, ready=None, depends=(), ready_timeout: float = 10.0,
+            required: bool = True) -> Component:
+        if name in self._components:
+            raise ValueError(f"Component '{name}' is already registered")
+        component = Component(name, start, stop, ready, depends, ready_timeout, required)
+        self._components[name] = component
+        return component
+
+    def get(self, name: str):
+        """Handle returned by the component's start(), or None if it is not running."""
+        component = self._components.get(name)
+        return component.handle if component is not None else None
+
+    def _run_component(self, c: Component):
+        for dep in c.depends:
+            d = self._components[dep]
+            d._done.wait()
+            if d.state != "ready":
+                c.state = "skipped"
+                c.error = f"dependency '{dep}' is {d.state}"
+                c._done.set()
+                return
+        if self._stopping.is_set():
+            c.state = "skipped"
+            c.error = "shutting down"
+            c._done.set()
+            return
+        c.state = "starting"
+        c.started_at = time.perf_counter() - self._t0
+        t0 = time.perf_counter()
+        try:
+            c.handle = c.start()
+            c.start_s = time.perf_counter() - t0
+            if c.ready is not None:
+                deadline = time.monotonic() + c.ready_timeout
+                while not c.ready(c.handle):
+                    if time.monotonic() > deadline:
+                        raise RuntimeError(f"not ready after {c.ready_timeout:g}s")
+                    time.sleep(0.01)
+            c.ready_s = time.perf_counter() - t0
+            c.state = "ready"
+            with self._lock:
+                self._ready_order.append(c)
+        except Exception as e:
+            c.state = "failed"
+            c.error = str(e)
+            # a component that started but never became ready still gets stopped
+            if c.handle is not None:
+                with self._lock:
+                    self._ready_order.append(c)
+        finally:
+            c._done.set()
+
+    def start_all(self) -> bool:
+        """Start every component; returns False if a required component failed or was skipped."""
+        for c in self._components.values():
+            for dep in c.depends:
+                if dep not in self._components:
+                    raise ValueError(f"Component '{c.name}' depends on unknown component '{dep}'")
+        self._t0 = time.perf_counter()
+        threads = [threading.Thread(target=self._run_component, args=(c,), name=f"start-{c.name}", daemon=True)
+                   for c in self._components.values()]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        ok = True
+        for c in self._components.values():
+            if c.state != "ready":
+                level = "Error" if c.required else "Warning"
+                print(f"[LIFECYCLE] {level}: {c.name} {c.state}: {c.error}")
+                ok = ok and not c.required
+        return ok
+
+    def stop_all(self, timeout: float = 10.0):
+        """Stop running components in reverse start order, each within timeout seconds.
+
+        If start-up was interrupted, components still starting are waited for (up to timeout)
+        so they are stopped too; those not yet started are skipped.
+        """
+        self._stopping.set()
+        if self._t0 is not None:
+            deadline = time.monotonic() + timeout
+            for c in self._components.values():
+                c._done.wait(max(deadline - time.monotonic(), 0))
+        with self._lock:
+            order = list(reversed(self._ready_order))
+            self._ready_order.clear()
+        for c in order:
+            if c.stop is None:
+                c.state = "stopped"
+                continue
+            t0 = time.perf_counter()
+            # stop in a helper thread so one component that hangs cannot block the rest of the shutdown
+            errors = []
+
+            def _stop(c=c):
+                try:
+                    c.stop(c.handle)
+                except Exception as e:
+                    errors.append(e)
+
+            t = threading.Thread(target=_stop, name=f"stop-{c.name}", daemon=True)
+            t.start()
+            t.join(timeout)
+            c.stop_s = time.perf_counter() - t0
+            if t.is_alive():
+                print(f"[LIFECYCLE] {c.name} did not stop within {timeout:g}s")
+            elif errors:
+                print(f"[LIFECYCLE] {c.name} failed to stop: {errors[0]}")
+            c.state = "stopped"
+
+    def report(self) -> str:
+        """Per-component state and timings (ms): start offset, time in start(), time to ready, time to stop."""
+
+        def ms(v):
+            return f"{v * 1000:8.1f}" if v is not None else "       -"
+
+        lines = [f"  {'component':20s} {'state':8s} {'at':>8s} {'start':>8s} {'ready':>8s} {'stop':>8s}"]
+        for c in self._components.values():
+            lines.append(f"  {c.name:20s} {c.state:8s} {ms(c.started_at)} {ms(c.start_s)} {ms(c.ready_s)} {ms(c.stop_s)}")
+        return "\n".join(lines)
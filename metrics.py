@@ -0,0 +1,232 @@
+import bisect
+import threading
+
+# Instruments keep one shard per writing thread, so the hot path is a plain dict update
+# without any lock; shards are only summed when /metrics is scraped.
+
+_registry = []
+_registry_lock = threading.Lock()
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _fmt(value) -> str:
+    if isinstance(value, float):
+        if value != value:
+            return "NaN"
+        if value in (float("inf"), float("-inf")):
+            return "+Inf" if value > 0 else "-Inf"
+        return repr(value)
+    return str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards = []
+        self._shards_lock = threading.Lock()
+
+    def _shard(self) -> dict:
+        try:
+            return self._local.cells
+        except AttributeError:
+            cells = self._local.cells = {}
+            with self._shards_lock:
+                self._shards.append(cells)
+            return cells
+
+    def _labels(self, labels, extra=None) -> str:
+        pairs = [f'{n}="{_escape(v)}"' for n, v in zip(self.labelnames, labels)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def _merged(self) -> dict:
+        raise NotImplementedError
+
+    def render(self) -> list:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        cells = self._shard()
+        cells[labels] = cells.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._merged().get(labels, 0)
+
+    def values(self) -> dict:
+        """Return {label tuple: total} across all threads."""
+        return self._merged()
+
+    def _merged(self) -> dict:
+        out = {}
+        with self._shards_lock:
+            shards = list(self._shards)
+        for cells in shards:
+            for labels, v in list(cells.items()):
+                out[labels] = out.get(labels, 0) + v
+        return out
+
+    def render(self) -> list:
+        return [f"{self.name}{self._labels(k)} {_fmt(v)}" for k, v in sorted(self._merged().items())]
+
+
+class Gauge(Counter):
+    """Up/down gauge; inc/dec are sharded per thread, or set_function() samples on scrape."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._function = None
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def set_function(self, fn):
+        """Report fn() (a number, or {label tuple: number}) instead of the sharded value."""
+        self._function = fn
+
+    def _merged(self) -> dict:
+        if self._function is not None:
+            try:
+                v = self._function()
+            except Exception:
+                return {}
+            return dict(v) if isinstance(v, dict) else {(): v}
+        return super()._merged()
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+    DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        cells = self._shard()
+        cell = cells.get(labels)
+        if cell is None:
+            # per-bucket counts followed by sum and count
+            cell = cells[labels] = [0] * (len(self.buckets) + 3)
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-2] += value
+        cell[-1] += 1
+
+    def _merged(self) -> dict:
+        out = {}
+        with self._shards_lock:
+            shards = list(self._shards)
+        for cells in shards:
+            for labels, cell in list(cells.items()):
+                acc = out.get(labels)
+                if acc is None:
+                    out[labels] = list(cell)
+                else:
+                    for i, v in enumerate(cell):
+                        acc[i] += v
+        return out
+
+    def snapshot(self) -> dict:
+        """Return {label tuple: (bucket bounds, bucket counts, sum, count)} across all threads."""
+        return {k: (self.buckets, v[:-2], v[-2], v[-1]) for k, v in self._merged().items()}
+
+    def render(self) -> list:
+        lines = []
+        for labels, cell in sorted(self._merged().items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), cell[:-2]):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else _fmt(float(bound))
+                extra = 'le="' + le + '"'
+                lines.append(f"{self.name}_bucket{self._labels(labels, extra)} {cumulative}")
+            lines.append(f"{self.name}_sum{self._labels(labels)} {_fmt(float(cell[-2]))}")
+            lines.append(f"{self.name}_count{self._labels(labels)} {cell[-1]}")
+        return lines
+
+
+def _register(metric):
+    with _registry_lock:
+        _registry.append(metric)
+    return metric
+
+
+def counter(name: str, documentation: str, labelnames=()) -> Counter:
+    return _register(Counter(name, documentation, labelnames))
+
+
+def gauge(name: str, documentation: str, labelnames=()) -> Gauge:
+    return _register(Gauge(name, documentation, labelnames))
+
+
+def histogram(name: str, documentation: str, labelnames=(), buckets=Histogram.DEFAULT_BUCKETS) -> Histogram:
+    return _register(Histogram(name, documentation, labelnames, buckets))
+
+
+def render() -> str:
+    """Render every registered metric in the Prometheus text exposition format."""
+    with _registry_lock:
+        metrics = list(_registry)
+    lines = []
+    for m in metrics:
+        lines.append(f"# HELP {m.name} {m.documentation}")
+        lines.append(f"# TYPE {m.name} {m.kind}")
+        lines.extend(m.render())
+    return "\n".join(lines) + "\n"
+
+
+# Instruments shared by the simulator components
+DEVICE_MESSAGES = counter(
+    "iot_device_messages_total",
+    "Messages per device by outcome (sent, dropped by fault injection, failed: skipped while failed or publish rejected).",
+    ("device_id", "protocol", "outcome"),
+)
+COLLECTOR_RECEIVED = counter("iot_collector_received_total", "Readings received by the MQTT collector.", ("protocol",))
+COLLECTOR_DECODE_ERRORS = counter("iot_collector_decode_errors_total", "Payloads the MQTT collector failed to decode.", ("protocol",))
+COAP_REQUESTS = counter("iot_coap_gateway_requests_total", "POST requests handled by the CoAP gateway resource.", ("status",))
+MODBUS_POLL_CYCLE = histogram("iot_modbus_poll_cycle_seconds", "Duration of one Modbus poll cycle over all targets.")
+GATEWAY_MESSAGES = counter("iot_gateway_messages_total", "Readings normalised and persisted by the gateway.", ("protocol",))
+STORAGE_QUEUE_DEPTH = gauge("iot_storage_queue_depth", "Writers waiting for the storage lock.")
+BROKER_CLIENT_MESSAGES = gauge("iot_broker_client_messages", "Messages seen by the built-in broker per client and direction.", ("client_id", "direction"))
+SEQUENCE_EVENTS = counter(
+    "iot_gateway_sequence_events_total",
+    "Readings per device that were duplicates, out of order or late according to their sequence number.",
+    ("device_id", "outcome"),
+)
+SEQUENCE_LOST = gauge("iot_gateway_sequence_lost", "Sequence numbers never received per device.", ("device_id",))
+STORAGE_FLUSH = histogram("iot_storage_flush_seconds", "Time to persist one batch of records, including waiting for the storage lock.")
+
+
+def start_http_server(host: str = "127.0.0.1", port: int = 9100):
+    """Serve /metrics from a background thread (Flask is imported only when enabled)."""
+    from flask import Flask, Response
+    from werkzeug.serving import make_server, WSGIRequestHandler
+
+    class _QuietHandler(WSGIRequestHandler):
+        # scrapes every few seconds would otherwise flood the demo output
+        def log_request(self, *args, **kwargs):
+            pass
+
+    app = Flask("iot-metrics")
+
+    @app.route("/metrics")
+    def _metrics():
+        return Response(render(), mimetype="text/plain; version=0.0.4")
+
+    server = make_server(host, port, app, threaded=True, request_handler=_QuietHandler)
+    t = threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True)
+    t.start()
+    return server
@@ -0,0 +1,366 @@
+import asyncio
+import random
+import threading
+import time
+
+
+class LinkProfile:
+    """Impairments applied to one proxied link (both directions).
+
+    loss_rate, duplicate_rate and reorder_rate are probabilities per datagram/segment,
+    delay_ms is a [min_ms, max_ms] window and bandwidth_kbps (0 = unlimited) adds
+    serialisation delay. For TCP a "lost" segment is held back for tcp_rto_ms, which is
+    what a TCP application observes when the kernel retransmits; reset_rate aborts the
+    connection so clients have to reconnect (and MQTT redelivers unacknowledged messages).
+    """
+
+    def __init__(self, loss_rate=0.0, delay_ms=(0, 0), duplicate_rate=0.0, reorder_rate=0.0,
+                 reorder_delay_ms=50, bandwidth_kbps=0, tcp_rto_ms=200, reset_rate=0.0):
+        self.loss_rate = float(loss_rate)
+        self.delay_ms = (float(delay_ms[0]), float(delay_ms[1]))
+        self.duplicate_rate = float(duplicate_rate)
+        self.reorder_rate = float(reorder_rate)
+        self.reorder_delay_ms = float(reorder_delay_ms)
+        self.bandwidth_kbps = float(bandwidth_kbps)
+        self.tcp_rto_ms = float(tcp_rto_ms)
+        self.reset_rate = float(reset_rate)
+
+    @classmethod
+    def from_config(cls, cfg: dict | None):
+        cfg = cfg or {}
+        return cls(
+            loss_rate=cfg.get('loss_rate', 0.0),
+            delay_ms=tuple(cfg.get('delay_ms', (0, 0))),
+            duplicate_rate=cfg.get('duplicate_rate', 0.0),
+            reorder_rate=cfg.get('reorder_rate', 0.0),
+            reorder_delay_ms=cfg.get('reorder_delay_ms', 50),
+            bandwidth_kbps=cfg.get('bandwidth_kbps', 0),
+            tcp_rto_ms=cfg.get('tcp_rto_ms', 200),
+            reset_rate=cfg.get('reset_rate', 0.0),
+        )
+
+
+class _Direction:
+    """Per-direction link state: RNG, serialisation clock and counters."""
+
+    def __init__(self, profile: LinkProfile, rng: random.Random, stats: dict):
+        self.profile = profile
+        self.rng = rng
+        self.stats = stats
+        self._busy_until = 0.0
+
+    def base_delay(self, nbytes: int, now: float) -> float:
+        """Return seconds from now until the payload leaves the link."""
+        lo, hi = self.profile.delay_ms
+        delay = (lo if hi <= lo else self.rng.uniform(lo, hi)) / 1000.0
+        if self.profile.bandwidth_kbps > 0:
+            start = max(now, self._busy_until)
+            self._busy_until = start + (nbytes * 8) / (self.profile.bandwidth_kbps * 1000.0)
+            delay += self._busy_until - now
+        return delay
+
+    def roll(self, rate: float) -> bool:
+        return rate > 0 and self.rng.random() < rate
+
+
+class _UdpUpstream(asyncio.DatagramProtocol):
+    """Socket towards the real server for one client address."""
+
+    def __init__(self, link, client_addr):
+        self.link = link
+        self.client_addr = client_addr
+        self.transport = None
+        self.pending = []  # datagrams received while the socket is being opened
+        self.last_active = time.monotonic()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.last_active = time.monotonic()
+        self.link.forward(self.link.down, data, lambda d: self.link.transport.sendto(d, self.client_addr))
+
+
+class _UdpLink(asyncio.DatagramProtocol):
+    """UDP listener relaying each client address through its own upstream socket.
+
+    Upstream sockets with no traffic in either direction for idle_timeout seconds are closed,
+    so restarting clients (new source ports) do not accumulate sockets.
+    """
+
+    def __init__(self, loop, target, profile: LinkProfile, rng: random.Random, stats: dict,
+                 idle_timeout: float = 60.0):
+        self.loop = loop
+        self.target = target
+        self.up = _Direction(profile, rng, stats)
+        self.down = _Direction(profile, rng, stats)
+        self.stats = stats
+        self.idle_timeout = idle_timeout
+        self.transport = None
+        self._upstreams = {}  # client addr -> _UdpUpstream
+        self._sweep = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.idle_timeout > 0:
+            self._sweep = self.loop.call_later(self.idle_timeout / 2, self._evict_idle)
+
+    def _evict_idle(self):
+        cutoff = time.monotonic() - self.idle_timeout
+        for addr, upstream in list(self._upstreams.items()):
+            if upstream.last_active < cutoff:
+                # also covers upstreams whose socket never opened
+                if upstream.transport is not None:
+                    upstream.transport.close()
+                upstream.pending = []
+                del self._upstreams[addr]
+                self.stats['evicted'] += 1
+        self._sweep = self.loop.call_later(self.idle_timeout / 2, self._evict_idle)
+
+    def datagram_received(self, data, addr):
+        upstream = self._upstreams.get(addr)
+        if upstream is None:
+            upstream = _UdpUpstream(self, addr)
+            self._upstreams[addr] = upstream
+            self.loop.create_task(self._open_upstream(upstream))
+        upstream.last_active = time.monotonic()
+        if upstream.transport is None:
+            upstream.pending.append(data)
+            return
+        self.forward(self.up, data, upstream.transport.sendto)
+
+    async def _open_upstream(self, upstream):
+        try:
+            await self.loop.create_datagram_endpoint(lambda: upstream, remote_addr=self.target)
+        except Exception as e:
+            # forget the client so its next datagram retries instead of queueing forever
+            if self._upstreams.get(upstream.client_addr) is upstream:
+                del self._upstreams[upstream.client_addr]
+            self.stats['packets'] += len(upstream.pending)
+            self.stats['dropped'] += len(upstream.pending)
+            upstream.pending = []
+            print(f"[NETEM] Could not open upstream socket to {self.target[0]}:{self.target[1]}: {e}")
+            return
+        if self._upstreams.get(upstream.client_addr) is not upstream:
+            # evicted while the socket was being opened
+            upstream.transport.close()
+            return
+        pending, upstream.pending = upstream.pending, []
+        for data in pending:
+            self.forward(self.up, data, upstream.transport.sendto)
+
+    def forward(self, direction: _Direction, data: bytes, send):
+        stats = direction.stats
+        profile = direction.profile
+        stats['packets'] += 1
+        if direction.roll(profile.loss_rate):
+            stats['dropped'] += 1
+            return
+        delay = direction.base_delay(len(data), time.monotonic())
+        if direction.roll(profile.reorder_rate):
+            # hold this datagram back so the ones behind it overtake it
+            delay += profile.reorder_delay_ms / 1000.0
+            stats['reordered'] += 1
+        copies = 2 if direction.roll(profile.duplicate_rate) else 1
+        if copies > 1:
+            stats['duplicated'] += 1
+        for _ in range(copies):
+            stats['bytes'] += len(data)
+            if delay > 0:
+                self.loop.call_later(delay, send, data)
+            else:
+                send(data)
+
+    def close(self):
+        if self._sweep is not None:
+            self._sweep.cancel()
+        for upstream in self._upstreams.values():
+            if upstream.transport is not None:
+                upstream.transport.close()
+        if self.transport is not None:
+            self.transport.close()
+
+
+class _TcpLink:
+    def __init__(self, target, profile: LinkProfile, rng: random.Random, stats: dict):
+        self.target = target
+        self.profile = profile
+        self.rng = rng
+        self.stats = stats
+
+    async def handle(self, client_reader, client_writer):
+        try:
+            server_reader, server_writer = await asyncio.open_connection(*self.target)
+        except OSError:
+            client_writer.close()
+            return
+        self.stats['connections'] += 1
+        up = _Direction(self.profile, self.rng, self.stats)
+        down = _Direction(self.profile, self.rng, self.stats)
+        tasks = [
+            asyncio.ensure_future(self._pipe(client_reader, server_writer, up)),
+            asyncio.ensure_future(self._pipe(server_reader, client_writer, down)),
+        ]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            for t in tasks:
+                t.cancel()
+            for w in (client_writer, server_writer):
+                try:
+                    w.close()
+                except Exception:
+                    pass
+
+    async def _pipe(self, reader, writer, direction: _Direction):
+        # Segments keep their order (TCP guarantees it); every impairment becomes added delay.
+        queue = asyncio.Queue()
+        pump = asyncio.ensure_future(self._pump(queue, writer))
+        last_due = 0.0
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                self.stats['packets'] += 1
+                self.stats['bytes'] += len(data)
+                if direction.roll(self.profile.reset_rate):
+                    self.stats['resets'] += 1
+                    writer.transport.abort()
+                    break
+                now = time.monotonic()
+                delay = direction.base_delay(len(data), now)
+                if direction.roll(self.profile.loss_rate):
+                    self.stats['dropped'] += 1
+                    delay += self.profile.tcp_rto_ms / 1000.0
+                due = max(now + delay, last_due)
+                last_due = due
+                queue.put_nowait((due, data))
+            queue.put_nowait((0.0, None))
+            await pump
+        finally:
+            pump.cancel()
+
+    async def _pump(self, queue, writer):
+        while True:
+            due, data = await queue.get()
+            if data is None:
+                break
+            wait = due - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            writer.write(data)
+            await writer.drain()
+        try:
+            if writer.can_write_eof():
+                writer.write_eof()
+        except Exception:
+            pass
+
+
+class NetemProxy:
+    """Localhost TCP/UDP proxy applying a LinkProfile per listening port.
+
+    Links are registered with add_tcp/add_udp before start(); start() returns once every
+    listener is bound. The proxy runs its own asyncio loop in a background thread.
+    """
+
+    def __init__(self, host='127.0.0.1', seed: int | None = None, udp_idle_timeout: float = 60.0):
+        self.host = host
+        self._seed = seed
+        self.udp_idle_timeout = udp_idle_timeout
+        self._links = []  # (kind, listen_port, target, profile)
+        self._stats = {}
+        self._loop = None
+        self._thread = None
+        self._ready = threading.Event()
+        self._error = None
+
+    def add_tcp(self, listen_port: int, target_host: str, target_port: int, profile: LinkProfile):
+        self._links.append(('tcp', listen_port, (target_host, target_port), profile))
+
+    def add_udp(self, listen_port: int, target_host: str, target_port: int, profile: LinkProfile):
+        self._links.append(('udp', listen_port, (target_host, target_port), profile))
+
+    def stats(self) -> dict:
+        """Return a copy of the per-link counters keyed by '<kind>:<listen_port>'."""
+        return {k: dict(v) for k, v in self._stats.items()}
+
+    async def _serve(self):
+        loop = asyncio.get_running_loop()
+        servers = []
+        for kind, listen_port, target, profile in self._links:
+            rng = random.Random(None if self._seed is None else self._seed + listen_port)
+            stats = {'packets': 0, 'bytes': 0, 'dropped': 0, 'duplicated': 0, 'reordered': 0,
+                     'connections': 0, 'resets': 0, 'evicted': 0}
+            self._stats[f'{kind}:{listen_port}'] = stats
+            if kind == 'tcp':
+                link = _TcpLink(target, profile, rng, stats)
+                servers.append(await asyncio.start_server(link.handle, self.host, listen_port))
+            else:
+                link = _UdpLink(loop, target, profile, rng, stats, idle_timeout=self.udp_idle_timeout)
+                await loop.create_datagram_endpoint(lambda link=link: link, local_addr=(self.host, listen_port))
+                servers.append(link)
+        self._ready.set()
+        try:
+            await loop.create_future()
+        finally:
+            for s in servers:
+                s.close()
+
+    def start(self, timeout=5.0):
+        def _run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            try:
+                self._loop.run_until_complete(self._serve())
+            except asyncio.CancelledError:
+                pass
+            except Exception as e:
+                self._error = e
+                self._ready.set()
+
+        self._thread = threading.Thread(target=_run, name='netem-proxy', daemon=True)
+        self._thread.start()
+        if not self._ready.wait(timeout):
+            raise RuntimeError('Network emulator did not start in time')
+        if self._error:
+            raise RuntimeError(f'Network emulator failed to start: {self._error}')
+
+    def stop(self):
+        if self._loop:
+            def _cancel():
+                for task in asyncio.all_tasks(self._loop):
+                    task.cancel()
+            try:
+                self._loop.call_soon_threadsafe(_cancel)
+            except Exception:
+                pass
+        if self._thread:
+            self._thread.join(timeout=2)
+
+
+def build_proxy(cfg: dict, host='127.0.0.1', tcp_ports=(), udp_ports=()):
+    """Create a NetemProxy from config.json keys.
+
+    Every target port is exposed on port + netem_port_offset. Profiles come from
+    netem_profiles keyed by target port (as a string), falling back to "default".
+    Returns (proxy, port_map) where port_map maps target port -> proxied port.
+    """
+    offset = int(cfg.get('netem_port_offset', 10000))
+    profiles = cfg.get('netem_profiles', {}) or {}
+    proxy = NetemProxy(host=host, seed=cfg.get('netem_seed'),
+                       udp_idle_timeout=float(cfg.get('netem_udp_idle_s', 60)))
+    port_map = {}
+    for kind, ports in (('tcp', tcp_ports), ('udp', udp_ports)):
+        for port in ports:
+            profile = LinkProfile.from_config(profiles.get(str(port), profiles.get('default')))
+            listen = port + offset
+            if kind == 'tcp':
+                proxy.add_tcp(listen, host, port, profile)
+            else:
+                proxy.add_udp(listen, host, port, profile)
+            port_map[port] = listen
+    return proxy, port_map
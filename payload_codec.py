@@ -0,0 +1,253 @@
+import json
+import struct
+import time
+from threading import Lock
+
+# Payload encodings selectable per protocol in config.json (mqtt_encoding / coap_encoding)
+ENCODINGS = ("json", "cbor", "msgpack", "packed")
+
+# CoAP Content-Format numbers (RFC 7252 / IANA registry); msgpack and packed have none registered
+CONTENT_FORMATS = {"json": 50, "cbor": 60, "msgpack": 42, "packed": 42}
+
+_stats = {}  # (protocol, encoding) -> [messages, bytes, encode_ns, decode_ns, encoded, decoded]
+_lock = Lock()
+
+
+class PackedCodec:
+    """Fixed-layout binary encoding for readings.
+
+    Layout (little endian): header <BBH> magic, flags, record count; then per record
+    <BBBd> protocol code, sensor code, field flags, value followed by u8-length-prefixed
+    UTF-8 strings device_id, time, date, and send_ts as <q> when it is an integer or as a
+    string otherwise. Unknown sensor names are appended as an extra string, a sampled
+    trace_id as <Q>, send_mono_ns (timestamp_mode "ns") as <q> and the device sequence
+    number as <I>. Keys outside the reading schema are not carried.
+    """
+
+    name = "packed"
+    MAGIC = 0xB1
+    FLAG_BATCH = 0x01
+    F_SEND_INT = 0x01
+    F_SENSOR_NAME = 0x02
+    F_HAS_SEND = 0x04
+    F_TRACE = 0x08
+    F_MONO = 0x10
+    F_SEQ = 0x20
+    _HEADER = struct.Struct("<BBH")
+    _RECORD = struct.Struct("<BBBd")
+    _INT64 = struct.Struct("<q")
+    _UINT64 = struct.Struct("<Q")
+    _UINT32 = struct.Struct("<I")
+    PROTOCOLS = {"MQTT": 1, "COAP": 2, "MODBUS": 3}
+    SENSORS = {"temperature": 1, "humidity": 2, "light": 3}
+    _PROTOCOL_NAMES = {v: k for k, v in PROTOCOLS.items()}
+    _SENSOR_NAMES = {v: k for k, v in SENSORS.items()}
+
+    @staticmethod
+    def _put_str(out: bytearray, s):
+        b = str(s if s is not None else "").encode("utf-8")[:255]
+        out.append(len(b))
+        out += b
+
+    @staticmethod
+    def _get_str(buf, pos):
+        n = buf[pos]
+        pos += 1
+        return bytes(buf[pos:pos + n]).decode("utf-8"), pos + n
+
+    def encode(self, obj: dict) -> bytes:
+        if isinstance(obj.get("batch"), list):
+            common = {k: v for k, v in obj.items() if k != "batch"}
+            records = [{**common, **item} for item in obj["batch"]]
+            flags = self.FLAG_BATCH
+        else:
+            records = [obj]
+            flags = 0
+        out = bytearray(self._HEADER.pack(self.MAGIC, flags, len(records)))
+        for r in records:
+            sensor = r.get("sensor_type") or ""
+            sensor_code = self.SENSORS.get(sensor, 0)
+            send_ts = r.get("send_ts")
+            fflags = 0
+            if send_ts is not None and send_ts != "":
+                fflags |= self.F_HAS_SEND
+                if isinstance(send_ts, int):
+                    fflags |= self.F_SEND_INT
+            if not sensor_code:
+                fflags |= self.F_SENSOR_NAME
+            trace_id = r.get("trace_id")
+            if trace_id is not None:
+                fflags |= self.F_TRACE
+            send_mono = r.get("send_mono_ns")
+            if send_mono is not None:
+                fflags |= self.F_MONO
+            seq = r.get("seq")
+            if seq is not None:
+                fflags |= self.F_SEQ
+            value = r.get("value")
+            out += self._RECORD.pack(self.PROTOCOLS.get(r.get("protocol"), 0), sensor_code, fflags,
+                                     float(value) if value not in (None, "") else float("nan"))
+            self._put_str(out, r.get("device_id"))
+            self._put_str(out, r.get("time"))
+            self._put_str(out, r.get("date"))
+            if fflags & self.F_HAS_SEND:
+                if fflags & self.F_SEND_INT:
+                    out += self._INT64.pack(send_ts)
+                else:
+                    self._put_str(out, send_ts)
+            if fflags & self.F_SENSOR_NAME:
+                self._put_str(out, sensor)
+            if fflags & self.F_TRACE:
+                out += self._UINT64.pack(trace_id)
+            if fflags & self.F_MONO:
+                out += self._INT64.pack(send_mono)
+            if fflags & self.F_SEQ:
+                out += self._UINT32.pack(seq)
+        return bytes(out)
+
+    def decode(self, data: bytes):
+        buf = memoryview(data)
+        magic, flags, count = self._HEADER.unpack_from(buf, 0)
+        if magic != self.MAGIC:
+            raise ValueError("not a packed reading payload")
+        pos = self._HEADER.size
+        records = []
+        for _ in range(count):
+            proto, sensor_code, fflags, value = self._RECORD.unpack_from(buf, pos)
+            pos += self._RECORD.size
+            device_id, pos = self._get_str(buf, pos)
+            t, pos = self._get_str(buf, pos)
+            d, pos = self._get_str(buf, pos)
+            r = {
+                "device_id": device_id,
+                "protocol": self._PROTOCOL_NAMES.get(proto, ""),
+                "sensor_type": self._SENSOR_NAMES.get(sensor_code, ""),
+                "value": value,
+                "time": t,
+                "date": d,
+            }
+            if fflags & self.F_HAS_SEND:
+                if fflags & self.F_SEND_INT:
+                    (r["send_ts"],) = self._INT64.unpack_from(buf, pos)
+                    pos += 8
+                else:
+                    r["send_ts"], pos = self._get_str(buf, pos)
+            if fflags & self.F_SENSOR_NAME:
+                r["sensor_type"], pos = self._get_str(buf, pos)
+            if fflags & self.F_TRACE:
+                (r["trace_id"],) = self._UINT64.unpack_from(buf, pos)
+                pos += 8
+            if fflags & self.F_MONO:
+                (r["send_mono_ns"],) = self._INT64.unpack_from(buf, pos)
+                pos += 8
+            if fflags & self.F_SEQ:
+                (r["seq"],) = self._UINT32.unpack_from(buf, pos)
+                pos += 4
+            records.append(r)
+        if flags & self.FLAG_BATCH:
+            return {"batch": records}
+        return records[0]
+
+
+class _JsonCodec:
+    name = "json"
+
+    @staticmethod
+    def encode(obj) -> bytes:
+        return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+    @staticmethod
+    def decode(data: bytes):
+        return json.loads(data)
+
+
+class _CborCodec:
+    name = "cbor"
+
+    def __init__(self):
+        import cbor2
+        self.encode = cbor2.dumps
+        self.decode = cbor2.loads
+
+
+class _MsgpackCodec:
+    name = "msgpack"
+
+    def __init__(self):
+        import msgpack
+        self.encode = msgpack.packb
+        self.decode = msgpack.unpackb
+
+
+_FACTORIES = {"json": _JsonCodec, "cbor": _CborCodec, "msgpack": _MsgpackCodec, "packed": PackedCodec}
+_codecs = {}
+
+
+def get_codec(name: str | None):
+    """Return the codec instance for name (default json).
+
+    cbor and msgpack need the optional cbor2 / msgpack packages.
+    """
+    name = (name or "json").lower()
+    codec = _codecs.get(name)
+    if codec is None:
+        factory = _FACTORIES.get(name)
+        if factory is None:
+            raise ValueError(f"Unknown payload encoding '{name}', expected one of {', '.join(ENCODINGS)}")
+        try:
+            codec = factory()
+        except ImportError as e:
+            raise RuntimeError(f"Payload encoding '{name}' needs an optional package: {e}") from e
+        _codecs[name] = codec
+    return codec
+
+
+def _record(protocol: str, codec_name: str, nbytes: int, encode_ns=0, decode_ns=0):
+    key = (protocol, codec_name)
+    with _lock:
+        s = _stats.get(key)
+        if s is None:
+            s = _stats[key] = [0, 0, 0, 0, 0, 0]
+        if encode_ns:
+            s[0] += 1
+            s[1] += nbytes
+            s[2] += encode_ns
+            s[4] += 1
+        if decode_ns:
+            s[3] += decode_ns
+            s[5] += 1
+
+
+def encode(obj, encoding: str | None, protocol: str = ""):
+    """Encode obj; returns (payload bytes, encode time in microseconds)."""
+    codec = get_codec(encoding)
+    t0 = time.perf_counter_ns()
+    data = codec.encode(obj)
+    elapsed = time.perf_counter_ns() - t0
+    _record(protocol, codec.name, len(data), encode_ns=elapsed or 1)
+    return data, elapsed / 1000.0
+
+
+def decode(data: bytes, encoding: str | None, protocol: str = ""):
+    """Decode data; returns (object, decode time in microseconds)."""
+    codec = get_codec(encoding)
+    t0 = time.perf_counter_ns()
+    obj = codec.decode(data)
+    elapsed = time.perf_counter_ns() - t0
+    _record(protocol, codec.name, len(data), decode_ns=elapsed or 1)
+    return obj, elapsed / 1000.0
+
+
+def stats() -> dict:
+    """Per protocol/encoding totals: messages, bytes on wire and mean encode/decode time (us)."""
+    with _lock:
+        out = {}
+        for (protocol, name), s in _stats.items():
+            out[f"{protocol}/{name}"] = {
+                "messages": s[0],
+                "bytes": s[1],
+                "mean_bytes": s[1] / s[0] if s[0] else None,
+                "mean_encode_us": s[2] / s[4] / 1000.0 if s[4] else None,
+                "mean_decode_us": s[3] / s[5] / 1000.0 if s[5] else None,
+            }
+        return out
@@ -0,0 +1,285 @@
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from collections import deque
+from pathlib import Path
+
+# Opt-in profiling for run_demo.py --profile: a sampling profiler over every thread's Python
+# stack (collapsed-stack output for flamegraph.pl / speedscope), per-thread CPU time,
+# periodic tracemalloc snapshots and wait/hold timing on the shared locks.
+
+
+class TimedLock:
+    """Drop-in wrapper for a threading.Lock that records wait and hold times.
+
+    Waiting is measured from the acquire call to getting the lock (GIL scheduling included),
+    so it shows how long writers queue on choke points such as storage._lock.
+    """
+
+    def __init__(self, lock, name: str):
+        self._lock = lock
+        self.name = name
+        self._stats_lock = threading.Lock()
+        self.acquired = 0
+        self.contended = 0
+        self.wait_ns = 0
+        self.max_wait_ns = 0
+        self.hold_ns = 0
+        self.max_hold_ns = 0
+        self._held_since = 0
+
+    def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+        t0 = time.perf_counter_ns()
+        contended = False
+        got = self._lock.acquire(False)
+        if not got:
+            if not blocking:
+                return False
+            contended = True
+            got = self._lock.acquire(True, timeout)
+            if not got:
+                return False
+        now = time.perf_counter_ns()
+        waited = now - t0
+        self._held_since = now
+        with self._stats_lock:
+            self.acquired += 1
+            self.contended += contended
+            self.wait_ns += waited
+            if waited > self.max_wait_ns:
+                self.max_wait_ns = waited
+        return True
+
+    def release(self):
+        held = time.perf_counter_ns() - self._held_since
+        self._lock.release()
+        with self._stats_lock:
+            self.hold_ns += held
+            if held > self.max_hold_ns:
+                self.max_hold_ns = held
+
+    def locked(self) -> bool:
+        return self._lock.locked()
+
+    __enter__ = acquire
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            n = self.acquired or 1
+            return {
+                "acquired": self.acquired,
+                "contended": self.contended,
+                "wait_ms_total": round(self.wait_ns / 1e6, 3),
+                "wait_ms_mean": round(self.wait_ns / n / 1e6, 4),
+                "wait_ms_max": round(self.max_wait_ns / 1e6, 3),
+                "hold_ms_total": round(self.hold_ns / 1e6, 3),
+                "hold_ms_max": round(self.max_hold_ns / 1e6, 3),
+            }
+
+
+def instrument_lock(module, attr: str = "_lock") -> TimedLock:
+    """Replace module.<attr> with a TimedLock around it (module functions look the lock up per call)."""
+    lock = getattr(module, attr)
+    if isinstance(lock, TimedLock):
+        return lock
+    timed = TimedLock(lock, f"{module.__name__}.{attr}")
+    setattr(module, attr, timed)
+    return timed
+
+
+def _thread_label(name: str) -> str:
+    # short-lived auto-named threads ("Thread-12 (process_request_thread)") share one label
+    return re.sub(r"^Thread-\d+(?= \(|$)", "Thread-*", name)
+
+
+def _thread_cpu_seconds(ident: int):
+    # per-thread CPU clock (POSIX only); None where unsupported
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(ident))
+    except Exception:
+        return None
+
+
+class Profiler:
+    """Samples every thread's stack each interval_ms and snapshots tracemalloc every snapshot_s.
+
+    Writes to output_dir:
+      stacks.collapsed      "thread;module:function;... count" lines for flamegraph tools
+      tracemalloc.txt       top allocation sites (and growth since the last snapshot) per snapshot
+      summary.txt           per-thread samples/CPU time, lock wait/hold, sampler lag, memory
+    The sampler's wake-up lag (how late it runs after its interval) is recorded as a proxy for
+    GIL contention: a thread holding the GIL delays every other thread by the same amount.
+    """
+
+    def __init__(self, output_dir: str = "profile", interval_ms: float = 10, snapshot_s: float = 30,
+                 tracemalloc_frames: int = 1, top: int = 25):
+        self.output_dir = Path(output_dir)
+        self.interval = interval_ms / 1000.0
+        self.snapshot_s = snapshot_s
+        self.tracemalloc_frames = tracemalloc_frames
+        self.top = top
+        self.locks = []
+        self._stacks = {}  # (thread name, code objects root first) -> samples
+        self._thread_samples = {}  # thread name -> samples
+        self._thread_cpu = {}  # thread ident -> [name, first cpu seconds, last cpu seconds]
+        self._lags_ms = deque(maxlen=100000)  # most recent sampler wake-up delays
+        self._samples = 0
+        self._sampler_cpu = 0.0
+        self._stop_event = threading.Event()
+        self._sampler = None
+        self._snapshotter = None
+        self._last_snapshot = None
+        self._snapshots = 0
+        self._started = 0.0
+
+    def add_lock(self, timed: TimedLock):
+        self.locks.append(timed)
+
+    def start(self):
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        (self.output_dir / "tracemalloc.txt").write_text("", encoding="utf-8")
+        if self.tracemalloc_frames and not tracemalloc.is_tracing():
+            tracemalloc.start(self.tracemalloc_frames)
+        self._started = time.perf_counter()
+        self._sampler = threading.Thread(target=self._sample_loop, name="profiler-sampler", daemon=True)
+        self._sampler.start()
+        if self.tracemalloc_frames and self.snapshot_s > 0:
+            self._snapshotter = threading.Thread(target=self._snapshot_loop, name="profiler-tracemalloc", daemon=True)
+            self._snapshotter.start()
+
+    def _sample_loop(self):
+        own = threading.get_ident()
+        names = {}
+        next_at = time.perf_counter() + self.interval
+        while not self._stop_event.is_set():
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            now = time.perf_counter()
+            self._lags_ms.append((now - next_at) * 1000.0)
+            next_at = max(next_at + self.interval, now)
+            frames = sys._current_frames()
+            if len(names) != len(frames) or any(ident not in names for ident in frames):
+                names = {t.ident: _thread_label(t.name) for t in threading.enumerate()}
+            for ident, frame in frames.items():
+                if ident == own:
+                    continue
+                thread = names.get(ident, "unnamed")
+                # code objects only; names are resolved once per distinct stack when writing
+                codes = []
+                while frame is not None:
+                    codes.append(frame.f_code)
+                    frame = frame.f_back
+                key = (thread, tuple(reversed(codes)))
+                self._stacks[key] = self._stacks.get(key, 0) + 1
+                self._thread_samples[thread] = self._thread_samples.get(thread, 0) + 1
+                cpu = _thread_cpu_seconds(ident)
+                if cpu is not None:
+                    entry = self._thread_cpu.get(ident)
+                    if entry is None or entry[0] != thread:
+                        self._thread_cpu[ident] = [thread, cpu, cpu]
+                    else:
+                        entry[2] = cpu
+            self._samples += 1
+        self._sampler_cpu = time.thread_time()
+
+    def _snapshot_loop(self):
+        while not self._stop_event.wait(self.snapshot_s):
+            try:
+                self.snapshot()
+            except Exception as e:
+                print(f"[PROFILER] tracemalloc snapshot failed: {e}")
+
+    def snapshot(self):
+        """Append the top allocation sites (and growth since the previous snapshot) to tracemalloc.txt."""
+        if not tracemalloc.is_tracing():
+            return
+        snap = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        self._snapshots += 1
+        lines = [f"# snapshot {self._snapshots} at +{time.perf_counter() - self._started:.1f}s: "
+                 f"traced {current / 2**20:.1f} MB, peak {peak / 2**20:.1f} MB", "## top sites"]
+        lines += [str(stat) for stat in snap.statistics("lineno")[:self.top]]
+        if self._last_snapshot is not None:
+            lines.append("## growth since previous snapshot")
+            lines += [str(stat) for stat in snap.compare_to(self._last_snapshot, "lineno")[:self.top]]
+        self._last_snapshot = snap
+        with (self.output_dir / "tracemalloc.txt").open("a", encoding="utf-8") as fh:
+            fh.write("\n".join(lines) + "\n\n")
+
+    def stop(self) -> str:
+        """Stop sampling, write the output files and return the summary text."""
+        self._stop_event.set()
+        if self._sampler:
+            self._sampler.join(timeout=2)
+        if self._snapshotter:
+            self._snapshotter.join(timeout=2)
+        try:
+            self.snapshot()
+        except Exception as e:
+            print(f"[PROFILER] tracemalloc snapshot failed: {e}")
+        with (self.output_dir / "stacks.collapsed").open("w", encoding="utf-8") as fh:
+            for line, n in sorted(self._collapsed().items()):
+                fh.write(f"{line} {n}\n")
+        summary = self.summary()
+        (self.output_dir / "summary.txt").write_text(summary, encoding="utf-8")
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        return summary
+
+    def _collapsed(self) -> dict:
+        # "thread;module:function;..." -> samples (different code objects may share a name)
+        names = {}
+        out = {}
+        for (thread, codes), n in self._stacks.items():
+            parts = [thread]
+            for code in codes:
+                name = names.get(code)
+                if name is None:
+                    name = names[code] = f"{Path(code.co_filename).stem}:{code.co_name}"
+                parts.append(name)
+            line = ";".join(parts)
+            out[line] = out.get(line, 0) + n
+        return out
+
+    def summary(self) -> str:
+        elapsed = time.perf_counter() - self._started
+        lines = [f"Profile of {elapsed:.1f}s, {self._samples} samples every {self.interval * 1000:g} ms"]
+        lines.append("Threads (samples, CPU seconds, CPU share of wall time):")
+        cpu = {}
+        for name, first, last in self._thread_cpu.values():
+            cpu[name] = cpu.get(name, 0.0) + last - first
+        for name in sorted(self._thread_samples, key=lambda n: (-cpu.get(n, 0), -self._thread_samples[n])):
+            c = cpu.get(name)
+            share = f"{c / elapsed:6.1%}" if c is not None and elapsed > 0 else "     -"
+            c_text = f"{c:8.2f}" if c is not None else "       -"
+            lines.append(f"  {name:32s} {self._thread_samples[name]:8d} {c_text} {share}")
+        lines.append("Hottest leaf functions (samples over all threads):")
+        leaves = {}
+        for (thread, codes), n in self._stacks.items():
+            leaf = f"{thread}: {Path(codes[-1].co_filename).stem}:{codes[-1].co_name}" if codes else thread
+            leaves[leaf] = leaves.get(leaf, 0) + n
+        for leaf, n in sorted(leaves.items(), key=lambda kv: -kv[1])[:15]:
+            lines.append(f"  {n:8d}  {leaf}")
+        lines.append(f"Profiler overhead: sampler {self._sampler_cpu:.2f} CPU seconds")
+        if self._lags_ms:
+            lags = sorted(self._lags_ms)
+            pick = lambda q: lags[min(len(lags) - 1, int(q * len(lags)))]
+            lines.append(f"Sampler wake-up lag (GIL/scheduler wait) ms: p50 {pick(0.5):.3f}, p99 {pick(0.99):.3f}, "
+                         f"max {lags[-1]:.3f}")
+        for timed in self.locks:
+            s = timed.stats()
+            lines.append(f"Lock {timed.name}: {s['acquired']} acquisitions, {s['contended']} contended, wait mean "
+                         f"{s['wait_ms_mean']} ms / max {s['wait_ms_max']} ms / total {s['wait_ms_total']} ms, "
+                         f"hold max {s['hold_ms_max']} ms / total {s['hold_ms_total']} ms")
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            lines.append(f"Traced memory: {current / 2**20:.1f} MB current, {peak / 2**20:.1f} MB peak")
+        lines.append(f"Files: {self.output_dir / 'stacks.collapsed'}, {self.output_dir / 'tracemalloc.txt'}, "
+                     f"{self.output_dir / 'summary.txt'}")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,154 @@
+import sys
+from dataclasses import dataclass
+from operator import attrgetter, itemgetter
+
+from storage import RECORD_HEADER
+import timestamps
+
+# Output field -> accepted payload keys, in order of preference
+_ALIASES = {
+    "device_id": ("device_id", "id"),
+    "time": ("time", "t"),
+    "date": ("date", "d"),
+    "sensor_type": ("sensor_type", "sensor"),
+    "value": ("value", "val"),
+}
+# Strings repeated on every reading are interned so buffered readings share one copy
+_INTERNED = ("device_id", "protocol", "sensor_type", "encoding")
+# Keys put on the wire by devices (receive-side fields are added by the receiver)
+_WIRE = ("device_id", "protocol", "time", "date", "sensor_type", "value", "send_ts", "send_mono_ns", "seq", "trace_id")
+_MAX_SCHEMAS = 256
+
+
+def _to_float(v):
+    if v is None or isinstance(v, float):
+        return v
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_int(v):
+    if v is None or type(v) is int:
+        return v
+    try:
+        return int(v)
+    except (TypeError, ValueError):
+        return None
+
+
+@dataclass(slots=True)
+class Reading:
+    """One sensor reading as it travels from device to storage.
+
+    Fields mirror storage.RECORD_HEADER plus send_mono_ns (timestamp_mode "ns") and the
+    sampled trace_id; missing optional fields are None. send_ts/receive_ts are int nanoseconds
+    in "ns" mode and ISO strings otherwise.
+    """
+
+    device_id: str = ""
+    time: str = ""
+    date: str = ""
+    protocol: str = ""
+    sensor_type: str = ""
+    value: float | None = None
+    send_ts: int | str | None = None
+    receive_ts: int | str | None = None
+    latency_ms: float | None = None
+    encoding: str | None = None
+    payload_bytes: float | None = None
+    decode_us: float | None = None
+    seq: int | None = None
+    trace_id: int | None = None
+    send_mono_ns: int | None = None
+
+    def stamp_send(self):
+        self.send_ts, self.send_mono_ns = timestamps.send_stamp()
+
+    def stamp_receive(self, recv_ts=None, recv_mono_ns: int | None = None):
+        """Set receive_ts (now unless given) and latency_ms from send_ts."""
+        self.receive_ts = recv_ts if recv_ts is not None else timestamps.now()
+        self.latency_ms = timestamps.latency_ms(self.send_ts, self.send_mono_ns, self.receive_ts, recv_mono_ns)
+
+    def to_row(self) -> list:
+        """Values in storage.RECORD_HEADER order, None as an empty field."""
+        return ["" if v is None else v for v in _row_getter(self)]
+
+    def to_payload(self, batch_item: bool = False) -> dict:
+        """Wire representation for the payload codecs; batch items leave out device_id/protocol."""
+        out = {}
+        for k in (_WIRE[2:] if batch_item else _WIRE):
+            v = getattr(self, k)
+            if v is not None:
+                out[k] = v
+        return out
+
+    @classmethod
+    def from_dict(cls, data: dict, defaults: dict | None = None) -> "Reading":
+        """Build a Reading from a decoded payload or legacy record dict.
+
+        Key aliases are resolved once per payload schema (the tuple of keys) and cached, so
+        each call is a single itemgetter. defaults supplies fields the payload leaves out, e.g.
+        device_id/protocol shared by a batch.
+        """
+        keys = tuple(data)
+        build = _builders.get(keys)
+        if build is None:
+            if len(_builders) >= _MAX_SCHEMAS:
+                _builders.clear()
+            build = _builders[keys] = _compile(keys)
+        kwargs = build(data)
+        if defaults:
+            for k, v in defaults.items():
+                kwargs.setdefault(k, v)
+        kwargs["value"] = _to_float(kwargs.get("value"))
+        if "seq" in kwargs:
+            kwargs["seq"] = _to_int(kwargs["seq"])
+        for k in _INTERNED:
+            v = kwargs.get(k)
+            if type(v) is str:
+                kwargs[k] = sys.intern(v)
+        return cls(**kwargs)
+
+
+_FIELDS = tuple(Reading.__dataclass_fields__)
+_row_getter = attrgetter(*RECORD_HEADER)
+_builders = {}
+
+
+def _compile(keys: tuple):
+    present = set(keys)
+    out_names, in_names = [], []
+    fallbacks = []  # (field, later aliases present in the schema)
+    for field in _FIELDS:
+        sources = [a for a in _ALIASES.get(field, (field,)) if a in present]
+        if sources:
+            out_names.append(field)
+            in_names.append(sources[0])
+            if len(sources) > 1:
+                fallbacks.append((field, tuple(sources[1:])))
+    if not in_names:
+        return lambda data: {}
+    getter = itemgetter(*in_names)
+    if len(in_names) == 1:
+        single = out_names[0]
+        build = lambda data: {single: getter(data)}
+    else:
+        build = lambda data: dict(zip(out_names, getter(data)))
+    if not fallbacks:
+        return build
+
+    def build_with_fallbacks(data):
+        # an empty preferred key falls back to the next non-empty alias, as data.get(a) or data.get(b) did
+        kwargs = build(data)
+        for field, sources in fallbacks:
+            if kwargs[field] is None or kwargs[field] == "":
+                for src in sources:
+                    v = data[src]
+                    if v is not None and v != "":
+                        kwargs[field] = v
+                        break
+        return kwargs
+
+    return build_with_fallbacks
@@ -0,0 +1,302 @@
+import bisect
+import csv
+import math
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from pathlib import Path
+
+from sequence import SeqTracker
+
+# Tumbling-window aggregates per (device_id, protocol, sensor_type) maintained on the gateway
+# path. Only the finest window sees individual readings; coarser windows are built by merging
+# closed finer windows, so every resolution costs one dict update per reading in total.
+
+RESOLUTIONS = (1, 10, 60)
+# Windows kept in memory per resolution (older windows are only in the rollup CSVs)
+RETENTION = {1: 600, 10: 720, 60: 1440}
+DEFAULT_RETENTION = 1440
+# Upper bounds (ms) of the latency histogram buckets used for percentiles: geometric, 20% apart,
+# from 0.05 ms to about 60 s, so interpolated percentiles are within a few percent
+LATENCY_BUCKETS_MS = tuple(round(0.05 * 1.2 ** i, 4) for i in range(78))
+ROLLUP_HEADER = [
+    "window_start",
+    "resolution_s",
+    "device_id",
+    "protocol",
+    "sensor_type",
+    "count",
+    "value_min",
+    "value_max",
+    "value_mean",
+    "latency_count",
+    "latency_mean_ms",
+    "latency_p50_ms",
+    "latency_p95_ms",
+    "latency_p99_ms",
+    "latency_max_ms",
+    "drops",
+    "reordered",
+    "duplicates",
+]
+
+
+def rollup_path(resolution: int, directory: str = "rollups") -> Path:
+    """CSV holding the closed windows of one resolution (e.g. rollups/rollup_60s.csv)."""
+    return Path(directory) / f"rollup_{resolution}s.csv"
+
+
+def _iso(epoch_s: float) -> str:
+    return datetime.fromtimestamp(epoch_s, timezone.utc).replace(tzinfo=None).isoformat()
+
+
+class _Agg:
+    __slots__ = ("count", "values", "total", "vmin", "vmax", "lat_count", "lat_total", "lat_max", "lat_buckets",
+                 "drops", "reordered", "duplicates")
+
+    def __init__(self):
+        self.count = 0
+        self.values = 0
+        self.total = 0.0
+        self.vmin = None
+        self.vmax = None
+        self.lat_count = 0
+        self.lat_total = 0.0
+        self.lat_max = None
+        # one count per LATENCY_BUCKETS_MS bound plus an overflow bucket
+        self.lat_buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.drops = 0
+        self.reordered = 0
+        self.duplicates = 0
+
+    def add(self, value, latency):
+        self.count += 1
+        if value is not None:
+            self.values += 1
+            self.total += value
+            if self.vmin is None or value < self.vmin:
+                self.vmin = value
+            if self.vmax is None or value > self.vmax:
+                self.vmax = value
+        if latency is not None and latency != "":
+            self.lat_count += 1
+            self.lat_total += latency
+            if self.lat_max is None or latency > self.lat_max:
+                self.lat_max = latency
+            self.lat_buckets[bisect.bisect_left(LATENCY_BUCKETS_MS, latency)] += 1
+
+    def merge(self, other: "_Agg"):
+        self.count += other.count
+        self.values += other.values
+        self.total += other.total
+        if other.vmin is not None and (self.vmin is None or other.vmin < self.vmin):
+            self.vmin = other.vmin
+        if other.vmax is not None and (self.vmax is None or other.vmax > self.vmax):
+            self.vmax = other.vmax
+        self.lat_count += other.lat_count
+        self.lat_total += other.lat_total
+        if other.lat_max is not None and (self.lat_max is None or other.lat_max > self.lat_max):
+            self.lat_max = other.lat_max
+        for i, n in enumerate(other.lat_buckets):
+            self.lat_buckets[i] += n
+        self.drops += other.drops
+        self.reordered += other.reordered
+        self.duplicates += other.duplicates
+
+    def percentile(self, q: float):
+        # interpolated inside the bucket holding the q-th latency, capped at the observed maximum
+        if not self.lat_count:
+            return None
+        rank = max(1, math.ceil(q * self.lat_count))
+        cumulative = 0
+        lower = 0.0
+        for bound, n in zip(LATENCY_BUCKETS_MS, self.lat_buckets):
+            if n and cumulative + n >= rank:
+                return round(min(lower + (bound - lower) * (rank - cumulative) / n, self.lat_max), 3)
+            cumulative += n
+            lower = bound
+        return self.lat_max
+
+    def row(self, window_start: float, resolution: int, key: tuple) -> list:
+        lat_mean = round(self.lat_total / self.lat_count, 3) if self.lat_count else None
+        return [
+            _iso(window_start), resolution, *key, self.count, self.vmin, self.vmax,
+            round(self.total / self.values, 4) if self.values else None,
+            self.lat_count, lat_mean, self.percentile(0.5), self.percentile(0.95), self.percentile(0.99), self.lat_max,
+            self.drops, self.reordered, self.duplicates,
+        ]
+
+
+class RollupSink:
+    """Gateway sink keeping tumbling-window rollups at several resolutions (seconds).
+
+    Readings are assigned to windows by the time the gateway handles them. For each window and
+    (device_id, protocol, sensor_type) it keeps count, min/max/mean value, latency mean, max and
+    p50/p95/p99 (from fixed histogram buckets, so windows merge exactly) and, from the sequence
+    numbers, drops (numbers skipped when a device jumps ahead, minus holes filled by late
+    readings in the window they arrive in, which can make that window negative), reordered
+    (holes filled later) and duplicates. Closed windows are appended to rollup_<res>s.csv in directory and the most
+    recent RETENTION[res] windows stay in memory for query(). A ticker thread closes windows
+    while no readings arrive.
+    """
+
+    name = "rollups"
+
+    def __init__(self, directory: str = "rollups", resolutions=RESOLUTIONS, persist: bool = True):
+        self.resolutions = tuple(sorted(int(r) for r in resolutions))
+        if not self.resolutions or self.resolutions[0] < 1:
+            raise ValueError("Rollup resolutions must be whole seconds >= 1")
+        finest = self.resolutions[0]
+        if any(r % finest for r in self.resolutions):
+            raise ValueError(f"Rollup resolutions must be multiples of the finest one ({finest}s)")
+        self.directory = Path(directory)
+        self._lock = threading.Lock()
+        self._open = {}  # key -> _Agg for the finest window being filled
+        self._open_start = None
+        self._pending = {}  # coarser resolution -> (window_start, {key: _Agg})
+        self._history = {r: deque(maxlen=RETENTION.get(r, DEFAULT_RETENTION)) for r in self.resolutions}
+        self._seq = SeqTracker()
+        self._highest = {}  # device_id -> highest seq seen
+        self._files = {}
+        self._writers = {}
+        if persist:
+            # truncate: windows from a previous run would overlap this run's timeline
+            self.directory.mkdir(parents=True, exist_ok=True)
+            for r in self.resolutions:
+                fh = rollup_path(r, self.directory).open("w", newline="", encoding="utf-8")
+                self._files[r] = fh
+                self._writers[r] = csv.writer(fh)
+                self._writers[r].writerow(ROLLUP_HEADER)
+                fh.flush()
+        self._stop_event = threading.Event()
+        self._ticker = threading.Thread(target=self._tick, name="rollup-ticker", daemon=True)
+        self._ticker.start()
+
+    def write(self, batch: list):
+        now = time.time()
+        with self._lock:
+            self._advance(now)
+            aggs = self._open
+            for r in batch:
+                key = (r.device_id, r.protocol, r.sensor_type)
+                agg = aggs.get(key)
+                if agg is None:
+                    agg = aggs[key] = _Agg()
+                agg.add(r.value, r.latency_ms)
+                if r.seq is not None:
+                    self._observe_seq(agg, r.device_id, r.seq)
+
+    def _observe_seq(self, agg: _Agg, device_id: str, seq: int):
+        outcome = self._seq.observe(device_id, seq)
+        if outcome == "new":
+            agg.drops += seq - self._highest.get(device_id, -1) - 1
+            self._highest[device_id] = seq
+        elif outcome == "duplicate":
+            agg.duplicates += 1
+        else:
+            # a hole counted as dropped when the device skipped ahead is filled after all; taking
+            # it back here keeps the summed drops equal to the gateway's lost count
+            agg.reordered += 1
+            agg.drops -= 1
+
+    def _tick(self):
+        while not self._stop_event.wait(self.resolutions[0]):
+            try:
+                with self._lock:
+                    self._advance(time.time())
+            except Exception as e:
+                print(f"[ROLLUPS] Failed to close windows: {e}")
+
+    def _advance(self, now: float):
+        finest = self.resolutions[0]
+        start = now - now % finest
+        if self._open_start is not None and start > self._open_start:
+            self._roll_up(self._open_start, self._open)
+            self._open = {}
+            self._open_start = None
+        if self._open_start is None:
+            self._open_start = start
+        for r in self.resolutions[1:]:
+            pending = self._pending.get(r)
+            if pending is not None and pending[0] + r <= now:
+                self._emit(r, *pending)
+                del self._pending[r]
+
+    def _roll_up(self, start: float, aggs: dict):
+        if not aggs:
+            return
+        self._emit(self.resolutions[0], start, aggs)
+        for r in self.resolutions[1:]:
+            window_start = start - start % r
+            pending = self._pending.get(r)
+            if pending is not None and pending[0] != window_start:
+                self._emit(r, *pending)
+                pending = None
+            if pending is None:
+                pending = self._pending[r] = (window_start, {})
+            merged = pending[1]
+            for key, agg in aggs.items():
+                acc = merged.get(key)
+                if acc is None:
+                    acc = merged[key] = _Agg()
+                acc.merge(agg)
+
+    def _emit(self, resolution: int, start: float, aggs: dict):
+        rows = [agg.row(start, resolution, key) for key, agg in sorted(aggs.items())]
+        self._history[resolution].append((start, rows))
+        writer = self._writers.get(resolution)
+        if writer is not None:
+            writer.writerows(["" if v is None else v for v in row] for row in rows)
+            self._files[resolution].flush()
+
+    def query(self, resolution: int, start: float | None = None, end: float | None = None,
+              device_id: str | None = None, protocol: str | None = None, sensor_type: str | None = None) -> list:
+        """Closed windows of resolution still in memory as dicts (ROLLUP_HEADER keys), oldest first.
+
+        start/end are epoch seconds bounding window starts; the other arguments filter rows.
+        """
+        if resolution not in self._history:
+            raise ValueError(f"No {resolution}s rollup (configured: {', '.join(map(str, self.resolutions))})")
+        with self._lock:
+            windows = list(self._history[resolution])
+        out = []
+        for window_start, rows in windows:
+            if (start is not None and window_start < start) or (end is not None and window_start > end):
+                continue
+            for row in rows:
+                if ((device_id is not None and row[2] != device_id) or (protocol is not None and row[3] != protocol)
+                        or (sensor_type is not None and row[4] != sensor_type)):
+                    continue
+                out.append(dict(zip(ROLLUP_HEADER, row)))
+        return out
+
+    def close(self):
+        """Close the open windows regardless of time, write them and stop the ticker."""
+        self._stop_event.set()
+        self._ticker.join(timeout=2)
+        with self._lock:
+            if self._open_start is not None:
+                self._roll_up(self._open_start, self._open)
+                self._open = {}
+                self._open_start = None
+            for r in self.resolutions[1:]:
+                pending = self._pending.pop(r, None)
+                if pending is not None:
+                    self._emit(r, *pending)
+            for fh in self._files.values():
+                try:
+                    fh.close()
+                except Exception:
+                    pass
+            self._files.clear()
+            self._writers.clear()
+
+
+def load_rollup(resolution: int, directory: str = "rollups") -> list:
+    """Rows of a persisted rollup CSV as dicts (values as strings, empty when unknown)."""
+    path = rollup_path(resolution, directory)
+    if not path.exists():
+        return []
+    with path.open("r", newline="", encoding="utf-8") as fh:
+        return list(csv.DictReader(fh))
@@ -1,231 +1,451 @@
-import csv
-import random
-from pathlib import Path
-import json
-import threading
-import time
-import signal
-import sys
-from datetime import datetime
-
-from collector.mqtt_collector import MqttCollector
-from collector.local_broker import LocalBroker
-from devices.mqtt_device import start_mqtt_device_thread
-from storage import set_output_file
-from storage import initialize_output, initialize_sent_log
-import faults
-from devices.modbus_device import start_modbus_device_thread
-from gateway_modbus_poller import ModbusPoller
-from gateway_coap_server import start_coap_server
-from devices.coap_device import start_coap_device_loop
-
-def initial_data_parser(path_to_file, how_many_rows_to_read):
-    # enforce minimum
-    if how_many_rows_to_read < 100:
-        how_many_rows_to_read = 100
-
-    out_files = {
-        "humidity": Path("parsed_data_humidity_sensors.csv"),
-        "light": Path("parsed_data_light_sensors.csv"),
-        "temperature": Path("parsed_data_temperature_sensors.csv"),
-    }
-
-    # Open writers and write headers (overwrite existing files)
-    writers = {}
-    files = {}
-    try:
-        files["humidity"] = out_files["humidity"].open("w", newline="", encoding="utf-8")
-        files["light"] = out_files["light"].open("w", newline="", encoding="utf-8")
-        files["temperature"] = out_files["temperature"].open("w", newline="", encoding="utf-8")
-
-        writers["humidity"] = csv.writer(files["humidity"])
-        writers["light"] = csv.writer(files["light"])
-        writers["temperature"] = csv.writer(files["temperature"])
-
-        writers["humidity"].writerow(["time", "date", "humidity"])
-        writers["light"].writerow(["time", "date", "light"])
-        writers["temperature"].writerow(["time", "date", "temperature"])
-
-        counts = {"humidity": 0, "light": 0, "temperature": 0}
-        with open(path_to_file, "r", encoding="utf-8") as f:
-            for i, line in enumerate(f):
-                if i >= how_many_rows_to_read:
-                    break
-                line = line.strip()
-                if not line:
-                    continue
-                parts = line.split()
-                # Expected: date, time, epoch, moteid, temperature, humidity, light, voltage
-                if len(parts) < 8:
-                    continue
-                date, time = parts[0], parts[1]
-                moteid = parts[3] # will not use it, progresses to slow (too many records :( )
-                temperature = parts[4]
-                humidity = parts[5]
-                light = parts[6]
-
-                chosen = random.choice(["humidity", "light", "temperature"])
-                if chosen == "humidity":
-                    writers["humidity"].writerow([time, date, humidity])
-                elif chosen == "light":
-                    writers["light"].writerow([time, date, light])
-                else:
-                    writers["temperature"].writerow([time, date, temperature])
-                counts[chosen] += 1
-
-        return counts
-
-    finally:
-        for fh in files.values():
-            try:
-                fh.close()
-            except Exception:
-                pass
-
-def main():
-    # Read configuration from config.json (in the current working directory)
-    config_path = Path("config.json")
-    if not config_path.exists():
-        print("Configuration file 'config.json' not found.")
-        return
-
-    try:
-        with config_path.open("r", encoding="utf-8") as f:
-            cfg = json.load(f)
-    except Exception as e:
-        print("Failed to read config.json:", e)
-        return
-
-    # Required fields
-    path = cfg.get("path_to_data_file")
-    if not path:
-        print("'path_to_data_file' not set in config.json")
-        return
-
-    # rows_to_read (enforce integer and minimum inside parser too)
-    try:
-        rows = int(cfg.get("rows_to_read", 100))
-    except (TypeError, ValueError):
-        rows = 100
-
-    # Read and keep other parameters (MQTT-focused)
-    num_devices_mqtt = cfg.get("num_devices_mqtt")
-    message_interval_mqtt = cfg.get("message_interval_mqtt")
-    mqtt_broker = cfg.get("mqtt_broker")
-    mqtt_topic = cfg.get("mqtt_topic")
-
-    config_summary = {
-        "path_to_data_file": path,
-        "rows_to_read": rows,
-        "num_devices_mqtt": num_devices_mqtt,
-        "message_interval_mqtt": message_interval_mqtt,
-        "mqtt_broker": mqtt_broker,
-        "mqtt_topic": mqtt_topic,
-    }
-
-    print("Loaded configuration:")
-    for k, v in config_summary.items():
-        print(f"  {k}: {v}")
-
-    counts = initial_data_parser(path, rows)
-    print("Parsing finished. Rows written per file:")
-    for k, v in counts.items():
-        print(f"  {k}: {v}")
-
-    # Sensor files map
-    sensor_files = {
-        "humidity": Path("parsed_data_humidity_sensors.csv"),
-        "light": Path("parsed_data_light_sensors.csv"),
-        "temperature": Path("parsed_data_temperature_sensors.csv"),
-    }
-
-    devices = []
-    # MQTT-only flow
-    # initialize/overwrite output CSV so each run starts fresh
-    initialize_output("all_devices_recorded_data.csv")
-    # ensure storage points at the same file
-    set_output_file("all_devices_recorded_data.csv")
-    # start local broker
-    broker_host = mqtt_broker or "localhost"
-    local_broker = LocalBroker(host=broker_host, port=1883)
-    local_broker.start()
-    print(f"Local MQTT broker started at {broker_host}:1883")
-    # Start MQTT collector
-    broker = mqtt_broker or "localhost"
-    topic = mqtt_topic or "iot"
-    mqtt_col = MqttCollector(broker_host=broker, topic=topic)
-    mqtt_col.start()
-    print(f"MQTT collector started and subscribed to topic '{topic}' on {broker}:1883")
-
-    # fault injection params (optional) - apply into the faults module so all devices/pollers see them
-    try:
-        LOSS_RATE = float(cfg.get('loss_rate', 0.0))
-        LATENCY_RANGE = tuple(cfg.get('latency_range', (0, 0)))
-        FAIL_PROB = float(cfg.get('fail_prob', 0.0))
-    except Exception:
-        LOSS_RATE = 0.0
-        LATENCY_RANGE = (0, 0)
-        FAIL_PROB = 0.0
-
-    # propagate configured values into the faults module globals
-    try:
-        faults.LOSS_RATE = LOSS_RATE
-        faults.LATENCY_RANGE = LATENCY_RANGE
-        faults.FAIL_PROB = FAIL_PROB
-        print(f"Applied fault injection settings: LOSS_RATE={faults.LOSS_RATE}, LATENCY_RANGE={faults.LATENCY_RANGE}, FAIL_PROB={faults.FAIL_PROB}")
-    except Exception:
-        # If faults module can't be updated, continue with defaults
-        print('Warning: could not apply fault injection settings to faults module')
-
-    # initialize sent log
-    initialize_sent_log()
-
-    num_mqtt = int(num_devices_mqtt) if num_devices_mqtt else 0
-    for i in range(1, num_mqtt + 1):
-        device_id = "id_device" if i == 1 else f"id_device{i}"
-        t = start_mqtt_device_thread(
-            device_id=device_id,
-            sensor_files=sensor_files,
-            broker_host=broker,
-            topic=topic,
-            fixed_interval=(None if message_interval_mqtt == -1 else int(message_interval_mqtt)),
-        )
-        devices.append(t)
-
-    # start Modbus simulated devices and poller (spawn N devices)
-    modbus_targets = []
-    num_modbus = int(cfg.get('num_devices_modbus', 1))
-    for i in range(1, num_modbus + 1):
-        port = 1501 + i  # start ports at 1502,1503,...
-        device_id = 'modbus1' if i == 1 else f'modbus{i}'
-        start_modbus_device_thread(host='127.0.0.1', port=port, unit_id=1, update_interval=5)
-        modbus_targets.append({'host': '127.0.0.1', 'port': port, 'device_id': device_id})
-    modbus_poller = ModbusPoller(modbus_targets, poll_interval=5)
-    modbus_poller.start()
-
-    # start CoAP gateway server and spawn N CoAP devices
-    coap_server_thread = start_coap_server()
-    num_coap = int(cfg.get('num_devices_coap', 1))
-    coap_device_threads = []
-    for i in range(1, num_coap + 1):
-        device_id = 'coap1' if i == 1 else f'coap{i}'
-        t = start_coap_device_loop('coap://127.0.0.1/gateway', device_id=device_id, sensor_files=None, interval=5)
-        coap_device_threads.append(t)
-
-    print(f"Simulating {num_mqtt} MQTT devices, {num_coap} CoAP devices and {num_modbus} Modbus devices")
-
-    try:
-        while True:
-            time.sleep(1)
-    except KeyboardInterrupt:
-        print("Stopping MQTT devices and collector...")
-        for t in devices:
-            t.stop()
-        for t in devices:
-            t.join()
-        mqtt_col.stop()
-        local_broker.stop()
-        print("Shutdown complete.")
-
-if __name__ == "__main__":
+import argparse
+import csv
+import random
+from pathlib import Path
+import json
+import threading
+import time
+import signal
+import sys
+from datetime import datetime
+
+from storage import set_output_file
+from storage import initialize_output, initialize_sent_log
+import storage
+import faults
+from payload_codec import get_codec
+import metrics
+import gateway
+import tracing
+import timestamps
+from lifecycle import Lifecycle, port_listening
+
+def initial_data_parser(path_to_file, how_many_rows_to_read):
+    # enforce minimum
+    if how_many_rows_to_read < 100:
+        how_many_rows_to_read = 100
+
+    out_files = {
+        "humidity": Path("parsed_data_humidity_sensors.csv"),
+        "light": Path("parsed_data_light_sensors.csv"),
+        "temperature": Path("parsed_data_temperature_sensors.csv"),
+    }
+
+    # Open writers and write headers (overwrite existing files)
+    writers = {}
+    files = {}
+    try:
+        files["humidity"] = out_files["humidity"].open("w", newline="", encoding="utf-8")
+        files["light"] = out_files["light"].open("w", newline="", encoding="utf-8")
+        files["temperature"] = out_files["temperature"].open("w", newline="", encoding="utf-8")
+
+        writers["humidity"] = csv.writer(files["humidity"])
+        writers["light"] = csv.writer(files["light"])
+        writers["temperature"] = csv.writer(files["temperature"])
+
+        writers["humidity"].writerow(["time", "date", "humidity"])
+        writers["light"].writerow(["time", "date", "light"])
+        writers["temperature"].writerow(["time", "date", "temperature"])
+
+        counts = {"humidity": 0, "light": 0, "temperature": 0}
+        with open(path_to_file, "r", encoding="utf-8") as f:
+            for i, line in enumerate(f):
+                if i >= how_many_rows_to_read:
+                    break
+                line = line.strip()
+                if not line:
+                    continue
+                parts = line.split()
+                # Expected: date, time, epoch, moteid, temperature, humidity, light, voltage
+                if len(parts) < 8:
+                    continue
+                date, time = parts[0], parts[1]
+                moteid = parts[3] # will not use it, progresses to slow (too many records :( )
+                temperature = parts[4]
+                humidity = parts[5]
+                light = parts[6]
+
+                chosen = random.choice(["humidity", "light", "temperature"])
+                if chosen == "humidity":
+                    writers["humidity"].writerow([time, date, humidity])
+                elif chosen == "light":
+                    writers["light"].writerow([time, date, light])
+                else:
+                    writers["temperature"].writerow([time, date, temperature])
+                counts[chosen] += 1
+
+        return counts
+
+    finally:
+        for fh in files.values():
+            try:
+                fh.close()
+            except Exception:
+                pass
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the IoT protocol simulation configured in config.json.")
+    parser.add_argument("--profile", action="store_true",
+                        help="sample all thread stacks, snapshot tracemalloc and time the shared locks")
+    parser.add_argument("--profile-dir", default="profile", help="output directory for --profile")
+    parser.add_argument("--profile-interval-ms", type=float, default=10, help="stack sampling interval")
+    parser.add_argument("--profile-snapshot-s", type=float, default=30, help="seconds between tracemalloc snapshots")
+    args = parser.parse_args(argv)
+
+    # Read configuration from config.json (in the current working directory)
+    config_path = Path("config.json")
+    if not config_path.exists():
+        print("Configuration file 'config.json' not found.")
+        return
+
+    try:
+        with config_path.open("r", encoding="utf-8") as f:
+            cfg = json.load(f)
+    except Exception as e:
+        print("Failed to read config.json:", e)
+        return
+
+    # Required fields
+    path = cfg.get("path_to_data_file")
+    if not path:
+        print("'path_to_data_file' not set in config.json")
+        return
+
+    # rows_to_read (enforce integer and minimum inside parser too)
+    try:
+        rows = int(cfg.get("rows_to_read", 100))
+    except (TypeError, ValueError):
+        rows = 100
+
+    # Read and keep other parameters (MQTT-focused)
+    num_devices_mqtt = cfg.get("num_devices_mqtt")
+    message_interval_mqtt = cfg.get("message_interval_mqtt")
+    mqtt_broker = cfg.get("mqtt_broker")
+    mqtt_topic = cfg.get("mqtt_topic")
+    mqtt_qos = int(cfg.get("mqtt_qos", 0))
+    # per-device override: {"id_device2": 1, ...} or a list in device order (null = mqtt_qos)
+    mqtt_device_qos = cfg.get("mqtt_device_qos") or {}
+    mqtt_batch_size = int(cfg.get("mqtt_batch_size", 1))
+    mqtt_batch_ms = int(cfg.get("mqtt_batch_ms", 0))
+    mqtt_max_inflight = int(cfg.get("mqtt_max_inflight", 20))
+    mqtt_encoding = cfg.get("mqtt_encoding", "json")
+    coap_encoding = cfg.get("coap_encoding", "json")
+    # fail early on unknown encodings or missing optional codec packages
+    try:
+        get_codec(mqtt_encoding)
+        get_codec(coap_encoding)
+    except (ValueError, RuntimeError) as e:
+        print("Invalid payload encoding in config.json:", e)
+        return
+    # "iso" keeps the original ISO-8601 strings, "ns" carries integer nanoseconds end to end
+    timestamp_mode = cfg.get("timestamp_mode", "iso")
+    try:
+        timestamps.set_mode(timestamp_mode)
+    except ValueError as e:
+        print("Invalid timestamp_mode in config.json:", e)
+        return
+
+    config_summary = {
+        "path_to_data_file": path,
+        "rows_to_read": rows,
+        "num_devices_mqtt": num_devices_mqtt,
+        "message_interval_mqtt": message_interval_mqtt,
+        "mqtt_broker": mqtt_broker,
+        "mqtt_topic": mqtt_topic,
+        "mqtt_qos": mqtt_qos,
+        "mqtt_device_qos": mqtt_device_qos or None,
+        "mqtt_batch_size": mqtt_batch_size,
+        "mqtt_batch_ms": mqtt_batch_ms,
+        "mqtt_encoding": mqtt_encoding,
+        "coap_encoding": coap_encoding,
+        "timestamp_mode": timestamp_mode,
+    }
+
+    print("Loaded configuration:")
+    for k, v in config_summary.items():
+        print(f"  {k}: {v}")
+
+    counts = initial_data_parser(path, rows)
+    print("Parsing finished. Rows written per file:")
+    for k, v in counts.items():
+        print(f"  {k}: {v}")
+
+    # Sensor files map
+    sensor_files = {
+        "humidity": Path("parsed_data_humidity_sensors.csv"),
+        "light": Path("parsed_data_light_sensors.csv"),
+        "temperature": Path("parsed_data_temperature_sensors.csv"),
+    }
+
+    # optional profiling; started before any component so every thread and lock use is seen
+    profiler = None
+    if args.profile:
+        import profiling
+        profiler = profiling.Profiler(args.profile_dir, interval_ms=args.profile_interval_ms,
+                                      snapshot_s=args.profile_snapshot_s)
+        profiler.add_lock(profiling.instrument_lock(storage))
+        profiler.add_lock(profiling.instrument_lock(faults))
+        profiler.start()
+        print(f"Profiling into {args.profile_dir}/ (stack samples every {args.profile_interval_ms:g} ms)")
+    # MQTT-only flow
+    # optional segmented output: rotate by age/size, keep a manifest, expire and gzip old segments
+    storage.configure_segments(
+        segment_seconds=float(cfg.get("storage_segment_seconds", 0)),
+        segment_bytes=int(cfg.get("storage_segment_bytes", 0)),
+        retention_segments=int(cfg.get("storage_retention_segments", 0)),
+        retention_seconds=float(cfg.get("storage_retention_seconds", 0)),
+        compress=bool(cfg.get("storage_compress", False)),
+    )
+    # initialize/overwrite output CSV so each run starts fresh
+    initialize_output("all_devices_recorded_data.csv")
+    # ensure storage points at the same file
+    set_output_file("all_devices_recorded_data.csv")
+    # fault injection params (optional) - apply into the faults module so all devices/pollers see them
+    try:
+        LOSS_RATE = float(cfg.get('loss_rate', 0.0))
+        LATENCY_RANGE = tuple(cfg.get('latency_range', (0, 0)))
+        FAIL_PROB = float(cfg.get('fail_prob', 0.0))
+    except Exception:
+        LOSS_RATE = 0.0
+        LATENCY_RANGE = (0, 0)
+        FAIL_PROB = 0.0
+
+    # propagate configured values into the faults module globals
+    try:
+        faults.LOSS_RATE = LOSS_RATE
+        faults.LATENCY_RANGE = LATENCY_RANGE
+        faults.FAIL_PROB = FAIL_PROB
+        print(f"Applied fault injection settings: LOSS_RATE={faults.LOSS_RATE}, LATENCY_RANGE={faults.LATENCY_RANGE}, FAIL_PROB={faults.FAIL_PROB}")
+    except Exception:
+        # If faults module can't be updated, continue with defaults
+        print('Warning: could not apply fault injection settings to faults module')
+
+    # the sent log is optional: PDR, loss and duplicates come from the sequence numbers
+    storage.SENT_LOG_ENABLED = bool(cfg.get("sent_log_enabled", True))
+    if storage.SENT_LOG_ENABLED:
+        initialize_sent_log()
+
+    # optional per-message stage tracing (sampled)
+    trace_rate = float(cfg.get("trace_sample_rate", 0.0))
+    trace_path = tracing.initialize(trace_rate)
+    if trace_rate > 0:
+        print(f"Tracing {trace_rate:.1%} of messages into {trace_path}")
+
+    # optional Prometheus endpoint; instruments are always updated, serving them is opt-in
+    if cfg.get("metrics_enabled"):
+        metrics_host = cfg.get("metrics_host", "127.0.0.1")
+        metrics_port = int(cfg.get("metrics_port", 9100))
+        try:
+            metrics.start_http_server(metrics_host, metrics_port)
+            print(f"Metrics endpoint at http://{metrics_host}:{metrics_port}/metrics")
+        except Exception as e:
+            print(f"Warning: could not start metrics endpoint: {e}")
+
+    # optional columnar copy of the recorded data (Parquet part files, needs pyarrow)
+    if cfg.get("columnar_enabled"):
+        from sinks import ColumnarSink
+        try:
+            columnar_dir = cfg.get("columnar_dir", "recorded_parquet")
+            gateway.add_sink(ColumnarSink(columnar_dir, row_group_rows=int(cfg.get("columnar_rows", 10000))))
+            print(f"Writing columnar copy of recorded data to {columnar_dir}/")
+        except Exception as e:
+            print(f"Warning: could not enable columnar storage: {e}")
+
+    # tumbling-window rollups (count, value, latency percentiles, drops) persisted next to the raw data
+    if cfg.get("rollups_enabled", True):
+        from rollups import RollupSink
+        try:
+            rollups_dir = cfg.get("rollups_dir", "rollups")
+            gateway.add_sink(RollupSink(rollups_dir, resolutions=cfg.get("rollup_resolutions", [1, 10, 60])))
+            print(f"Writing rollups to {rollups_dir}/")
+        except Exception as e:
+            print(f"Warning: could not enable rollups: {e}")
+
+    # optional browser dashboard fed with incremental aggregates over server-sent events
+    if cfg.get("dashboard_enabled"):
+        from dashboard import start_dashboard
+        dashboard_host = cfg.get("dashboard_host", "127.0.0.1")
+        dashboard_port = int(cfg.get("dashboard_port", 8050))
+        try:
+            stream = start_dashboard(dashboard_host, dashboard_port,
+                                     refresh_ms=int(cfg.get("dashboard_refresh_ms", 500)),
+                                     max_points=int(cfg.get("dashboard_max_points", 50)))
+            gateway.add_sink(stream)
+            print(f"Dashboard at http://{dashboard_host}:{dashboard_port}/")
+        except Exception as e:
+            print(f"Warning: could not start dashboard: {e}")
+
+    num_mqtt = int(num_devices_mqtt) if num_devices_mqtt else 0
+    num_modbus = int(cfg.get('num_devices_modbus', 1))
+    num_coap = int(cfg.get('num_devices_coap', 1))
+    modbus_ports = [1501 + i for i in range(1, num_modbus + 1)]  # start ports at 1502,1503,...
+    broker = mqtt_broker or "localhost"
+    topic = mqtt_topic or "iot"
+
+    def _device_qos(i, device_id):
+        if isinstance(mqtt_device_qos, dict):
+            qos = mqtt_device_qos.get(device_id)
+        else:
+            qos = mqtt_device_qos[i - 1] if i <= len(mqtt_device_qos) else None
+        return mqtt_qos if qos is None else int(qos)
+
+    mqtt_device_ids = ["id_device" if i == 1 else f"id_device{i}" for i in range(1, num_mqtt + 1)]
+    # the collector subscribes at QoS 1 when any device publishes above QoS 0
+    collector_qos = min(max([_device_qos(i, d) for i, d in enumerate(mqtt_device_ids, start=1)], default=mqtt_qos), 1)
+
+    # Every protocol stack is a component: imported only when it has devices, started as soon as
+    # its dependencies are ready (stacks in parallel) and stopped in reverse order on shutdown.
+    lifecycle = Lifecycle()
+
+    def _stop_threads(threads):
+        for t in threads:
+            t.stop()
+        for t in threads:
+            t.join(timeout=5)
+
+    # port each device connects to; the network emulator replaces them with its listen ports
+    device_ports = {port: port for port in [1883, 5683] + modbus_ports}
+    device_deps = []
+    # optional transport-level network emulator between devices and broker/gateway/Modbus servers
+    if cfg.get('netem_enabled'):
+        def _start_netem():
+            from netem import build_proxy
+            proxy, port_map = build_proxy(cfg, tcp_ports=[1883] + modbus_ports, udp_ports=[5683])
+            proxy.start()
+            device_ports.update(port_map)
+            print(f"Network emulator started: {', '.join(f'{p}->{t}' for t, p in port_map.items())}")
+            return proxy
+
+        lifecycle.add("netem", _start_netem, stop=lambda proxy: proxy.stop())
+        device_deps.append("netem")
+
+    if num_mqtt > 0:
+        def _start_broker():
+            from collector.local_broker import LocalBroker
+            local_broker = LocalBroker(host=broker, port=1883)
+            local_broker.start()
+            metrics.BROKER_CLIENT_MESSAGES.set_function(lambda: {
+                (cid, direction): c[f"msgs_{direction}"]
+                for cid, c in local_broker.stats().get("clients", {}).items()
+                for direction in ("in", "out")
+            })
+            print(f"Local MQTT broker started at {broker}:1883")
+            return local_broker
+
+        def _start_collector():
+            from collector.mqtt_collector import MqttCollector
+            mqtt_col = MqttCollector(broker_host=broker, topic=topic, qos=collector_qos, encoding=mqtt_encoding)
+            mqtt_col.start()
+            print(f"MQTT collector started and subscribed to topic '{topic}' on {broker}:1883")
+            return mqtt_col
+
+        def _stop_collector(mqtt_col):
+            # devices are already stopped; persist what the broker still delivers
+            mqtt_col.drain()
+            mqtt_col.stop()
+
+        def _start_mqtt_devices():
+            from devices.mqtt_device import start_mqtt_device_thread
+            threads = []
+            for i, device_id in enumerate(mqtt_device_ids, start=1):
+                threads.append(start_mqtt_device_thread(
+                    device_id=device_id,
+                    sensor_files=sensor_files,
+                    broker_host=broker,
+                    topic=topic,
+                    fixed_interval=(None if message_interval_mqtt == -1 else int(message_interval_mqtt)),
+                    broker_port=device_ports[1883],
+                    qos=_device_qos(i, device_id),
+                    batch_size=mqtt_batch_size,
+                    batch_ms=mqtt_batch_ms,
+                    max_inflight=mqtt_max_inflight,
+                    encoding=mqtt_encoding,
+                ))
+            return threads
+
+        lifecycle.add("mqtt-broker", _start_broker, stop=lambda b: b.stop(), ready=lambda b: port_listening(1883, broker))
+        # ready once the broker acknowledged the subscription, so no early reading is missed
+        lifecycle.add("mqtt-collector", _start_collector, stop=_stop_collector, ready=lambda c: c.wait_ready(0),
+                      depends=["mqtt-broker"])
+        lifecycle.add("mqtt-devices", _start_mqtt_devices, stop=_stop_threads,
+                      ready=lambda threads: all(t.connected() for t in threads), depends=["mqtt-collector"] + device_deps)
+
+    if num_modbus > 0:
+        def _start_modbus_devices():
+            from devices.modbus_device import start_modbus_device_thread
+            return [start_modbus_device_thread(host='127.0.0.1', port=port, unit_id=1, update_interval=5)
+                    for port in modbus_ports]
+
+        def _start_modbus_poller():
+            from gateway_modbus_poller import ModbusPoller
+            modbus_targets = []
+            for i, port in enumerate(modbus_ports, start=1):
+                device_id = 'modbus1' if i == 1 else f'modbus{i}'
+                modbus_targets.append({'host': '127.0.0.1', 'port': device_ports[port], 'device_id': device_id})
+            modbus_poller = ModbusPoller(modbus_targets, poll_interval=5)
+            modbus_poller.start()
+            return modbus_poller
+
+        # wait_ready raises if a server could not bind its port
+        lifecycle.add("modbus-devices", _start_modbus_devices, stop=_stop_threads,
+                      ready=lambda threads: all(t.wait_ready(0) for t in threads))
+        # stopping the poller lets the current cycle finish and hand its batch to the gateway
+        lifecycle.add("modbus-poller", _start_modbus_poller, stop=lambda poller: _stop_threads([poller]),
+                      depends=["modbus-devices"] + device_deps)
+
+    if num_coap > 0:
+        def _start_coap_gateway():
+            from gateway_coap_server import start_coap_server
+            # returns once the UDP socket is bound
+            return start_coap_server(encoding=coap_encoding)
+
+        def _start_coap_devices():
+            from devices.coap_device import start_coap_device_loop
+            threads = []
+            for i in range(1, num_coap + 1):
+                device_id = 'coap1' if i == 1 else f'coap{i}'
+                threads.append(start_coap_device_loop(f'coap://127.0.0.1:{device_ports[5683]}/gateway', device_id=device_id,
+                                                      sensor_files=None, interval=5, encoding=coap_encoding))
+            return threads
+
+        lifecycle.add("coap-gateway", _start_coap_gateway, stop=lambda server: server.stop())
+        lifecycle.add("coap-devices", _start_coap_devices, stop=_stop_threads, depends=["coap-gateway"] + device_deps)
+
+    # SIGTERM (e.g. experiments.py terminating the run) shuts down as gracefully as Ctrl+C
+    stop_requested = threading.Event()
+    try:
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop_requested.set())
+    except (ValueError, AttributeError):
+        pass  # not the main thread or no SIGTERM on this platform
+
+    # one try/finally around start-up and the wait, so Ctrl+C at any point still stops every
+    # component that came up and flushes what was recorded
+    try:
+        started = lifecycle.start_all()
+        print("Startup (ms):")
+        print(lifecycle.report())
+        if started:
+            print(f"Simulating {num_mqtt} MQTT devices, {num_coap} CoAP devices and {num_modbus} Modbus devices")
+            while not stop_requested.wait(1):
+                pass
+        else:
+            print("A required component failed to start, shutting down.")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print("Stopping devices, draining collectors and closing storage...")
+        lifecycle.stop_all()
+        gateway.close()
+        storage.close()
+        tracing.flush()
+        print("Sequence statistics per device (expected / unique / lost / duplicates / out of order):")
+        for dev, s in sorted(gateway.sequences.stats().items()):
+            print(f"  {dev}: {s['expected']} / {s['unique']} / {s['lost']} / {s['duplicates']} / {s['out_of_order']}")
+        print("Component timings (ms):")
+        print(lifecycle.report())
+        if profiler:
+            print(profiler.stop(), end="")
+        print("Shutdown complete.")
+
+if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,240 @@
+import csv
+import gzip
+import json
+import queue
+import shutil
+import threading
+import time
+from pathlib import Path
+
+# A segmented log replaces one ever-growing CSV with <stem>_segments/<stem>-NNNNN.csv files plus
+# a manifest.json describing each segment, so readers can pick segments by time or device
+# and old ones can be deleted or compressed while the run continues.
+
+
+class SegmentedLog:
+    """Append-only CSV split into segments rotated by age and/or size.
+
+    time_field and device_field name the columns summarised per segment in the manifest
+    (min/max time, devices, row count). Callers serialise write() calls (storage holds its
+    lock). The active segment's manifest entry is refreshed at most every manifest_interval
+    seconds while rows arrive, so readers (and a run that exits uncleanly) see current data.
+    Closed segments beyond retention_segments, or closed more than retention_seconds
+    ago, are deleted; with compress=True a background thread gzips closed segments.
+    """
+
+    def __init__(self, path, header: list, time_field: str, device_field: str = "device_id",
+                 segment_seconds: float = 0, segment_bytes: int = 0, retention_segments: int = 0,
+                 retention_seconds: float = 0, compress: bool = False, manifest_interval: float = 1.0):
+        path = Path(path)
+        self.stem = path.stem
+        self.directory = path.parent / f"{path.stem}_segments"
+        self.header = header
+        self._time_idx = header.index(time_field)
+        self._device_idx = header.index(device_field)
+        self.segment_seconds = segment_seconds
+        self.segment_bytes = segment_bytes
+        self.retention_segments = retention_segments
+        self.retention_seconds = retention_seconds
+        self.manifest_interval = manifest_interval
+        self._manifest_written = 0.0
+        self._manifest_lock = threading.Lock()
+        self._segments = []  # manifest entries, oldest first
+        self._fh = None
+        self._writer = None
+        self._active = None
+        self._devices = set()
+        self._opened_at = 0.0
+        self._compact_queue = None
+        self._compactor = None
+        if compress:
+            self._compact_queue = queue.Queue()
+            self._compactor = threading.Thread(target=self._compact_loop, name=f"compactor-{self.stem}", daemon=True)
+            self._compactor.start()
+        # segments and manifest left by a previous run are discarded
+        if self.directory.exists():
+            shutil.rmtree(self.directory)
+        self.directory.mkdir(parents=True)
+        self._open_segment()
+
+    @property
+    def manifest_path(self) -> Path:
+        return self.directory / "manifest.json"
+
+    def _open_segment(self):
+        number = self._segments[-1]["number"] + 1 if self._segments else 1
+        name = f"{self.stem}-{number:05d}.csv"
+        self._fh = (self.directory / name).open("w", newline="", encoding="utf-8")
+        self._writer = csv.writer(self._fh)
+        self._writer.writerow(self.header)
+        self._opened_at = time.time()
+        self._devices = set()
+        self._active = {"number": number, "file": name, "rows": 0, "bytes": 0, "min_time": None, "max_time": None,
+                        "devices": [], "opened": self._opened_at, "closed": None, "compressed": False}
+        with self._manifest_lock:
+            self._segments.append(self._active)
+            self._write_manifest()
+
+    def _due(self) -> bool:
+        if self.segment_seconds and time.time() - self._opened_at >= self.segment_seconds:
+            return True
+        return bool(self.segment_bytes) and self._active["bytes"] >= self.segment_bytes
+
+    def write(self, rows: list):
+        if not rows:
+            return
+        if self._active["rows"] and self._due():
+            self.rotate()
+        self._writer.writerows(rows)
+        self._fh.flush()
+        seg = self._active
+        seg["rows"] += len(rows)
+        seg["bytes"] = self._fh.tell()
+        times = [r[self._time_idx] for r in rows if r[self._time_idx] != ""]
+        if times:
+            lo, hi = min(times), max(times)
+            if seg["min_time"] is None or lo < seg["min_time"]:
+                seg["min_time"] = lo
+            if seg["max_time"] is None or hi > seg["max_time"]:
+                seg["max_time"] = hi
+        with self._manifest_lock:
+            self._devices.update(r[self._device_idx] for r in rows)
+            if time.time() - self._manifest_written >= self.manifest_interval:
+                self._write_manifest()
+
+    def _close_active(self):
+        self._fh.close()
+        seg = self._active
+        with self._manifest_lock:
+            seg["devices"] = sorted(self._devices)
+            seg["closed"] = time.time()
+        return seg
+
+    def rotate(self):
+        """Close the active segment, apply retention and start a new segment."""
+        seg = self._close_active()
+        if self._compact_queue is not None:
+            self._compact_queue.put(seg)
+        self._apply_retention()
+        self._open_segment()
+
+    def _apply_retention(self):
+        now = time.time()
+        with self._manifest_lock:
+            closed = [s for s in self._segments if s["closed"] is not None]
+            expired = []
+            if self.retention_segments and len(closed) > self.retention_segments:
+                expired = closed[:len(closed) - self.retention_segments]
+            if self.retention_seconds:
+                expired += [s for s in closed if now - s["closed"] > self.retention_seconds and s not in expired]
+            for seg in expired:
+                self._segments.remove(seg)
+                seg["deleted"] = True
+                try:
+                    (self.directory / seg["file"]).unlink()
+                except FileNotFoundError:
+                    pass
+            self._write_manifest()
+
+    def _write_manifest(self):
+        # write-then-rename so readers never see a half-written manifest (caller holds _manifest_lock)
+        if self._active is not None and self._active["closed"] is None:
+            self._active["devices"] = sorted(self._devices)
+        tmp = self.manifest_path.with_suffix(".tmp")
+        tmp.write_text(json.dumps({"header": self.header, "segments": self._segments}, indent=1), encoding="utf-8")
+        tmp.replace(self.manifest_path)
+        self._manifest_written = time.time()
+
+    def _compact_loop(self):
+        while True:
+            seg = self._compact_queue.get()
+            if seg is None:
+                return
+            src = self.directory / seg["file"]
+            if seg.get("deleted") or not src.exists():
+                continue
+            dst = src.with_name(src.name + ".gz")
+            try:
+                with src.open("rb") as fin, gzip.open(dst, "wb", compresslevel=6) as fout:
+                    shutil.copyfileobj(fin, fout)
+                with self._manifest_lock:
+                    if seg.get("deleted"):
+                        dst.unlink()
+                        continue
+                    seg["file"] = dst.name
+                    seg["compressed"] = True
+                    seg["compressed_bytes"] = dst.stat().st_size
+                    self._write_manifest()
+                src.unlink()
+            except Exception as e:
+                print(f"[STORAGE] Failed to compact {src.name}: {e}")
+
+    def segment_files(self, start=None, end=None, devices=None) -> list:
+        """Paths of segments overlapping [start, end] (compared like the time column) and devices."""
+        with self._manifest_lock:
+            segments = [dict(s) for s in self._segments]
+            if self._fh is not None:
+                segments[-1]["devices"] = sorted(self._devices)
+        return [self.directory / s["file"] for s in select_segments(segments, start, end, devices)]
+
+    def close(self):
+        """Close the active segment, write the final manifest and finish pending compaction."""
+        if self._fh is None:
+            return
+        seg = self._close_active()
+        self._fh = None
+        with self._manifest_lock:
+            self._write_manifest()
+        if self._compact_queue is not None:
+            if seg["rows"]:
+                self._compact_queue.put(seg)
+            self._compact_queue.put(None)
+            self._compactor.join(timeout=30)
+
+
+def select_segments(segments: list, start=None, end=None, devices=None) -> list:
+    """Manifest entries that may hold rows in [start, end] for any of devices (None = no filter).
+
+    A segment that is still open (or was never closed because the run exited uncleanly) may hold
+    more rows than its entry records, so it is always selected.
+    """
+    wanted = set(devices) if devices else None
+    out = []
+    for s in segments:
+        if s["closed"] is None:
+            out.append(s)
+            continue
+        if not s["rows"]:
+            continue
+        if start is not None and s["max_time"] is not None and s["max_time"] < start:
+            continue
+        if end is not None and s["min_time"] is not None and s["min_time"] > end:
+            continue
+        if wanted is not None and not wanted.intersection(s["devices"]):
+            continue
+        out.append(s)
+    return out
+
+
+def read_manifest(path) -> list:
+    """Segment entries for the segmented log of path (e.g. all_devices_recorded_data.csv), oldest first."""
+    path = Path(path)
+    manifest = path.parent / f"{path.stem}_segments" / "manifest.json"
+    if not manifest.exists():
+        return []
+    return json.loads(manifest.read_text(encoding="utf-8"))["segments"]
+
+
+def segment_paths(path, start=None, end=None, devices=None) -> list:
+    """Files of the segmented log of path that may hold rows for [start, end] and devices."""
+    path = Path(path)
+    directory = path.parent / f"{path.stem}_segments"
+    return [directory / s["file"] for s in select_segments(read_manifest(path), start, end, devices)]
+
+
+def open_segment(path):
+    """Open a segment file for reading as text, transparently decompressing .gz segments."""
+    path = Path(path)
+    if path.suffix == ".gz":
+        return gzip.open(path, "rt", newline="", encoding="utf-8")
+    return path.open("r", newline="", encoding="utf-8")
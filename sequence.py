@@ -0,0 +1,119 @@
+import threading
+
+# Devices number their readings 0, 1, 2, ... per run (dropped readings still consume a number),
+# so the gateway can tell loss, duplicates and reordering apart without the sent log.
+
+
+class _DeviceSeq:
+    __slots__ = ("highest", "bitmap", "received", "unique", "duplicates", "out_of_order", "late", "run")
+
+    def __init__(self, window: int):
+        self.highest = -1
+        # bit i set = sequence (highest - i) was received; numbers before 0 count as received
+        self.bitmap = (1 << window) - 1
+        self.received = 0
+        self.unique = 0
+        self.duplicates = 0
+        self.out_of_order = 0
+        self.late = 0  # arrived after leaving the window; assumed not to be a duplicate
+        self.run = 0  # length of the missing run that is sliding out of the window
+
+
+class SeqTracker:
+    """Online per-device sequence accounting over a sliding bitmap.
+
+    Each device keeps the highest sequence seen and a window-bit Python int recording which
+    of the last `window` numbers arrived, so a reading is classified in O(1): new, duplicate,
+    out of order (a hole being filled) or late (older than the window). Missing numbers that
+    slide out of the window are final and are counted into the gap-length histogram.
+    """
+
+    def __init__(self, window: int = 1024):
+        self.window = window
+        self._mask = (1 << window) - 1
+        self._devices = {}
+        self._gaps = {}  # device_id -> {gap length: count}
+        self._lock = threading.Lock()
+
+    def observe(self, device_id: str, seq: int) -> str:
+        """Record seq for device_id; returns "new", "duplicate", "out_of_order" or "late"."""
+        with self._lock:
+            d = self._devices.get(device_id)
+            if d is None:
+                d = self._devices[device_id] = _DeviceSeq(self.window)
+            d.received += 1
+            offset = d.highest - seq
+            if offset < 0:
+                self._advance(device_id, d, -offset)
+                d.highest = seq
+                d.unique += 1
+                return "new"
+            if offset >= self.window:
+                d.late += 1
+                d.unique += 1
+                return "late"
+            bit = 1 << offset
+            if d.bitmap & bit:
+                d.duplicates += 1
+                return "duplicate"
+            d.bitmap |= bit
+            d.out_of_order += 1
+            d.unique += 1
+            return "out_of_order"
+
+    def _advance(self, device_id, d: _DeviceSeq, shift: int):
+        shifted = (d.bitmap << shift) | 1
+        leaving = shifted >> self.window
+        d.bitmap = shifted & self._mask
+        # walk the old window bits leaving it from oldest to newest, closing runs of zeros
+        for i in range(shift - 1, max(shift - self.window, 0) - 1, -1):
+            if (leaving >> i) & 1:
+                if d.run:
+                    gaps = self._gaps.setdefault(device_id, {})
+                    gaps[d.run] = gaps.get(d.run, 0) + 1
+                    d.run = 0
+            else:
+                d.run += 1
+        if shift > self.window:
+            # numbers that skipped over the window entirely were never received
+            d.run += shift - self.window
+
+    def _open_gaps(self, d: _DeviceSeq) -> dict:
+        # missing runs still inside the window (a late arrival may yet fill them)
+        gaps = {}
+        run = d.run
+        for i in range(self.window - 1, -1, -1):
+            if (d.bitmap >> i) & 1:
+                if run:
+                    gaps[run] = gaps.get(run, 0) + 1
+                    run = 0
+            else:
+                run += 1
+        return gaps
+
+    def stats(self) -> dict:
+        """Per device: expected, received, unique, lost, duplicates, out_of_order, late, pdr and gaps."""
+        with self._lock:
+            out = {}
+            for device_id, d in self._devices.items():
+                expected = d.highest + 1
+                gaps = dict(self._gaps.get(device_id, {}))
+                for length, n in self._open_gaps(d).items():
+                    gaps[length] = gaps.get(length, 0) + n
+                out[device_id] = {
+                    "expected": expected,
+                    "received": d.received,
+                    "unique": d.unique,
+                    "lost": max(expected - d.unique, 0),
+                    "duplicates": d.duplicates,
+                    "out_of_order": d.out_of_order,
+                    "late": d.late,
+                    "pdr": d.unique / expected if expected else None,
+                    "gaps": dict(sorted(gaps.items())),
+                }
+            return out
+
+    def reset(self):
+        with self._lock:
+            self._devices.clear()
+            self._gaps.clear()
@@ -0,0 +1,97 @@
+import threading
+from pathlib import Path
+
+from storage import RECORD_HEADER, save_many
+from metrics import GATEWAY_MESSAGES
+import timestamps
+
+# Gateway sinks receive whole batches of normalised records through write(batch); close()
+# is called at shutdown. Anything with those two methods can be added with gateway.add_sink.
+
+
+class CsvSink:
+    """Appends batches to the recorded CSV (storage output file unless path is given)."""
+
+    name = "csv"
+
+    def __init__(self, path: str | None = None):
+        self.path = path
+
+    def write(self, batch: list):
+        save_many(batch, self.path)
+
+    def close(self):
+        pass
+
+
+class MetricsSink:
+    """Counts persisted readings per protocol, one counter update per protocol and batch."""
+
+    name = "metrics"
+
+    def write(self, batch: list):
+        counts = {}
+        for record in batch:
+            protocol = record.protocol
+            counts[protocol] = counts.get(protocol, 0) + 1
+        for protocol, n in counts.items():
+            GATEWAY_MESSAGES.inc(protocol, amount=n)
+
+    def close(self):
+        pass
+
+
+class ColumnarSink:
+    """Buffers records column-wise and writes Parquet part files of row_group_rows rows.
+
+    Needs the optional pyarrow package. Columns have a fixed type so every part file shares one
+    schema; missing fields are nulls.
+    """
+
+    name = "columnar"
+    _NUMERIC = {"value": "float64", "latency_ms": "float64", "payload_bytes": "float64",
+                "decode_us": "float64", "seq": "int64"}
+
+    def __init__(self, directory: str = "recorded_parquet", row_group_rows: int = 10000):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError as e:
+            raise RuntimeError(f"Columnar storage needs the optional pyarrow package: {e}") from e
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.row_group_rows = row_group_rows
+        self._columns = {k: [] for k in RECORD_HEADER}
+        self._rows = 0
+        self._parts = 0
+        # part files of a previous run would otherwise be read back as part of this one
+        for old in self.directory.glob("part-*.parquet"):
+            old.unlink()
+        self._lock = threading.Lock()
+        # send_ts/receive_ts are integers in timestamp_mode "ns", ISO strings otherwise
+        ts_type = "int64" if timestamps.MODE == "ns" else "string"
+        types = {**{k: "string" for k in RECORD_HEADER}, **self._NUMERIC, "send_ts": ts_type, "receive_ts": ts_type}
+        self._schema = pyarrow.schema([(k, types[k]) for k in RECORD_HEADER])
+
+    def write(self, batch: list):
+        with self._lock:
+            for k, column in self._columns.items():
+                column.extend(getattr(record, k) for record in batch)
+            self._rows += len(batch)
+            if self._rows >= self.row_group_rows:
+                self._flush()
+
+    def _flush(self):
+        if not self._rows:
+            return
+        table = self._pa.Table.from_pydict(self._columns, schema=self._schema)
+        self._parts += 1
+        self._pq.write_table(table, self.directory / f"part-{self._parts:05d}.parquet")
+        self._columns = {k: [] for k in RECORD_HEADER}
+        self._rows = 0
+
+    def close(self):
+        with self._lock:
+            self._flush()
@@ -1,10 +1,53 @@
 import csv
 import threading
+import time
 from pathlib import Path
 
+from metrics import STORAGE_QUEUE_DEPTH, STORAGE_FLUSH
+from segments import SegmentedLog, open_segment
+
 _lock = threading.Lock()
+# Column order of the recorded CSV; payload_bytes/decode_us come from the payload codec layer
+RECORD_HEADER = [
+    "device_id",
+    "time",
+    "date",
+    "protocol",
+    "sensor_type",
+    "value",
+    "send_ts",
+    "receive_ts",
+    "latency_ms",
+    "encoding",
+    "payload_bytes",
+    "decode_us",
+    "seq",
+]
+SENT_HEADER = ["device_id", "send_ts", "protocol", "payload_bytes", "encode_us", "seq"]
+# The sent log is only needed for PDR without sequence numbers; config sent_log_enabled
+SENT_LOG_ENABLED = True
 # Default to MQTT output since this repository focuses on MQTT now
 _output = Path("all_devices_recorded_data.csv")
+_sent_output = Path("sent_messages.csv")
+# Segmented output (see configure_segments); None keeps the single-file logs
+_segment_options = None
+_segments = None
+_sent_segments = None
+
+
+def configure_segments(segment_seconds: float = 0, segment_bytes: int = 0, retention_segments: int = 0,
+                       retention_seconds: float = 0, compress: bool = False):
+    """Write the recorded and sent logs as rotating segments from the next initialize_* call.
+
+    With neither segment_seconds nor segment_bytes set the logs stay single files.
+    """
+    global _segment_options
+    if not segment_seconds and not segment_bytes:
+        _segment_options = None
+        return
+    _segment_options = {"segment_seconds": segment_seconds, "segment_bytes": segment_bytes,
+                        "retention_segments": retention_segments, "retention_seconds": retention_seconds,
+                        "compress": compress}
 
 
 def initialize_output(path: str | None = None):
@@ -13,50 +56,60 @@ def initialize_output(path: str | None = None):
     If path is provided, switch the global output to it.
     This is intended to be called at application startup to start a fresh log.
     """
-    global _output
+    global _output, _segments
     if path:
         _output = Path(path)
-    header = [
-        "device_id",
-        "time",
-        "date",
-        "protocol",
-        "sensor_type",
-        "value",
-        "send_ts",
-        "receive_ts",
-        "latency_ms",
-    ]
     with _lock:
+        if _segments is not None:
+            _segments.close()
+            _segments = None
+        if _segment_options is not None:
+            _segments = SegmentedLog(_output, RECORD_HEADER, "receive_ts", **_segment_options)
+            return
         with _output.open("w", newline="", encoding="utf-8") as fh:
             writer = csv.writer(fh)
-            writer.writerow(header)
+            writer.writerow(RECORD_HEADER)
 
 
 def log_sent(record: dict, sent_log_path: str | None = None):
     """Log that a device attempted to send a message (used for PDR calculation).
 
-    record should contain at least device_id and send_ts.
+    record should contain at least device_id and send_ts; payload_bytes and encode_us are
+    filled in when the message was encoded (dropped messages leave them empty).
+    Does nothing when SENT_LOG_ENABLED is off.
     """
-    target = Path(sent_log_path) if sent_log_path else Path("sent_messages.csv")
-    header = ["device_id", "send_ts", "protocol"]
+    if not SENT_LOG_ENABLED:
+        return
+    if _sent_segments is not None and not sent_log_path:
+        with _lock:
+            _sent_segments.write([[record.get(k, "") for k in SENT_HEADER]])
+        return
+    target = Path(sent_log_path) if sent_log_path else _sent_output
     with _lock:
         exists = target.exists()
         with target.open("a", newline="", encoding="utf-8") as fh:
             writer = csv.writer(fh)
             if not exists:
-                writer.writerow(header)
-            writer.writerow([record.get("device_id"), record.get("send_ts"), record.get("protocol")])
+                writer.writerow(SENT_HEADER)
+            writer.writerow([record.get(k, "") for k in SENT_HEADER])
 
 
 def initialize_sent_log(path: str | None = None):
     """Create/overwrite the sent_messages.csv log with header."""
-    target = Path(path) if path else Path("sent_messages.csv")
-    header = ["device_id", "send_ts", "protocol"]
+    global _sent_output, _sent_segments
+    if path:
+        _sent_output = Path(path)
+    target = _sent_output
     with _lock:
+        if _sent_segments is not None:
+            _sent_segments.close()
+            _sent_segments = None
+        if _segment_options is not None:
+            _sent_segments = SegmentedLog(target, SENT_HEADER, "send_ts", **_segment_options)
+            return
         with target.open("w", newline="", encoding="utf-8") as fh:
             writer = csv.writer(fh)
-            writer.writerow(header)
+            writer.writerow(SENT_HEADER)
 
 
 def set_output_file(path: str):
@@ -68,30 +121,59 @@ def set_output_file(path: str):
     _output = Path(path)
 
 
-def save_to_csv(record: dict, output_path: str | None = None):
-    # Supported keys: device_id, time, date, protocol, sensor_type, value, send_ts, receive_ts, latency_ms
-    header = ["device_id", "time", "date", "protocol", "sensor_type", "value", "send_ts", "receive_ts", "latency_ms"]
+def save_many(records: list, output_path: str | None = None):
+    """Append records (Readings or dicts keyed by RECORD_HEADER) with one lock acquisition and one file open."""
+    if not records:
+        return
     target = Path(output_path) if output_path else _output
+    rows = [[record.get(k, "") for k in RECORD_HEADER] if isinstance(record, dict) else record.to_row()
+            for record in records]
+    started = time.perf_counter()
+    # writers queue on the lock; the gauge counts how many are waiting
+    STORAGE_QUEUE_DEPTH.inc()
     with _lock:
-        exists = target.exists()
-        with target.open("a", newline="", encoding="utf-8") as fh:
-            writer = csv.writer(fh)
-            if not exists:
-                writer.writerow(header)
-            row = [
-                record.get("device_id"),
-                record.get("time"),
-                record.get("date"),
-                record.get("protocol"),
-                record.get("sensor_type"),
-                record.get("value"),
-                record.get("send_ts", ""),
-                record.get("receive_ts", ""),
-                record.get("latency_ms", ""),
-            ]
-            writer.writerow(row)
+        STORAGE_QUEUE_DEPTH.dec()
+        if _segments is not None and not output_path:
+            _segments.write(rows)
+        else:
+            exists = target.exists()
+            with target.open("a", newline="", encoding="utf-8") as fh:
+                writer = csv.writer(fh)
+                if not exists:
+                    writer.writerow(RECORD_HEADER)
+                writer.writerows(rows)
+    STORAGE_FLUSH.observe(time.perf_counter() - started)
+
+
+def save_to_csv(record: dict, output_path: str | None = None):
+    # Supported keys: see RECORD_HEADER
+    save_many([record], output_path)
+
+
+def segment_files(start=None, end=None, devices=None) -> list:
+    """Recorded-data files that may hold rows for the time range/devices (all when unsegmented)."""
+    if _segments is None:
+        return [_output] if _output.exists() else []
+    return _segments.segment_files(start, end, devices)
+
+
+def close():
+    """Close segmented logs (final manifest, pending compaction); single-file logs need nothing."""
+    global _segments, _sent_segments
+    with _lock:
+        for log in (_segments, _sent_segments):
+            if log is not None:
+                log.close()
+        _segments = _sent_segments = None
+
 
 def read_all():
+    if _segments is not None:
+        rows = [RECORD_HEADER]
+        for path in _segments.segment_files():
+            with open_segment(path) as fh:
+                rows.extend(list(csv.reader(fh))[1:])
+        return rows
     if not _output.exists():
         return []
     with _output.open("r", encoding="utf-8") as fh:
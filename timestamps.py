@@ -0,0 +1,58 @@
+import time
+from datetime import datetime, timezone
+
+# "iso": send_ts/receive_ts are naive UTC ISO-8601 strings (the original CSV format).
+# "ns":  integer nanoseconds since the epoch (time.time_ns()); payloads also carry
+#        send_mono_ns so same-host latency is measured on the monotonic clock and is not
+#        affected by wall-clock adjustments. Nothing is parsed on the message path.
+MODE = "iso"
+MODES = ("iso", "ns")
+
+
+def set_mode(mode: str):
+    global MODE
+    if mode not in MODES:
+        raise ValueError(f"Unknown timestamp_mode '{mode}', expected one of {', '.join(MODES)}")
+    MODE = mode
+
+
+def utc_now() -> datetime:
+    """Naive UTC datetime (replacement for the deprecated datetime.utcnow())."""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def now():
+    """Current wall-clock timestamp in the configured representation."""
+    if MODE == "ns":
+        return time.time_ns()
+    return utc_now().isoformat()
+
+
+def send_stamp():
+    """Return (send_ts, send_mono_ns) for a reading sent now; send_mono_ns is None in iso mode."""
+    if MODE == "ns":
+        return time.time_ns(), time.monotonic_ns()
+    return utc_now().isoformat(), None
+
+
+def latency_ms(send_ts, send_mono_ns, recv_ts, recv_mono_ns: int | None = None):
+    """Latency in ms (float, microsecond resolution), or None when it cannot be computed."""
+    if send_ts is None or send_ts == "":
+        return None
+    try:
+        if send_mono_ns is not None:
+            mono = recv_mono_ns if recv_mono_ns is not None else time.monotonic_ns()
+            return round((mono - send_mono_ns) / 1e6, 3)
+        if isinstance(send_ts, int) and isinstance(recv_ts, int):
+            return round((recv_ts - send_ts) / 1e6, 3)
+        delta = to_datetime(recv_ts) - to_datetime(send_ts)
+        return round(delta.total_seconds() * 1000, 3)
+    except Exception:
+        return None
+
+
+def to_datetime(ts) -> datetime:
+    """Convert either representation to a naive UTC datetime (for presentation only)."""
+    if isinstance(ts, (int, float)) or (isinstance(ts, str) and ts.isdigit()):
+        return datetime.fromtimestamp(int(ts) / 1e9, timezone.utc).replace(tzinfo=None)
+    return datetime.fromisoformat(ts)
@@ -0,0 +1,128 @@
+import csv
+import itertools
+import random
+import threading
+import time
+from pathlib import Path
+
+from metrics import histogram
+
+# Stages stamped along the message path, in order. Not every protocol passes every stage:
+# Modbus readings are pulled by the poller, so they start at "received" and the delay the
+# poller injects afterwards shows up in persist_us. "flushed" is only stamped by batching MQTT
+# devices, when the batch holding the reading is taken for publishing.
+STAGES = ("generated", "flushed", "fault_delayed", "published", "received", "decoded", "persisted")
+# Span columns: time spent between consecutive stages, in microseconds; a span whose start
+# stage was not stamped starts at the previous stage instead
+SPANS = (
+    ("batch_wait_us", "generated", "flushed"),
+    ("fault_delay_us", "flushed", "fault_delayed"),
+    ("send_us", "fault_delayed", "published"),
+    ("transit_us", "published", "received"),
+    ("decode_us", "received", "decoded"),
+    ("persist_us", "decoded", "persisted"),
+)
+TRACE_HEADER = ["trace_id", "device_id", "protocol"] + [name for name, _, _ in SPANS] + ["total_us"]
+
+STAGE_SECONDS = histogram(
+    "iot_trace_stage_seconds",
+    "Time between consecutive stages of sampled messages.",
+    ("protocol", "stage"),
+    buckets=(0.00001, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0),
+)
+
+SAMPLE_RATE = 0.0  # fraction of messages traced; 0 disables tracing
+MAX_OPEN_TRACES = 10000  # traces whose message was lost are evicted oldest-first
+FLUSH_EVERY = 50
+
+_output = Path("traces.csv")
+_open = {}  # trace_id -> [device_id, protocol, {stage: perf_counter_ns}]
+_buffer = []
+_ids = itertools.count(1)
+_rng = random.Random()
+_lock = threading.Lock()
+
+
+def initialize(sample_rate: float, path: str | None = None) -> Path:
+    """Set the sampling rate and create/overwrite the span output file; returns its path."""
+    global SAMPLE_RATE, _output
+    SAMPLE_RATE = float(sample_rate)
+    if path:
+        _output = Path(path)
+    with _lock:
+        _open.clear()
+        _buffer.clear()
+        if SAMPLE_RATE > 0:
+            with _output.open("w", newline="", encoding="utf-8") as fh:
+                csv.writer(fh).writerow(TRACE_HEADER)
+    return _output
+
+
+def start(device_id: str, protocol: str, stage: str = "generated"):
+    """Begin a trace for a new message if it is sampled; returns the trace id or None."""
+    if SAMPLE_RATE <= 0 or _rng.random() >= SAMPLE_RATE:
+        return None
+    now = time.perf_counter_ns()
+    trace_id = next(_ids)
+    with _lock:
+        if len(_open) >= MAX_OPEN_TRACES:
+            del _open[next(iter(_open))]
+        _open[trace_id] = [device_id, protocol, {stage: now}]
+    return trace_id
+
+
+def stamp(trace_id, stage: str, at_ns: int | None = None):
+    """Record that the traced message reached stage (no-op for unsampled messages).
+
+    at_ns lets callers stamp a time taken earlier, e.g. arrival before the payload (and so
+    the trace id) was decoded.
+    """
+    if trace_id is None:
+        return
+    now = at_ns if at_ns is not None else time.perf_counter_ns()
+    trace = _open.get(trace_id)
+    if trace is not None:
+        trace[2][stage] = now
+
+
+def finish(trace_id, stage: str = "persisted"):
+    """Stamp the final stage, emit the span record and update the per-stage histograms."""
+    if trace_id is None:
+        return
+    now = time.perf_counter_ns()
+    with _lock:
+        trace = _open.pop(trace_id, None)
+    if trace is None:
+        return
+    device_id, protocol, stamps = trace
+    stamps[stage] = now
+    row = [trace_id, device_id, protocol]
+    for name, a, b in SPANS:
+        if a not in stamps and a != STAGES[0]:
+            a = STAGES[STAGES.index(a) - 1]
+        if a in stamps and b in stamps:
+            delta = stamps[b] - stamps[a]
+            STAGE_SECONDS.observe(delta / 1e9, protocol, name[:-3])
+            row.append(round(delta / 1000.0, 1))
+        else:
+            row.append("")
+    first = min(stamps.values())
+    row.append(round((now - first) / 1000.0, 1))
+    with _lock:
+        _buffer.append(row)
+        if len(_buffer) >= FLUSH_EVERY:
+            _flush_locked()
+
+
+def _flush_locked():
+    if not _buffer:
+        return
+    with _output.open("a", newline="", encoding="utf-8") as fh:
+        csv.writer(fh).writerows(_buffer)
+    _buffer.clear()
+
+
+def flush():
+    """Write buffered span records to the output file."""
+    with _lock:
+        _flush_locked()